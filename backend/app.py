@@ -1,10 +1,16 @@
 import json
+import time
 import asyncio
+import hashlib
+import secrets
+import tempfile
+import threading
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
 from typing import Optional
 import sys
 import os
@@ -12,16 +18,113 @@ import os
 # プロジェクトルート（backendディレクトリ）をパスに追加
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from src.loader import DocumentProcessor
-from src.vectorstore import VectorStoreManager
-from src.generator import RAGGenerator
-from src.config import Config
+# NOTE: src.loader / src.vectorstore / src.generator は LangChain・Chroma・pypdf・
+# LLMクライアントを読み込むため重い。サーバーを即座に起動できるよう、
+# これらはウォームアップ処理の中で遅延インポートする。
+from src.config import Config, llm_settings
+from src.streaming import TokenCoalescer, iterate_in_thread, sse_event
+from src.admission import PRIORITY_BATCH, AdmissionController, AdmissionRejected, backend_key
+from src.cache import TTLCache, answer_cache_key
+from src.history import HistoryManager
+from src.images import ImagePreprocessor, ImageRejected
+from src.middleware import BodySizeLimitMiddleware, RequestTracingMiddleware
+from src.tracing import TraceRecorder, annotate, in_context, maybe_profile, profile_iterator, span
+from src.chunks import ChunkStore
+from src.querylog import QueryLog
+from src.documents import JOB_UNCHANGED, UploadJobs, UploadRejected, file_sha256, find_raw_file, list_raw_files, resolve_upload_path
+from src.warmup import TTFTTracker, keep_alive_seconds
+from src.router import BackendRouter
 from fastapi.middleware.cors import CORSMiddleware
 import requests
 
 # グローバル変数
 generator = None
-doc_chunks = None  # BM25再構築用にチャンクを保持
+partitions = None  # 自治体ごとのパーティション（PARTITION_BY_MUNICIPALITY=true のとき）
+rules_bundle = None  # PWA向けの分別ルールのバンドル（インジェストのたびに作り直す）
+raw_watcher = None  # data/raw の変更監視（WATCH_RAW_DIR=true のとき）
+
+# /ingest とファイル監視による取り込み直しを同時に走らせない
+index_lock = threading.Lock()
+# 分別ルールのバンドルの作り直しと部分的な更新を同時に走らせない
+rules_bundle_lock = threading.Lock()
+
+# LLM生成の受付制御（バックエンドごとの同時実行数と待ち行列）
+admission = AdmissionController(
+    limits={
+        "ollama": Config.LLM_MAX_CONCURRENCY_OLLAMA,
+        "openai": Config.LLM_MAX_CONCURRENCY_OPENAI,
+    },
+    max_queue=Config.LLM_QUEUE_MAX_DEPTH,
+    max_wait_sec=Config.LLM_QUEUE_MAX_WAIT,
+)
+
+# 回答キャッシュ（ヒット時は受付制御を通らない）
+answer_cache = TTLCache(max_entries=Config.ANSWER_CACHE_SIZE, ttl_sec=Config.ANSWER_CACHE_TTL)
+
+# 検索結果のキャッシュ（回答キャッシュの対象外のリクエストでも検索を省ける）
+retrieval_cache = TTLCache(max_entries=Config.RETRIEVAL_CACHE_SIZE, ttl_sec=Config.ANSWER_CACHE_TTL)
+
+# 質問ログ（正規化した質問・自治体・応答時間のみ）と、それを使ったキャッシュの事前生成
+query_log = QueryLog(
+    path=Config.QUERY_LOG_FILE,
+    enabled=Config.QUERY_LOG_ENABLED,
+    max_bytes=Config.QUERY_LOG_MAX_BYTES,
+)
+cache_warming = {"task": None, "runs": 0, "warmed": 0, "skipped": 0, "last_run": None}
+
+# 会話ごとの圧縮済み履歴（クライアントは会話IDだけ送ればよい）
+conversations = HistoryManager(
+    recent_turns=Config.HISTORY_RECENT_TURNS,
+    max_tokens=Config.HISTORY_MAX_TOKENS,
+    summary_max_chars=Config.HISTORY_SUMMARY_MAX_CHARS,
+    max_conversations=Config.CONVERSATION_CACHE_SIZE,
+    ttl_sec=Config.CONVERSATION_TTL,
+)
+
+# 画像の検証・縮小（同じ画像はハッシュでキャッシュ）
+image_preprocessor = ImagePreprocessor(
+    max_bytes=Config.IMAGE_MAX_BYTES,
+    max_side=Config.IMAGE_MAX_SIDE,
+    quality=Config.IMAGE_JPEG_QUALITY,
+    cache_size=Config.IMAGE_CACHE_SIZE,
+)
+
+# チャンクIDから本文を引くストア（回答にはIDとスニペットだけを載せる）
+chunk_store = ChunkStore(max_recent_bytes=Config.CHUNK_RECENT_MAX_BYTES)
+
+# POST /documents でアップロードされたファイルの取り込み状況
+upload_jobs = UploadJobs()
+
+# リクエストごとのトレース（遅いものだけJSONLに書き出す）
+trace_recorder = TraceRecorder(
+    enabled=Config.TRACING_ENABLED,
+    log_path=Config.TRACE_LOG_FILE,
+    slow_ms=Config.TRACE_SLOW_MS,
+    sample_rate=Config.TRACE_SAMPLE_RATE,
+    allow_profile=Config.TRACE_ALLOW_PROFILE,
+)
+
+# 最初のトークンまでの時間（モデル読み込みを伴う cold と、常駐済みの warm に分けて集計）
+ttft_tracker = TTFTTracker(keep_alive_sec=keep_alive_seconds(Config.OLLAMA_KEEP_ALIVE))
+
+# LLMバックエンドの振り分け（最初のトークンの締め切りでヘッジ、不調なバックエンドはブレーカーで外す）
+llm_router = BackendRouter(
+    ttft_deadline=Config.LLM_TTFT_DEADLINE,
+    first_token_timeout=Config.LLM_FIRST_TOKEN_TIMEOUT,
+    failure_threshold=Config.LLM_BREAKER_FAILURES,
+    cooldown_sec=Config.LLM_BREAKER_COOLDOWN,
+    # ヘッジ・予備のバックエンドへの呼び出しも受付枠を取ってから始める
+    admission=admission,
+)
+
+# 起動時ウォームアップの進捗（/health で公開）
+warmup_state = {
+    "stage": "pending",
+    "started_at": None,
+    "finished_at": None,
+    "error": None,
+    "models": None,  # モデルのウォームアップに掛かった時間
+}
 
 def _get_cors_origins():
     raw = os.getenv("CORS_ORIGINS", "*")
@@ -29,35 +132,339 @@ def _get_cors_origins():
         return ["*"]
     return [o.strip() for o in raw.split(",") if o.strip()]
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """アプリケーションの起動・終了時の処理"""
-    global generator, doc_chunks
+def _set_warmup_stage(stage, error=None):
+    """ウォームアップの進捗を更新する"""
+    warmup_state["stage"] = stage
+    warmup_state["error"] = error
+    if stage in ("ready", "error"):
+        warmup_state["finished_at"] = time.time()
+
+def _publish_rules_bundle(docs=None):
+    """分別ルールのバンドルを資料全体から作り直して保存・公開する（ブロッキング）"""
+    global rules_bundle
+    from src.rules_bundle import publish_rules_bundle
+
+    config = Config()
+    with rules_bundle_lock:
+        try:
+            if docs is None:
+                from src.loader import DocumentProcessor
+                docs = DocumentProcessor().load_documents(config.DATA_RAW_DIR)
+            rules_bundle = publish_rules_bundle(docs, config.DATA_RAW_DIR, config.DATA_PROCESSED_DIR)
+        except Exception as e:
+            # バンドルはオフライン用の補助なので、失敗してもインジェスト自体は止めない
+            print(f"⚠ Could not build rules bundle: {e}")
+
+def _update_rules_bundle(paths, docs=None):
+    """変更されたファイルのルールだけをバンドルに反映する（ブロッキング。ほかの資料は読み直さない）
+
+    docs は paths を読み込み済みのドキュメント（無ければここで読み込む）。読み込めなかったファイルは今のルールを残す。
+    """
+    global rules_bundle
+    from src.loader import DocumentProcessor, source_path
+    from src.rules_bundle import update_rules_bundle
+
+    config = Config()
+    with rules_bundle_lock:
+        if rules_bundle is None:
+            # まだ作られていなければ、起動時・/ingest で資料全体から作るときに含まれる
+            return
+        try:
+            by_source = {source_path(path, config.DATA_RAW_DIR): path for path in paths}
+            failed = []
+            if docs is None:
+                docs, failed = DocumentProcessor().load_files(sorted(by_source))
+            sources = set(by_source) - set(failed)
+            if sources:
+                rules_bundle = update_rules_bundle(
+                    rules_bundle, docs, sources, config.DATA_RAW_DIR, config.DATA_PROCESSED_DIR
+                )
+        except Exception as e:
+            print(f"⚠ Could not update rules bundle: {e}")
+
+def _load_rules_bundle():
+    """保存済みのバンドルを読み込む。無ければ None のまま"""
+    global rules_bundle
+    from src.rules_bundle import RulesBundle
+
+    rules_bundle = RulesBundle.load(Config.DATA_PROCESSED_DIR)
+
+def _load_chunks(publish_bundle=False):
+    """DATA_RAW_DIR のドキュメントを読み込んでチャンクに分割する（ブロッキング）"""
+    from src.loader import DocumentProcessor
+
+    config = Config()
+    processor = DocumentProcessor()
+    _set_warmup_stage("loading_documents")
+    docs = processor.load_documents(config.DATA_RAW_DIR)
+    if publish_bundle or rules_bundle is None:
+        _publish_rules_bundle(docs)
+    _set_warmup_stage("splitting")
+    return processor.split_documents(docs)
+
+def _build_generator(chunks, force_reingest=False):
+    """チャンクからハイブリッド検索とジェネレータを構築する（ブロッキング）"""
+    from src.vectorstore import VectorStoreManager
+    from src.generator import RAGGenerator
+
+    _set_warmup_stage("building_index")
+    vs_manager = VectorStoreManager()
+    hybrid_retriever = vs_manager.get_hybrid_retriever(chunks, force_reingest=force_reingest)
+    # 検索と同じ詰めたコーパスを登録する（文書が無くベクトル検索のみのときは空）
+    chunk_store.register_all(getattr(hybrid_retriever, "corpus", None) or [])
+    _set_warmup_stage("loading_model")
+    return RAGGenerator(
+        retriever=hybrid_retriever,
+        ttft_tracker=ttft_tracker,
+        chunk_store=chunk_store,
+        retrieval_cache=retrieval_cache,
+        router=llm_router
+    )
+
+def _drop_stale_collections():
+    """作り直す前のベクトルストアのコレクションを消す（検索を差し替えた後に呼ぶ）"""
+    from src.vectorstore import VectorStoreManager
+
+    VectorStoreManager(embeddings=generator.retriever.vectorstore.embeddings).drop_stale_collections()
+
+def _build_partitioned_generator():
+    """自治体パーティションを使うジェネレータを構築する（文書は初回利用時に読み込む）"""
+    global partitions
+    from src.partitions import PartitionManager, PartitionedRetriever
+    from src.generator import RAGGenerator
+
+    _set_warmup_stage("loading_model")
+    partitions = PartitionManager(max_resident=Config.MAX_RESIDENT_PARTITIONS)
+    return RAGGenerator(
+        retriever=PartitionedRetriever(partition_manager=partitions),
+        ttft_tracker=ttft_tracker,
+        chunk_store=chunk_store,
+        retrieval_cache=retrieval_cache,
+        router=llm_router
+    )
+
+def _reindex_files(paths):
+    """変更されたファイルだけを取り込み直し、成功したら検索を差し替える（ファイル監視・アップロードのスレッドから呼ばれる）
+
+    反映した内容（追加したチャンク数、または更新したパーティション）を返す。準備中で反映しなければ None。
+    削除されたファイルはインデックスから消すが、読み込めなかったファイル（コピー途中のPDFなど）は
+    今のチャンクを残し、結果の "failed" に入れて返す（ファイル監視が次の回に再試行する）。
+    """
+    from src.loader import DocumentProcessor, source_path
+    from src.vectorstore import VectorStoreManager
+
+    print(f"Detected changes in {len(paths)} file(s); updating the index...")
+    docs = None
+    with index_lock:
+        rag_generator = generator
+        if rag_generator is None:
+            # 起動中・インジェスト失敗中は反映しない（次の起動か /ingest で読み込まれる）
+            print("RAG components are not ready; skipping auto-ingest.")
+            return None
+        if partitions is not None:
+            # パーティションの中で読み込んだドキュメントは返らないので、バンドルの更新では読み込み直す
+            updated, failed = partitions.update_files(paths)
+            print(f"✓ Auto-ingest updated partitions: {updated}")
+            result = {"partitions": updated, "failed": failed}
+        else:
+            by_source = {source_path(path, Config.DATA_RAW_DIR): path for path in paths}
+            processor = DocumentProcessor()
+            docs, failed = processor.load_files(sorted(by_source))
+            # 読み込めなかったファイルは置き換え対象から外す（消すと検索から黙って消えてしまう）
+            sources = set(by_source) - set(failed)
+            failed = sorted(by_source[source] for source in failed)
+            if not sources:
+                print(f"⚠ Auto-ingest: could not load {len(failed)} file(s); keeping the current index.")
+                return {"chunks": 0, "total_chunks": len(chunk_store.corpus), "failed": failed}
+            new_chunks = processor.split_documents(docs)
+            vectorstore = rag_generator.retriever.vectorstore
+            vs_manager = VectorStoreManager(embeddings=vectorstore.embeddings)
+            # ベクトルストアは追加してから古いものを消す。失敗したら今の検索をそのまま使い続ける
+            added = vs_manager.replace_sources(vectorstore, sources, new_chunks)
+            corpus = chunk_store.corpus.replace_sources(sources, added)
+            if len(corpus):
+                retriever = vs_manager.build_hybrid_retriever(vectorstore, corpus)
+            else:
+                retriever = vectorstore.as_retriever(search_kwargs={"k": Config.RETRIEVAL_K})
+            chunk_store.register_all(corpus)
+            # BM25を含めて作り終えてから差し替える
+            rag_generator.retriever = retriever
+            print(f"✓ Auto-ingest: {len(sources)} file(s), {len(added)} chunks (total {len(corpus)})")
+            result = {"chunks": len(added), "total_chunks": len(corpus), "failed": failed}
+        if failed:
+            print(f"⚠ Auto-ingest: could not load {len(failed)} file(s); kept their current chunks: {failed}")
+        _clear_caches()
+    # バンドルも変更されたファイルの分だけ更新する（資料全体は解析し直さない）
+    _update_rules_bundle(sorted(set(paths) - set(failed)), docs)
+    return result
+
+def _clear_caches():
+    """検索対象が変わったので、検索結果と回答のキャッシュを捨てる"""
+    retrieval_cache.clear()
+    answer_cache.clear()
+
+async def _warm_popular_queries():
+    """質問ログでよく聞かれている質問を先に生成して、検索結果と回答をキャッシュに入れておく"""
+    loop = asyncio.get_running_loop()
+    entries = await loop.run_in_executor(
+        None, query_log.top_queries, Config.CACHE_WARM_TOP_N, Config.CACHE_WARM_WINDOW_DAYS
+    )
+    backend, model_type = resolve_backend(None)
+    warmed = skipped = 0
+    for entry in entries:
+        rag_generator = generator
+        if rag_generator is None:
+            break
+        # 実際のリクエストと同じキーになるよう、位置情報・履歴なしのリクエストとして組み立てる
+        # （モデル設定はサーバーの既定。PWAが既定と同じ設定を送ってくれば同じキーになる）
+        request = QueryRequest(prompt=entry["prompt"], municipality=entry["municipality"] or None)
+        chat_history = {"summary": "", "turns": []}
+        cache_key = get_cache_key(request, request.prompt, chat_history)
+        if answer_cache.contains(cache_key):
+            skipped += 1
+            continue
+        # 利用者が待っているときは生成枠を譲って打ち切る
+        if admission.stats().get(backend, {}).get("queue_depth", 0) > 0:
+            print("Cache warming paused: interactive requests are queued.")
+            break
+        try:
+            permit = await admission.acquire(backend, model_type, priority=PRIORITY_BATCH)
+        except AdmissionRejected:
+            break
+        try:
+            result = await loop.run_in_executor(
+                None,
+                lambda: rag_generator.get_answer(
+                    request.prompt, retrieval_options=get_retrieval_options(request)
+                )
+            )
+        except Exception as e:
+            print(f"Cache warming failed for a query: {e}")
+            continue
+        finally:
+            permit.release()
+        if not result.get("error"):
+            answer_cache.set(cache_key, result)
+            warmed += 1
+    cache_warming["runs"] += 1
+    cache_warming["warmed"] += warmed
+    cache_warming["skipped"] += skipped
+    cache_warming["last_run"] = {
+        "at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "candidates": len(entries),
+        "warmed": warmed,
+        "already_cached": skipped,
+    }
+    if entries:
+        print(f"Cache warming: {warmed} generated, {skipped} already cached (top {len(entries)} queries).")
+
+def _schedule_cache_warming():
+    """起動・インジェストの後に、よく聞かれる質問の事前生成をバックグラウンドで始める"""
+    if Config.CACHE_WARM_TOP_N <= 0 or not query_log.enabled:
+        return
+    task = cache_warming["task"]
+    if task is not None and not task.done():
+        task.cancel()
+    cache_warming["task"] = asyncio.create_task(_warm_popular_queries())
+
+def _start_watcher():
+    """data/raw の監視を始める"""
+    global raw_watcher
+    from src.watcher import RawDirWatcher
+
+    os.makedirs(Config.DATA_RAW_DIR, exist_ok=True)
+    raw_watcher = RawDirWatcher(
+        Config.DATA_RAW_DIR,
+        on_change=_reindex_files,
+        debounce_sec=Config.WATCH_DEBOUNCE_SEC,
+        poll_interval=Config.WATCH_POLL_INTERVAL,
+        force_polling=Config.WATCH_FORCE_POLLING
+    ).start()
+    print(f"Watching {Config.DATA_RAW_DIR} for changes.")
+
+def _warm_models(rag_generator):
+    """チャットモデルと埋め込みモデルを読み込ませておく（ブロッキング）"""
+    if not Config.MODEL_WARMUP:
+        return
+    _set_warmup_stage("warming_models")
+    timings = rag_generator.warm_up()
+    warmup_state["models"] = timings
+    print(f"Model warm-up finished: {timings}")
+
+async def _warm_up():
+    """バックグラウンドでRAGコンポーネントを読み込む"""
+    global generator
+    loop = asyncio.get_running_loop()
+    warmup_state["started_at"] = time.time()
     try:
-        config = Config()
-        processor = DocumentProcessor()
-        vs_manager = VectorStoreManager()
-        
-        # ドキュメントをロード（BM25用に常に必要）
-        docs = processor.load_documents(config.DATA_RAW_DIR)
-        doc_chunks = processor.split_documents(docs)
-        
+        await loop.run_in_executor(None, _load_rules_bundle)
+        if Config.PARTITION_BY_MUNICIPALITY:
+            # パーティションは初回利用時に読み込むので、起動時は文書を読まない
+            rag_generator = await loop.run_in_executor(None, _build_partitioned_generator)
+            await loop.run_in_executor(None, _warm_models, rag_generator)
+            generator = rag_generator
+            _set_warmup_stage("ready")
+            print("✓ RAG components (partitioned by municipality) ready.")
+            if rules_bundle is None:
+                # 起動時は文書を読まないので、バンドルが無い場合だけ受け付け開始後に作る
+                await loop.run_in_executor(None, _publish_rules_bundle)
+            return
+
+        # ドキュメントをロード（BM25用に常に必要。検索の準備ができたら詰めたコーパスだけを残す）
+        chunks = await loop.run_in_executor(None, _load_chunks)
         # ハイブリッド検索の準備（既存DBがあれば再利用）
-        hybrid_retriever = vs_manager.get_hybrid_retriever(doc_chunks, force_reingest=False)
-        
-        generator = RAGGenerator(retriever=hybrid_retriever)
+        rag_generator = await loop.run_in_executor(None, _build_generator, chunks, False)
+        del chunks
+        # モデルの読み込みが終わってから受け付けを始める（初回の質問が読み込み待ちにならないように）
+        await loop.run_in_executor(None, _warm_models, rag_generator)
+        generator = rag_generator
+        _set_warmup_stage("ready")
         print("✓ RAG components (Hybrid) loaded successfully.")
     except Exception as e:
+        _set_warmup_stage("error", str(e))
         print(f"⚠ Error loading RAG components: {e}")
         print("  The server will start but queries may not work.")
-    
+    finally:
+        # 監視と事前生成は受け付けを始めてから（起動に失敗した・終了時にキャンセルされた場合は始めない）
+        if warmup_state["stage"] == "ready":
+            if Config.WATCH_RAW_DIR:
+                _start_watcher()
+            _schedule_cache_warming()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリケーションの起動・終了時の処理"""
+    # 重い初期化はバックグラウンドで行い、HTTPサーバーはすぐに応答可能にする
+    warmup_task = asyncio.create_task(_warm_up())
+
     yield  # アプリケーション実行中
     
     # 終了時のクリーンアップ
+    warmup_task.cancel()
+    if raw_watcher is not None:
+        raw_watcher.stop()
+    if cache_warming["task"] is not None:
+        cache_warming["task"].cancel()
     print("Shutting down...")
 
 app = FastAPI(lifespan=lifespan)
 
+# ストリーミング応答で会話IDを返すヘッダー
+CONVERSATION_ID_HEADER = "X-Conversation-ID"
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """混雑時は Retry-After 付きで即座に 429/503 を返す"""
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+# 巨大なリクエスト（画像付き）はボディを読み切る前に413で拒否する
+# NOTE: 413応答にもCORSヘッダーが付くよう、CORSより先に（内側に）追加する
+app.add_middleware(BodySizeLimitMiddleware, max_bytes=Config.REQUEST_MAX_BODY_BYTES)
+
 # CORSを許可（フロントエンドからのアクセス用）
 # CORS_ORIGINS 環境変数で制限可能 (例: "https://your-app.pages.dev,http://localhost:8000")
 app.add_middleware(
@@ -66,8 +473,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", CONVERSATION_ID_HEADER],
 )
 
+# リクエストIDの付与とトレース（CORSの外側に置き、CORSの処理時間も含める）
+app.add_middleware(RequestTracingMiddleware, recorder=trace_recorder)
+
 # フロントエンドの静的ファイル配信
 FRONTEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "frontend")
 print(f"Frontend directory: {FRONTEND_DIR}")
@@ -83,25 +494,57 @@ class Location(BaseModel):
     latitude: float
     longitude: float
 
+class RetrievalOptions(BaseModel):
+    k: Optional[int] = Field(default=None, ge=1, le=50)
+    weights: Optional[list[float]] = Field(default=None, min_length=2, max_length=2)
+    adaptive: Optional[bool] = None  # スコアの分布で資料の数を決める（省略時は RETRIEVAL_ADAPTIVE）
+
 class QueryRequest(BaseModel):
     prompt: str
     config: Optional[dict] = None
     location: Optional[Location] = None
     image: Optional[str] = None
     history: Optional[list[ChatMessage]] = None
+    conversation_id: Optional[str] = None
+    retrieval: Optional[RetrievalOptions] = None
+    municipality: Optional[str] = None
+
+class BatchQueryRequest(BaseModel):
+    prompts: list[str] = Field(min_length=1)
+    config: Optional[dict] = None
+    retrieval: Optional[RetrievalOptions] = None
+    municipality: Optional[str] = None
 
 class SourceInfo(BaseModel):
+    chunk_id: Optional[str] = None  # 全文は GET /chunks/{chunk_id} で取得する
     filename: str
     snippet: str
     page: Optional[int] = None
+    scores: Optional[dict[str, float]] = None  # rrf / vector / bm25
 
 class QueryResponse(BaseModel):
     answer: str
     sources: list[SourceInfo]
+    retrieval: Optional[dict] = None  # 候補数・選んだ資料の数とその理由
+    conversation_id: Optional[str] = None  # 次の質問で送り返す会話ID（サーバーが発行）
 
 
 # --- Helper Functions ---
 
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+NDJSON_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+def ndjson_line(payload):
+    return json.dumps(payload, ensure_ascii=False) + "\n"
+
 def get_address_from_coords(lat, lon):
     """緯度経度から住所を取得する（逆ジオコーディング）"""
     try:
@@ -119,43 +562,100 @@ def get_address_from_coords(lat, lon):
     return None
 
 def build_source_list(result):
-    """検索結果からソース情報を構築する"""
-    sources = []
-    seen_snippets = set()
-    for content, meta in zip(result["source_documents"], result["metadata"]):
-        snippet = content[:200].replace("\n", " ").strip()
-        if len(content) > 200:
-            snippet += "..."
-        if snippet not in seen_snippets:
-            seen_snippets.add(snippet)
-            sources.append(SourceInfo(
-                filename=meta.get("source", "Unknown").split("/")[-1].split("\\")[-1],
-                snippet=snippet,
-                page=meta.get("page")
-            ))
-    return sources
-
-async def resolve_location(location: Optional[Location]) -> str:
-    """位置情報を住所文字列に変換する"""
+    """検索結果からソース情報を構築する（スニペットとIDはジェネレータが作成済み）"""
+    return [SourceInfo(**source) for source in result["sources"]]
+
+def resolve_backend(config_override):
+    """受付制御用に、リクエストが使うモデルバックエンドのキーと種別を返す"""
+    override = config_override or {}
+    model_type = override.get("type") or Config.LLM_MODEL_TYPE
+    return backend_key(model_type, override.get("address", "")), model_type
+
+def get_cache_key(request: "QueryRequest", full_prompt, chat_history, address=None):
+    """キャッシュ可能なリクエスト（画像・会話履歴なし）ならキーを返す"""
+    if request.image or chat_history["turns"] or chat_history["summary"]:
+        return None
+    return answer_cache_key(full_prompt, llm_settings(request.config), get_retrieval_options(request, address))
+
+def log_query(request: "QueryRequest", cache_key, address, started, cache_hit=False):
+    """質問ログに1件追記する。画像付き・会話の続きの質問（キャッシュ対象外）は再生できないので記録しない"""
+    if cache_key is None:
+        return
+    # 住所はそのまま残さず、既知の自治体名（パーティション名）に当たるときだけ記録する
+    if partitions is not None:
+        municipality = partitions.match(request.municipality or address) or ""
+    else:
+        municipality = request.municipality or ""
+    query_log.record(request.prompt, municipality, (time.perf_counter() - started) * 1000, cache_hit)
+
+def get_retrieval_options(request: "QueryRequest", address=None):
+    """リクエストごとの検索設定（k・重み・自治体）を辞書で返す"""
+    options = request.retrieval.model_dump(exclude_none=True) if request.retrieval else {}
+    # 自治体は明示指定を優先し、無ければ位置情報の住所から推定する
+    municipality = request.municipality or address
+    if partitions is not None and municipality:
+        options["municipality"] = partitions.match(municipality) or municipality
+    return options or None
+
+def get_chat_history(request: "QueryRequest"):
+    """会話IDまたはクライアント送信の履歴から (会話ID, 圧縮済みの履歴) を取得する。
+
+    会話IDは常にサーバーが発行したもの（知らないIDが送られてきたら新しく発行する）。
+    """
+    client_history = None
+    if request.history:
+        client_history = [{"role": m.role, "text": m.text} for m in request.history]
+    return conversations.get_history(request.conversation_id, client_history, request.prompt)
+
+async def prepare_image(image_data):
+    """画像を検証・縮小する（イベントループ外で実行）"""
+    if not image_data:
+        return None
+    try:
+        with span("image"):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, image_preprocessor.process, image_data
+            )
+    except ImageRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+async def resolve_location(location: Optional[Location]):
+    """位置情報を (プロンプト用の文字列, 住所) に変換する"""
     if not location:
-        return ""
-    address = await asyncio.get_running_loop().run_in_executor(
-        None, get_address_from_coords, location.latitude, location.longitude
-    )
+        return "", None
+    with span("geocode"):
+        address = await asyncio.get_running_loop().run_in_executor(
+            None, get_address_from_coords, location.latitude, location.longitude
+        )
     if address:
         print(f"Detected Location: {address}")
-        return f"現在のユーザーの位置情報: {address}\n"
-    return ""
+        return f"現在のユーザーの位置情報: {address}\n", address
+    return "", None
 
 
 # --- API Endpoints ---
 
 @app.get("/health")
 async def health_check():
-    """RAGコンポーネントの準備状況を返す"""
+    """RAGコンポーネントの準備状況とウォームアップの進捗を返す"""
+    if generator is not None:
+        status = "ready"
+    elif warmup_state["stage"] == "error":
+        status = "error"
+    else:
+        status = "loading"
+
+    started_at = warmup_state["started_at"]
+    finished_at = warmup_state["finished_at"] or time.time()
     return {
-        "status": "ready" if generator is not None else "loading",
-        "rag_initialized": generator is not None
+        "status": status,
+        "rag_initialized": generator is not None,
+        "warmup": {
+            "stage": warmup_state["stage"],
+            "elapsed_sec": round(finished_at - started_at, 2) if started_at else 0.0,
+            "error": warmup_state["error"],
+            "models": warmup_state["models"],
+        }
     }
 
 @app.get("/config")
@@ -164,6 +664,27 @@ async def get_config():
     config = Config()
     return config.to_dict()
 
+@app.get("/metrics")
+async def get_metrics():
+    """受付制御の待ち行列やキャッシュの統計を返す"""
+    return {
+        "admission": admission.stats(),
+        "answer_cache": answer_cache.stats(),
+        "retrieval_cache": retrieval_cache.stats(),
+        "query_log": query_log.stats(),
+        "cache_warming": {key: value for key, value in cache_warming.items() if key != "task"},
+        "conversations": conversations.stats(),
+        "image_cache": image_preprocessor.stats(),
+        "partitions": partitions.stats() if partitions is not None else None,
+        "ttft": ttft_tracker.stats(),
+        "llm_router": llm_router.stats(),
+        "rules_bundle": rules_bundle.stats() if rules_bundle is not None else None,
+        "tracing": trace_recorder.stats(),
+        "chunks": chunk_store.stats(),
+        "watcher": raw_watcher.stats() if raw_watcher is not None else None,
+        "uploads": upload_jobs.stats(),
+    }
+
 @app.post("/query", response_model=QueryResponse)
 async def query_rag(request: QueryRequest):
     """通常のRAGクエリ（非ストリーミング）"""
@@ -172,129 +693,403 @@ async def query_rag(request: QueryRequest):
             status_code=503, 
             detail="RAGシステムが初期化されていません。data/raw フォルダにPDFまたはTXTファイルを追加してサーバーを再起動してください。"
         )
+    started = time.perf_counter()
     
-    location_context = await resolve_location(request.location)
+    image_data = await prepare_image(request.image)
+    location_context, address = await resolve_location(request.location)
     full_prompt = location_context + request.prompt if location_context else request.prompt
 
-    # 会話履歴を渡す
-    chat_history = None
-    if request.history:
-        chat_history = [{"role": m.role, "text": m.text} for m in request.history]
+    # 会話履歴を渡す（要約＋直近の数ターンに圧縮済み）
+    conversation_id, chat_history = get_chat_history(request)
 
-    result = generator.get_answer(
-        full_prompt, 
-        request.config, 
-        image_data=request.image,
-        chat_history=chat_history
-    )
+    cache_key = get_cache_key(request, full_prompt, chat_history, address)
+    if cache_key:
+        cached = answer_cache.get(cache_key)
+        annotate(cache_hit=cached is not None)
+        if cached is not None:
+            conversations.record_turn(conversation_id, request.prompt, cached["answer"])
+            log_query(request, cache_key, address, started, cache_hit=True)
+            return QueryResponse(
+                answer=cached["answer"],
+                sources=build_source_list(cached),
+                retrieval=cached.get("retrieval"),
+                conversation_id=conversation_id
+            )
+
+    backend, model_type = resolve_backend(request.config)
+    with span("admission_wait", backend=backend):
+        permit = await admission.acquire(backend, model_type)
+
+    def generate():
+        with maybe_profile():
+            return generator.get_answer(
+                full_prompt, 
+                request.config, 
+                image_data=image_data,
+                chat_history=chat_history,
+                retrieval_options=get_retrieval_options(request, address)
+            )
+
+    try:
+        # トレースを引き継いでワーカースレッドで生成する
+        result = await asyncio.get_running_loop().run_in_executor(None, in_context(generate))
+    finally:
+        permit.release()
+
+    if not result.get("error"):
+        conversations.record_turn(conversation_id, request.prompt, result["answer"])
+        log_query(request, cache_key, address, started)
+        if cache_key:
+            answer_cache.set(cache_key, result)
     
     return QueryResponse(
         answer=result["answer"],
-        sources=build_source_list(result)
+        sources=build_source_list(result),
+        retrieval=result.get("retrieval"),
+        conversation_id=conversation_id
     )
 
 @app.post("/query/stream")
-async def query_rag_stream(request: QueryRequest):
+async def query_rag_stream(request: QueryRequest, http_request: Request):
     """ストリーミングRAGクエリ（SSE）"""
     if generator is None:
         raise HTTPException(
             status_code=503,
             detail="RAGシステムが初期化されていません。"
         )
+    started = time.perf_counter()
 
-    location_context = await resolve_location(request.location)
+    image_data = await prepare_image(request.image)
+    location_context, address = await resolve_location(request.location)
     full_prompt = location_context + request.prompt if location_context else request.prompt
 
-    chat_history = None
-    if request.history:
-        chat_history = [{"role": m.role, "text": m.text} for m in request.history]
+    conversation_id, chat_history = get_chat_history(request)
+    # 次の質問で送り返してもらう会話ID（ストリーム開始前に分かるようヘッダーで返す）
+    headers = dict(SSE_HEADERS, **{CONVERSATION_ID_HEADER: conversation_id})
+
+    cache_key = get_cache_key(request, full_prompt, chat_history, address)
+    cached = answer_cache.get(cache_key) if cache_key else None
+    annotate(cache_hit=cached is not None)
+    if cached is not None:
+        conversations.record_turn(conversation_id, request.prompt, cached["answer"])
+        log_query(request, cache_key, address, started, cache_hit=True)
+        return StreamingResponse(
+            cached_event_generator(cached),
+            media_type="text/event-stream",
+            headers=headers
+        )
+
+    # 混雑時はストリーム開始前に 429/503 を返す
+    backend, model_type = resolve_backend(request.config)
+    with span("admission_wait", backend=backend):
+        permit = await admission.acquire(backend, model_type)
 
     async def event_generator():
+        # LLMの同期ストリームは専用スレッドで回し、イベントループをブロックしない
+        stream = iterate_in_thread(lambda: profile_iterator(generator.get_answer_stream(
+            full_prompt,
+            request.config,
+            image_data=image_data,
+            chat_history=chat_history,
+            retrieval_options=get_retrieval_options(request, address)
+        )))
+        sources_chunk = None
+        # トークン単位ではなく時間窓・サイズ窓でまとめてフレーム化する
+        coalescer = TokenCoalescer(
+            window_ms=Config.STREAM_FLUSH_MS,
+            max_chars=Config.STREAM_FLUSH_CHARS
+        )
         try:
-            for chunk in generator.get_answer_stream(
-                full_prompt,
-                request.config,
-                image_data=request.image,
-                chat_history=chat_history
-            ):
+            async for chunk in stream:
                 chunk_type = chunk.get("type")
-                
+
+                if chunk_type == "token":
+                    text = coalescer.add(chunk["token"])
+                    if text is None:
+                        continue
+                    # クライアントが切断していたら上流の生成を打ち切る
+                    if await http_request.is_disconnected():
+                        print("Client disconnected; cancelling generation.")
+                        return
+                    yield sse_event({"type": "token", "token": text})
+                    continue
+
+                # 他のイベントの前に、まとめ中のトークンを送出しておく
+                pending = coalescer.flush()
+                if pending:
+                    yield sse_event({"type": "token", "token": pending})
+
                 if chunk_type == "sources":
-                    sources = build_source_list(chunk)
-                    data = json.dumps({
-                        "type": "sources",
-                        "sources": [s.model_dump() for s in sources]
-                    }, ensure_ascii=False)
-                    yield f"data: {data}\n\n"
-                
-                elif chunk_type == "token":
-                    data = json.dumps({
-                        "type": "token",
-                        "token": chunk["token"]
-                    }, ensure_ascii=False)
-                    yield f"data: {data}\n\n"
+                    sources_chunk = chunk
+                    yield sse_event({"type": "sources", "sources": chunk["sources"], "retrieval": chunk["retrieval"]})
                 
                 elif chunk_type == "done":
-                    data = json.dumps({
-                        "type": "done",
-                        "answer": chunk["answer"]
-                    }, ensure_ascii=False)
-                    yield f"data: {data}\n\n"
+                    conversations.record_turn(conversation_id, request.prompt, chunk["answer"])
+                    log_query(request, cache_key, address, started)
+                    if cache_key and sources_chunk is not None:
+                        answer_cache.set(cache_key, {
+                            "answer": chunk["answer"],
+                            "sources": sources_chunk["sources"],
+                            "retrieval": sources_chunk["retrieval"]
+                        })
+                    yield sse_event({"type": "done", "answer": chunk["answer"]})
                 
                 elif chunk_type == "error":
-                    data = json.dumps({
-                        "type": "error",
-                        "message": chunk["message"]
-                    }, ensure_ascii=False)
-                    yield f"data: {data}\n\n"
+                    yield sse_event({"type": "error", "message": chunk["message"]})
                 
                 elif chunk_type == "complete":
                     # ドキュメントが見つからない場合
-                    sources = build_source_list(chunk)
-                    data = json.dumps({
+                    log_query(request, cache_key, address, started)
+                    yield sse_event({
                         "type": "complete",
                         "answer": chunk["answer"],
-                        "sources": [s.model_dump() for s in sources]
-                    }, ensure_ascii=False)
-                    yield f"data: {data}\n\n"
+                        "sources": chunk["sources"],
+                        "retrieval": chunk["retrieval"]
+                    })
                     
         except Exception as e:
-            data = json.dumps({"type": "error", "message": str(e)}, ensure_ascii=False)
-            yield f"data: {data}\n\n"
+            yield sse_event({"type": "error", "message": str(e)})
+        finally:
+            # 途中終了（切断・キャンセル）時はワーカーに停止を伝える
+            await stream.aclose()
+            permit.release()
 
     return StreamingResponse(
         event_generator(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
+        headers=headers,
+        # ストリームが開始されずに切断された場合も生成枠を返却する
+        background=BackgroundTask(permit.release)
+    )
+
+async def cached_event_generator(result):
+    """キャッシュ済みの回答をSSEとして送出する"""
+    yield sse_event({"type": "sources", "sources": result["sources"], "retrieval": result.get("retrieval")})
+    yield sse_event({"type": "token", "token": result["answer"]})
+    yield sse_event({"type": "done", "answer": result["answer"]})
+
+@app.post("/query/batch")
+async def query_rag_batch(request: BatchQueryRequest, http_request: Request):
+    """複数の質問をまとめて回答する（NDJSON。回答ができた順に1行ずつ返す）"""
+    if generator is None:
+        raise HTTPException(
+            status_code=503,
+            detail="RAGシステムが初期化されていません。"
+        )
+    if len(request.prompts) > Config.BATCH_MAX_PROMPTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"質問は1回に{Config.BATCH_MAX_PROMPTS}件までです。"
+        )
+    rag_generator = generator
+    loop = asyncio.get_running_loop()
+    backend, model_type = resolve_backend(request.config)
+    semaphore = asyncio.Semaphore(max(1, Config.BATCH_MAX_CONCURRENCY))
+
+    # 同じ質問（正規化すると一致するもの）は1回だけ生成して、すべての番号に同じ回答を返す
+    groups, blank = {}, []
+    no_history = {"summary": "", "turns": []}
+    for index, prompt in enumerate(request.prompts):
+        if not prompt.strip():
+            blank.append(index)
+            continue
+        item = QueryRequest(
+            prompt=prompt, config=request.config, retrieval=request.retrieval, municipality=request.municipality
+        )
+        cache_key = get_cache_key(item, prompt, no_history)
+        groups.setdefault(cache_key, (item, []))[1].append(index)
+    annotate(prompts=len(request.prompts), unique=len(groups))
+
+    async def generate(item, query_vector):
+        # 同時生成数を抑え、受付制御では対話のリクエストより後に回す
+        async with semaphore:
+            permit = await admission.acquire(backend, model_type, priority=PRIORITY_BATCH)
+            try:
+                return await loop.run_in_executor(None, in_context(lambda: rag_generator.get_answer(
+                    item.prompt,
+                    item.config,
+                    retrieval_options=get_retrieval_options(item),
+                    query_vector=query_vector
+                )))
+            finally:
+                permit.release()
+
+    def result_lines(indices, result, cached):
+        for index in indices:
+            yield ndjson_line({
+                "type": "result",
+                "index": index,
+                "prompt": request.prompts[index],
+                "answer": result["answer"],
+                "sources": result["sources"],
+                "retrieval": result.get("retrieval"),
+                "cached": cached,
+                "error": result.get("error"),
+            })
+
+    async def line_generator():
+        counts = {"cache_hits": 0, "errors": len(blank)}
+        for index in blank:
+            yield ndjson_line({
+                "type": "result", "index": index, "prompt": request.prompts[index], "answer": "", "sources": [],
+                "retrieval": None, "cached": False, "error": "質問が空です。"
+            })
+
+        misses = []
+        for cache_key, (item, indices) in groups.items():
+            cached = answer_cache.get(cache_key)
+            if cached is not None:
+                counts["cache_hits"] += len(indices)
+                for line in result_lines(indices, cached, True):
+                    yield line
+            else:
+                misses.append((cache_key, item, indices))
+
+        # キャッシュに無い質問は1回の呼び出しでまとめて埋め込み、検索ではそのベクトルを使う
+        vectors = None
+        if misses:
+            try:
+                vectors = await loop.run_in_executor(
+                    None, in_context(rag_generator.embed_queries), [item.prompt for _, item, _ in misses]
+                )
+            except Exception as e:
+                print(f"Batch embedding failed; embedding each query separately: {e}")
+
+        tasks = {
+            asyncio.ensure_future(generate(item, vectors[i] if vectors else None)): (cache_key, item, indices)
+            for i, (cache_key, item, indices) in enumerate(misses)
         }
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    cache_key, _, indices = tasks[task]
+                    try:
+                        result = task.result()
+                    except AdmissionRejected as e:
+                        result = {"answer": "", "sources": [], "error": e.detail}
+                    except Exception as e:
+                        result = {"answer": "", "sources": [], "error": str(e)}
+                    if result.get("error"):
+                        counts["errors"] += len(indices)
+                    elif cache_key:
+                        answer_cache.set(cache_key, result)
+                    for line in result_lines(indices, result, False):
+                        yield line
+                # クライアントが切断していたら残りの生成は行わない
+                if pending and await http_request.is_disconnected():
+                    print("Client disconnected; cancelling batch.")
+                    return
+            yield ndjson_line({
+                "type": "done",
+                "total": len(request.prompts),
+                "unique": len(groups),
+                **counts,
+            })
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # 一括の質問は利用者の質問ではないので、質問ログ（よく聞かれる質問の事前生成）には記録しない
+    return StreamingResponse(
+        line_generator(),
+        media_type="application/x-ndjson",
+        headers=NDJSON_HEADERS
     )
 
 @app.post("/ingest")
 async def ingest_documents():
     """ドキュメントを再取り込みしてベクトルストアを再構築する"""
-    global generator, doc_chunks
+    global generator
+    loop = asyncio.get_running_loop()
+    # ファイル監視による取り込み直しが終わるのを待つ
+    await loop.run_in_executor(None, index_lock.acquire)
     try:
-        config = Config()
-        processor = DocumentProcessor()
-        vs_manager = VectorStoreManager()
-        
-        docs = processor.load_documents(config.DATA_RAW_DIR)
-        doc_chunks = processor.split_documents(docs)
+        warmup_state["started_at"] = time.time()
+        warmup_state["finished_at"] = None
+
+        if partitions is not None:
+            # パーティションごとに作り直す（常駐数の上限は守られる）
+            _set_warmup_stage("building_index")
+            total = await loop.run_in_executor(None, partitions.rebuild_all)
+            await loop.run_in_executor(None, _publish_rules_bundle)
+            _clear_caches()
+            _set_warmup_stage("ready")
+            _schedule_cache_warming()
+            return {"status": "success", "chunks": total, "partitions": partitions.list_partitions()}
+
+        with span("load_documents"):
+            chunks = await loop.run_in_executor(None, _load_chunks, True)
         
-        if not doc_chunks:
+        if not chunks:
+            _set_warmup_stage("ready" if generator is not None else "error", "no documents")
             raise HTTPException(status_code=400, detail="data/raw にドキュメントが見つかりません。")
         
-        hybrid_retriever = vs_manager.get_hybrid_retriever(doc_chunks, force_reingest=True)
-        generator = RAGGenerator(retriever=hybrid_retriever)
+        with span("build_index", chunks=len(chunks)):
+            generator = await loop.run_in_executor(None, _build_generator, chunks, True)
+        # 新しい検索に切り替えてから、作り直す前のコレクションを消す
+        await loop.run_in_executor(None, _drop_stale_collections)
+        _clear_caches()
+        _set_warmup_stage("ready")
+        _schedule_cache_warming()
         
-        return {"status": "success", "chunks": len(doc_chunks)}
+        return {"status": "success", "chunks": len(chunk_store.corpus)}
     except HTTPException:
         raise
     except Exception as e:
+        _set_warmup_stage("ready" if generator is not None else "error", str(e))
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        index_lock.release()
+
+
+# --- Source Chunks ---
+
+# コーパスに無い（直近に返しただけの）チャンクをキャッシュさせる秒数
+CHUNK_RECENT_MAX_AGE = 300
+
+@app.get("/chunks/{chunk_id}")
+async def get_chunk(chunk_id: str, request: Request):
+    """ソースを開いたときに、チャンクの全文を返す（IDは内容のハッシュなので長期キャッシュできる）
+
+    長期キャッシュさせるのは今のコーパスにあるチャンクだけ。直近に返しただけのチャンク
+    （古いベクトルDBやパーティションにしかないもの）は、消えることがあるので短い時間だけキャッシュさせる。
+    """
+    in_corpus = chunk_store.in_corpus(chunk_id)
+    chunk = chunk_store.get(chunk_id)
+    if chunk is None:
+        raise HTTPException(status_code=404, detail="指定されたチャンクが見つかりません。")
+    etag = f'"{chunk_id}"'
+    cache_control = "public, max-age=31536000, immutable" if in_corpus else f"public, max-age={CHUNK_RECENT_MAX_AGE}"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(chunk, headers=headers)
+
+
+# --- Offline Rules Bundle ---
+
+def _etag_matches(if_none_match, etag):
+    """If-None-Match ヘッダーが現在のETagに一致するか（弱いETag・複数指定・* に対応）"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+@app.get("/rules/bundle")
+async def get_rules_bundle(request: Request):
+    """PWAが端末内で品目を引くための分別ルールのバンドル（バージョン付き・gzip圧縮済み・ETag対応）"""
+    if rules_bundle is None:
+        raise HTTPException(status_code=503, detail="分別ルールのバンドルはまだ作成されていません。")
+    bundle = rules_bundle
+    headers = {"ETag": bundle.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request.headers.get("if-none-match"), bundle.etag):
+        return Response(status_code=304, headers=headers)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=bundle.gzipped, media_type="application/json", headers=headers)
+    return Response(content=bundle.body, media_type="application/json", headers=headers)
 
 
 # --- PDF File Endpoints ---
@@ -302,39 +1097,141 @@ async def ingest_documents():
 
 @app.get("/files")
 async def list_files():
-    """data/rawディレクトリ内のPDFファイル一覧を返す"""
+    """data/rawディレクトリ内のPDFファイル一覧を返す（自治体のサブフォルダ内は "柏市/xxx.pdf" の形）"""
     config = Config()
     raw_dir = config.DATA_RAW_DIR
     if not os.path.isdir(raw_dir):
         return {"files": []}
-    files = [
-        f for f in sorted(os.listdir(raw_dir))
-        if f.lower().endswith(".pdf") and os.path.isfile(os.path.join(raw_dir, f))
-    ]
+    files = await asyncio.get_running_loop().run_in_executor(None, list_raw_files, raw_dir)
     return {"files": files}
 
-@app.get("/files/{filename}")
+@app.get("/files/{filename:path}")
 async def serve_file(filename: str):
-    """指定されたPDFファイルを返す（パストラバーサル防止付き）"""
-    safe_name = os.path.basename(filename)
-    if safe_name != filename:
-        raise HTTPException(status_code=400, detail="Invalid filename")
-    if not safe_name.lower().endswith(".pdf"):
+    """指定されたPDFファイルを返す（パストラバーサル防止付き。ファイル名だけでもサブフォルダから探す）"""
+    if not filename.lower().endswith(".pdf"):
         raise HTTPException(status_code=400, detail="Only PDF files are available")
 
     config = Config()
-    file_path = os.path.join(config.DATA_RAW_DIR, safe_name)
+    file_path = find_raw_file(config.DATA_RAW_DIR, filename)
 
-    if not os.path.isfile(file_path):
+    if file_path is None:
         raise HTTPException(status_code=404, detail="File not found")
 
     return FileResponse(
         file_path,
         media_type="application/pdf",
-        filename=safe_name
+        filename=os.path.basename(file_path)
     )
 
 
+# --- Document Upload ---
+
+def _ingest_uploaded_file(job_id, path):
+    """アップロードされた1ファイルだけを取り込む（ワーカースレッドで実行）"""
+    try:
+        result = _reindex_files([path])
+        if result is None:
+            upload_jobs.finish(job_id, error="RAGシステムの準備中のため取り込めませんでした。/ingest で取り込んでください。")
+        elif result["failed"]:
+            upload_jobs.finish(job_id, result=result, error="ファイルを読み込めませんでした（壊れたPDFなど）。")
+        else:
+            upload_jobs.finish(job_id, result=result)
+    except Exception as e:
+        print(f"⚠ Upload ingest failed for {path}: {e}")
+        upload_jobs.finish(job_id, error=str(e))
+
+def _check_upload_token(request: Request):
+    if not Config.UPLOAD_TOKEN:
+        raise HTTPException(status_code=403, detail="アップロードは無効です（UPLOAD_TOKEN が設定されていません）。")
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), Config.UPLOAD_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="認証に失敗しました。", headers={"WWW-Authenticate": "Bearer"})
+
+@app.post("/documents", status_code=202)
+async def upload_document(request: Request, filename: str, municipality: Optional[str] = None):
+    """PDF・TXTを1ファイルアップロードし、そのファイルだけをバックグラウンドで取り込む。
+
+    ボディはファイルの中身そのもの（multipartではない）。例:
+    curl -X POST -H "Authorization: Bearer $UPLOAD_TOKEN" --data-binary @早見表.pdf \
+         "http://localhost:8000/documents?filename=早見表.pdf&municipality=柏市"
+    進捗は返される status_url（GET /documents/{id}）で確認する。
+    """
+    _check_upload_token(request)
+    if generator is None:
+        raise HTTPException(status_code=503, detail="RAGシステムが初期化されていません。")
+    try:
+        target = resolve_upload_path(Config.DATA_RAW_DIR, filename, municipality)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    content_length = request.headers.get("content-length", "")
+    max_mb = Config.UPLOAD_MAX_BYTES // (1024 * 1024)
+    if content_length.isdigit() and int(content_length) > Config.UPLOAD_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"ファイルが大きすぎます（上限 {max_mb}MB）。")
+
+    loop = asyncio.get_running_loop()
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    # 書き込み途中のファイルは隠しファイルにして、ファイル監視や /files の対象にしない
+    fd, temp_path = tempfile.mkstemp(prefix=".upload-", suffix=".part", dir=directory)
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+
+    def write(f, chunk):
+        digest.update(chunk)
+        f.write(chunk)
+
+    try:
+        # ボディは届いた分ずつディスクに書き、ファイル全体をメモリに載せない
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > Config.UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail=f"ファイルが大きすぎます（上限 {max_mb}MB）。")
+                if len(head) < 5:
+                    head += chunk[:5 - len(head)]
+                await loop.run_in_executor(None, write, f, chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="ファイルが空です。")
+        if target.lower().endswith(".pdf") and not head.startswith(b"%PDF-"):
+            raise HTTPException(status_code=415, detail="PDFファイルではありません。")
+
+        sha256 = digest.hexdigest()
+        relative = os.path.relpath(target, Config.DATA_RAW_DIR).replace(os.sep, "/")
+        # 同じ内容のファイルが既にあれば置き換えず、取り込みもしない
+        if await loop.run_in_executor(None, file_sha256, target) == sha256:
+            os.remove(temp_path)
+            job = upload_jobs.create(relative, sha256, size, status=JOB_UNCHANGED)
+        else:
+            os.replace(temp_path, target)
+            # ファイル監視が同じ変更をもう一度取り込まないようにする
+            if raw_watcher is not None:
+                raw_watcher.mark_indexed([target])
+            job = upload_jobs.create(relative, sha256, size)
+            loop.run_in_executor(None, _ingest_uploaded_file, job["id"], target)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    status_url = f"/documents/{job['id']}"
+    return JSONResponse(
+        dict(job, status_url=status_url),
+        status_code=202,
+        headers={"Location": status_url}
+    )
+
+@app.get("/documents/{job_id}")
+async def get_upload_status(job_id: str):
+    """アップロードしたファイルの取り込み状況を返す（indexing / done / unchanged / error）"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="指定されたアップロードが見つかりません。")
+    return job
+
+
 # --- Static File Serving ---
 # クラウドデプロイ時はフロントエンドを別ホスト(Cloudflare Pages等)で配信するため、
 # SERVE_FRONTEND=false でスキップ可能
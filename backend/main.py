@@ -12,17 +12,84 @@ from src.extractor import DataExtractor
 from src.evaluator import RAGEvaluator
 from src.config import Config
 
+# app.py のインポート時に読み込まれてはいけない重いモジュール（遅延インポート対象）
+HEAVY_STARTUP_MODULES = (
+    "langchain_community",
+    "langchain_openai",
+    "langchain_ollama",
+    "langchain_classic",
+    "chromadb",
+    "pypdf",
+    "openai",
+    "ollama",
+)
+
+def profile_startup(top_n=15):
+    """app.py のインポート時間を計測し、重いバックエンドが読み込まれていれば失敗を返す"""
+    import subprocess
+
+    backend_dir = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=backend_dir, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        return False
+
+    # 形式: "import time: self [us] | cumulative | imported package"
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        timings.append((int(cumulative), name.strip()))
+
+    total_us = next((us for us, name in timings if name == "app"), 0)
+    print(f"import app: {total_us / 1000:.1f} ms")
+    for us, name in sorted(timings, reverse=True)[:top_n]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    leaked = sorted({
+        name for _, name in timings
+        if name.split(".")[0] in HEAVY_STARTUP_MODULES
+    })
+    if leaked:
+        print("NG: heavy modules imported at startup:")
+        for name in leaked:
+            print(f"  - {name}")
+        return False
+    print("OK: no heavy backends imported at startup.")
+    return True
+
 def main():
     parser = argparse.ArgumentParser(description="Waste Sorting RAG System")
     parser.add_argument("--ingest", action="store_true", help="Ingest documents and create vector store")
     parser.add_argument("--extract", action="store_true", help="Extract structured data from documents")
     parser.add_argument("--eval", action="store_true", help="Evaluate the RAG system quality")
     parser.add_argument("--query", type=str, help="Query the RAG system")
+    parser.add_argument("--tune", action="store_true", help="Sweep retrieval parameters (no LLM calls) and write a Pareto-optimal config")
+    parser.add_argument("--tune-cases", type=str, default="data/eval/retrieval_cases.json", help="Labelled query -> expected source set for --tune")
+    parser.add_argument("--tune-output", type=str, default=None, help="Where --tune writes its result (default: RETRIEVAL_TUNING_FILE)")
+    parser.add_argument("--profile-startup", action="store_true", help="Profile app.py import time and fail if heavy backends are imported eagerly")
     args = parser.parse_args()
 
+    if args.profile_startup:
+        sys.exit(0 if profile_startup() else 1)
+
     config = Config()
     
-    if args.ingest:
+    if args.ingest and config.PARTITION_BY_MUNICIPALITY:
+        # 自治体ごとのパーティションを1つずつ作り直す（常駐は1つだけにしてメモリを抑える）
+        from src.partitions import PartitionManager
+        partitions = PartitionManager(max_resident=1)
+        total = partitions.rebuild_all()
+        # PWA向けの分別ルールのバンドルも作り直す
+        from src.rules_bundle import publish_rules_bundle
+        docs = DocumentProcessor().load_documents(config.DATA_RAW_DIR)
+        publish_rules_bundle(docs, config.DATA_RAW_DIR, config.DATA_PROCESSED_DIR)
+        print(f"Ingestion completed: {total} chunks in {len(partitions.list_partitions())} partitions.")
+    elif args.ingest:
         # ドキュメントの読み込みと分割
         processor = DocumentProcessor()
         docs = processor.load_documents(config.DATA_RAW_DIR)
@@ -35,6 +102,11 @@ def main():
         # ベクトルストアの作成
         vs_manager = VectorStoreManager()
         vs_manager.create_vectorstore(chunks)
+        vs_manager.drop_stale_collections()
+
+        # PWA向けの分別ルールのバンドル
+        from src.rules_bundle import publish_rules_bundle
+        publish_rules_bundle(docs, config.DATA_RAW_DIR, config.DATA_PROCESSED_DIR)
         print("Ingestion completed.")
 
     if args.extract:
@@ -82,6 +154,17 @@ def main():
             json.dump(results, f, ensure_ascii=False, indent=4)
         print(f"Evaluation results saved to {output_file}")
 
+    if args.tune:
+        from src.tuner import RetrievalTuner, load_cases, save_tuning
+        # 検索だけを掃引する（LLMは呼ばない）。埋め込みは掃引の間で使い回す
+        tuner = RetrievalTuner(load_cases(args.tune_cases))
+        result = tuner.run()
+        output_file = save_tuning(result, args.tune_output or config.RETRIEVAL_TUNING_FILE)
+        print(f"Pareto front: {len(result['pareto'])} of {len(result['points'])} points")
+        print(f"Recommended: {result['recommended']} -> {result['recommended_metrics']}")
+        print(f"Tuning results saved to {output_file}")
+        print("The server loads the recommended values on startup; run --ingest if chunking changed.")
+
     if args.query:
         # ドキュメントの読み込みと分割（ハイブリッド検索のために必要）
         processor = DocumentProcessor()
@@ -100,8 +183,8 @@ def main():
         print("\n--- Answer ---")
         print(result["answer"])
         print("\n--- Sources ---")
-        for i, meta in enumerate(result["metadata"]):
-            print(f"[{i+1}] {meta.get('source', 'Unknown')}")
+        for i, source in enumerate(result["sources"]):
+            print(f"[{i+1}] {source['filename']} ({source['chunk_id']})")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,202 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import math
+import time
+
+# 優先度（小さいほど先に処理される）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+# ワーカースレッドからイベントループ上の処理を呼ぶときに待つ上限（ループが止まっている場合に備える）
+LOOP_CALL_TIMEOUT_SEC = 5.0
+
+
+def backend_key(model_type, address=""):
+    """受付制御のバックエンドのキー（種別と、OpenAI以外はサーバーのアドレス）"""
+    # OpenAI の address は APIキーなのでキーには含めない
+    if model_type != "openai" and address:
+        return f"{model_type}@{address}"
+    return model_type
+
+
+class AdmissionRejected(Exception):
+    """混雑のため受付を拒否したことを表す（HTTP 429/503 に変換される）"""
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class AdmissionPermit:
+    """生成枠の利用権。release() は何度呼んでもよい"""
+
+    def __init__(self, controller, gate):
+        self._controller = controller
+        self._gate = gate
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        # ヘッジ・予備のバックエンドの枠はワーカースレッドから返されるので、イベントループ上で返す
+        self._controller._call_on_loop(self._controller._release, self._gate, time.monotonic() - self._started, wait=False)
+
+
+class _BackendGate:
+    """1つのモデルバックエンドに対する同時実行枠と待ち行列"""
+
+    def __init__(self, name, max_concurrency):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.active = 0
+        self.waiters = []  # heap: [priority, seq, future]
+        self.avg_service_sec = 10.0  # 生成時間の指数移動平均（Retry-After の見積もりに使う）
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    def queue_depth(self):
+        return sum(1 for _, _, fut in self.waiters if not fut.done())
+
+
+class AdmissionController:
+    """LLM生成の同時実行数をバックエンドごとに制限し、優先度付きFIFOで待たせる。
+
+    待ち行列が満杯なら429、最大待ち時間を超えたら503を AdmissionRejected で返す。
+    イベントループ上からのみ呼び出すこと（try_acquire_nowait と AdmissionPermit.release はワーカースレッドからも呼べる）。
+    """
+
+    def __init__(self, limits, default_limit=2, max_queue=32, max_wait_sec=30.0):
+        self.limits = dict(limits)
+        self.default_limit = default_limit
+        self.max_queue = max_queue
+        self.max_wait_sec = max_wait_sec
+        self._gates = {}
+        self._seq = itertools.count()
+        self._loop = None
+
+    def _gate(self, backend, model_type=None):
+        gate = self._gates.get(backend)
+        if gate is None:
+            limit = self.limits.get(model_type or backend, self.default_limit)
+            gate = _BackendGate(backend, limit)
+            self._gates[backend] = gate
+        return gate
+
+    def _retry_after(self, gate):
+        """待ち行列の長さと平均生成時間から再試行までの秒数を見積もる"""
+        backlog = gate.queue_depth() + 1
+        return max(1, math.ceil(gate.avg_service_sec * backlog / gate.max_concurrency))
+
+    def _call_on_loop(self, func, *args, wait=True):
+        """func をイベントループ上で呼ぶ。ループ外のスレッドからなら結果を待つ（wait=False なら待たない）"""
+        loop = self._loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop is None or running is loop or loop.is_closed():
+            return func(*args)
+        if not wait:
+            loop.call_soon_threadsafe(func, *args)
+            return None
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        loop.call_soon_threadsafe(run)
+        try:
+            return future.result(timeout=LOOP_CALL_TIMEOUT_SEC)
+        except concurrent.futures.TimeoutError:
+            if future.cancel():
+                return None
+            return future.result()
+
+    def _try_acquire(self, backend, model_type):
+        gate = self._gate(backend, model_type)
+        if gate.active < gate.max_concurrency and gate.queue_depth() == 0:
+            gate.active += 1
+            gate.admitted += 1
+            return AdmissionPermit(self, gate)
+        return None
+
+    def try_acquire_nowait(self, backend, model_type=None):
+        """空きがあれば待たずに生成枠を取得する。空きが無ければ None（ヘッジ・予備のバックエンド用）
+
+        待っているリクエストがあれば追い越さない。ワーカースレッドからも呼べる。
+        """
+        return self._call_on_loop(self._try_acquire, backend, model_type)
+
+    async def acquire(self, backend, model_type=None, priority=PRIORITY_INTERACTIVE):
+        """生成枠を取得する。混雑時は AdmissionRejected を送出する"""
+        self._loop = asyncio.get_running_loop()
+        permit = self._try_acquire(backend, model_type)
+        if permit is not None:
+            return permit
+        gate = self._gate(backend, model_type)
+
+        if gate.queue_depth() >= self.max_queue:
+            gate.rejected += 1
+            raise AdmissionRejected(
+                429, "混雑しています。しばらくしてから再度お試しください。", self._retry_after(gate)
+            )
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(gate.waiters, [priority, next(self._seq), fut])
+        try:
+            await asyncio.wait({fut}, timeout=self.max_wait_sec)
+        except asyncio.CancelledError:
+            # 枠を受け取った直後にキャンセルされた場合は次の待ち手に譲る
+            if fut.done() and not fut.cancelled():
+                self._release(gate, None)
+            else:
+                fut.cancel()
+            raise
+
+        if not fut.done():
+            fut.cancel()
+            gate.timed_out += 1
+            raise AdmissionRejected(
+                503, "処理待ちがタイムアウトしました。しばらくしてから再度お試しください。", self._retry_after(gate)
+            )
+        gate.admitted += 1
+        return AdmissionPermit(self, gate)
+
+    def _release(self, gate, duration):
+        if duration is not None:
+            gate.avg_service_sec = 0.8 * gate.avg_service_sec + 0.2 * duration
+        # 待ち手がいれば枠をそのまま引き渡す（active は変えない）
+        while gate.waiters:
+            _, _, fut = heapq.heappop(gate.waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        gate.active -= 1
+
+    def stats(self):
+        """バックエンドごとの実行数・待ち行列の深さなどを返す"""
+        return {
+            name: {
+                "active": gate.active,
+                "max_concurrency": gate.max_concurrency,
+                "queue_depth": gate.queue_depth(),
+                "max_queue": self.max_queue,
+                "admitted": gate.admitted,
+                "rejected": gate.rejected,
+                "timed_out": gate.timed_out,
+                "avg_service_sec": round(gate.avg_service_sec, 2),
+            }
+            for name, gate in self._gates.items()
+        }
@@ -0,0 +1,86 @@
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt):
+    """キャッシュキー用に質問文を正規化する（全角/半角・空白の揺れを吸収）"""
+    text = unicodedata.normalize("NFKC", prompt or "")
+    return " ".join(text.split())
+
+
+def answer_cache_key(prompt, llm=None, retrieval_options=None):
+    """質問文・モデル設定・検索設定から回答キャッシュのキーを作る
+
+    llm は既定値で補った設定（config.llm_settings）。回答を変える項目（種別・モデル名・温度・Ollamaの接続先）
+    だけを使うので、PWAが既定と同じ設定を送ってきても事前生成した回答に当たる。APIキーは含めない。
+    """
+    llm = llm or {}
+    material = json.dumps({
+        "prompt": normalize_prompt(prompt),
+        "type": llm.get("type"),
+        "name": llm.get("name"),
+        "base_url": (llm.get("ollama_base_url") or "").rstrip("/") if llm.get("type") != "openai" else None,
+        "temp": llm.get("temperature"),
+        "retrieval": retrieval_options,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """TTL付きのLRUキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, max_entries=256, ttl_sec=3600):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """値を返す。存在しないか期限切れならNone"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def contains(self, key):
+        """有効な値があるか（ヒット・ミスの統計には数えない）"""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def set(self, key, value):
+        """値を保存し、上限を超えたら古いものから削除する"""
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_sec, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
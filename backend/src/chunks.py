@@ -0,0 +1,319 @@
+import hashlib
+import itertools
+import json
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+# 検索結果に載せるスニペットの長さ（全文は /chunks/{id} で取得する）
+SNIPPET_CHARS = 200
+# 検索時に付くスコア（{"rrf", "vector", "bm25"}）を入れるメタデータのキー。保存はしない
+SCORES_KEY = "retrieval_scores"
+# 検索でタイムアウト・失敗したレッグの名前の一覧を入れるメタデータのキー（スコアとは別に持つ）。保存はしない
+DEGRADED_KEY = "retrieval_degraded"
+# 列に持つ整数のメタデータ（page, row）が無いことを表す値
+_MISSING = -1
+
+
+def source_filename(metadata):
+    """メタデータの source からファイル名だけを取り出す（Windowsのパスにも対応）"""
+    return metadata.get("source", "Unknown").split("/")[-1].split("\\")[-1]
+
+
+def chunk_id(doc):
+    """チャンクの内容から安定したIDを作る（再インジェストしても内容が同じなら同じID）"""
+    existing = doc.metadata.get("chunk_id")
+    if existing:
+        return existing
+    material = f"{source_filename(doc.metadata)}\x00{doc.metadata.get('page', '')}\x00{doc.page_content}"
+    return hashlib.sha1(material.encode("utf-8")).hexdigest()[:16]
+
+
+def assign_chunk_ids(chunks):
+    """分割直後のチャンクにIDを付ける（ベクトルストアにも保存される）"""
+    for chunk in chunks:
+        chunk.metadata["chunk_id"] = chunk_id(chunk)
+    return chunks
+
+
+def make_snippet(content):
+    snippet = content[:SNIPPET_CHARS].replace("\n", " ").strip()
+    if len(content) > SNIPPET_CHARS:
+        snippet += "..."
+    return snippet
+
+
+class CompactChunks:
+    """チャンクの一覧を整数IDで引けるように詰めて持つ（変更しない。差し替えるときは作り直す）。
+
+    本文は1本の文字列にまとめてオフセットで切り出し、source は表に1回だけ持って番号で参照する。
+    page・row は整数の配列に、残りのメタデータ（PDFの作成者・表の列見出しなど）は同じ内容を1つに
+    まとめた表に入れる。LangChain の Document は document(i) で必要になったときだけ作る。
+    """
+
+    def __init__(self, chunks=()):
+        texts = []
+        self._offsets = array("q", [0])
+        self._ids = []
+        self._index = {}
+        self._sources, self._filenames, source_index = [], [], {}
+        self._source_ids = array("I")
+        self._pages = array("i")
+        self._page_labelled = array("b")
+        self._rows = array("i")
+        self._meta_table, meta_index = [], {}
+        self._meta_ids = array("I")
+        for chunk in chunks:
+            metadata = dict(chunk.metadata)
+            metadata.pop(SCORES_KEY, None)
+            metadata.pop(DEGRADED_KEY, None)
+            cid = metadata.pop("chunk_id", None) or chunk_id(chunk)
+            if cid in self._index:
+                continue
+            self._index[cid] = len(self._ids)
+            self._ids.append(cid)
+            texts.append(chunk.page_content)
+            self._offsets.append(self._offsets[-1] + len(chunk.page_content))
+
+            source = metadata.pop("source", "Unknown")
+            if source not in source_index:
+                source_index[source] = len(self._sources)
+                self._sources.append(source)
+                self._filenames.append(source_filename({"source": source}))
+            self._source_ids.append(source_index[source])
+            page = self._pop_int(metadata, "page")
+            self._pages.append(page)
+            # PDFのページラベルはたいてい「ページ番号+1」なので、そのときは持たずに復元する（表がページ単位に分かれない）
+            labelled = page != _MISSING and metadata.get("page_label") == str(page + 1)
+            if labelled:
+                del metadata["page_label"]
+            self._page_labelled.append(labelled)
+            self._rows.append(self._pop_int(metadata, "row"))
+
+            key = json.dumps(metadata, ensure_ascii=False, sort_keys=True, default=str)
+            if key not in meta_index:
+                meta_index[key] = len(self._meta_table)
+                self._meta_table.append(metadata)
+            self._meta_ids.append(meta_index[key])
+        self._text = "".join(texts)
+
+    @staticmethod
+    def _pop_int(metadata, key):
+        """0以上の整数なら列に入れるために取り出す。それ以外はメタデータの表に残す"""
+        value = metadata.get(key)
+        if type(value) is int and value >= 0:
+            del metadata[key]
+            return value
+        return _MISSING
+
+    def __len__(self):
+        return len(self._ids)
+
+    def index_of(self, cid):
+        """チャンクIDから整数IDを返す。無ければ None"""
+        return self._index.get(cid)
+
+    def chunk_id(self, i):
+        return self._ids[i]
+
+    def text(self, i):
+        return self._text[self._offsets[i]:self._offsets[i + 1]]
+
+    def texts(self):
+        for i in range(len(self)):
+            yield self.text(i)
+
+    def source(self, i):
+        return self._sources[self._source_ids[i]]
+
+    def page(self, i):
+        page = self._pages[i]
+        return None if page == _MISSING else page
+
+    def metadata(self, i):
+        metadata = dict(self._meta_table[self._meta_ids[i]])
+        metadata["source"] = self.source(i)
+        if self._pages[i] != _MISSING:
+            metadata["page"] = self._pages[i]
+            if self._page_labelled[i]:
+                metadata["page_label"] = str(self._pages[i] + 1)
+        if self._rows[i] != _MISSING:
+            metadata["row"] = self._rows[i]
+        metadata["chunk_id"] = self._ids[i]
+        return metadata
+
+    def document(self, i):
+        """LangChain に渡すための Document を作る"""
+        from langchain_core.documents import Document
+
+        return Document(page_content=self.text(i), metadata=self.metadata(i))
+
+    def ref(self, i):
+        """{chunk_id, filename, page, snippet}（スニペットは本文から都度切り出す）"""
+        return {
+            "chunk_id": self._ids[i],
+            "filename": self._filenames[self._source_ids[i]],
+            "page": self.page(i),
+            "snippet": make_snippet(self.text(i)),
+        }
+
+    def replace_sources(self, sources, new_chunks):
+        """指定したファイル（メタデータの source）のチャンクを new_chunks に置き換えた新しい一覧を返す
+
+        sources にあって new_chunks に無いファイルは消える（読み込めなかったファイルは sources に含めないこと）。
+        """
+        kept = (self.document(i) for i in range(len(self)) if self.source(i) not in sources)
+        return CompactChunks(itertools.chain(kept, new_chunks))
+
+    def stats(self):
+        arrays = (self._offsets, self._source_ids, self._pages, self._page_labelled, self._rows, self._meta_ids)
+        return {
+            "chunks": len(self),
+            "text_chars": len(self._text),
+            "sources": len(self._sources),
+            "metadata_variants": len(self._meta_table),
+            # 本文のバッファと列の配列の大きさ（IDの索引やメタデータの表は含まない概算）
+            "buffer_bytes": sys.getsizeof(self._text) + sum(a.itemsize * len(a) for a in arrays),
+        }
+
+
+class _Entry:
+    __slots__ = ("ref", "text", "metadata", "size")
+
+    def __init__(self, ref, text, metadata):
+        self.ref = ref
+        self.text = text
+        self.metadata = metadata
+        # 本文・スニペット・メタデータの大きさの概算（直近のチャンクをバイト数で制限するのに使う）
+        self.size = (
+            sys.getsizeof(text) + sys.getsizeof(ref["snippet"])
+            + len(json.dumps(metadata, ensure_ascii=False, default=str).encode("utf-8"))
+        )
+
+
+class ChunkStore:
+    """チャンクIDから本文を引くストア。
+
+    回答にはIDとスニペットだけを載せ、本文はクライアントがソースを開いたときに取得させる。
+    コーパス全体（ハイブリッド検索と共有する CompactChunks）に加えて、直近に返したチャンクも
+    max_recent_bytes（概算）まで保持する（古いベクトルDBやパーティションにしかないチャンク用）。
+    """
+
+    def __init__(self, max_recent_bytes=32 * 1024 * 1024):
+        self.max_recent_bytes = max_recent_bytes
+        self.corpus = CompactChunks()
+        self._recent = OrderedDict()
+        self._recent_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_entry(doc, cid):
+        ref = {
+            "chunk_id": cid,
+            "filename": source_filename(doc.metadata),
+            "page": doc.metadata.get("page"),
+            "snippet": make_snippet(doc.page_content),
+        }
+        # 検索ごとに付くスコアは持たない
+        metadata = {k: v for k, v in doc.metadata.items() if k not in (SCORES_KEY, DEGRADED_KEY)}
+        return _Entry(ref, doc.page_content, metadata)
+
+    def register_all(self, chunks):
+        """コーパスを登録し直す（インジェストのたびに置き換える）。チャンクのリストなら詰め直す"""
+        corpus = chunks if isinstance(chunks, CompactChunks) else CompactChunks(chunks)
+        with self._lock:
+            self.corpus = corpus
+
+    def ref(self, doc):
+        """検索結果のドキュメントに対応する {chunk_id, filename, page, snippet} を返す"""
+        cid = chunk_id(doc)
+        corpus = self.corpus
+        i = corpus.index_of(cid)
+        if i is not None:
+            return corpus.ref(i)
+        with self._lock:
+            entry = self._recent.get(cid)
+            if entry is None:
+                entry = self._make_entry(doc, cid)
+                self._recent[cid] = entry
+                self._recent_bytes += entry.size
+                # 古いものから捨てる（今入れたものは上限を超えていても残す）
+                while self._recent_bytes > self.max_recent_bytes and len(self._recent) > 1:
+                    _, evicted = self._recent.popitem(last=False)
+                    self._recent_bytes -= evicted.size
+            else:
+                self._recent.move_to_end(cid)
+        return entry.ref
+
+    def refs(self, docs):
+        """検索結果をIDで重複除去しながら参照の一覧にする（検索スコアがあれば添える）"""
+        refs, seen = [], set()
+        for doc in docs:
+            ref = self.ref(doc)
+            if ref["chunk_id"] not in seen:
+                seen.add(ref["chunk_id"])
+                scores = doc.metadata.get(SCORES_KEY)
+                # 直近のチャンクの参照は共有しているので、スコアはコピーに付ける
+                refs.append(dict(ref, scores=scores) if scores else ref)
+        return refs
+
+    def cache_entry(self, docs):
+        """検索結果をキャッシュに入れる形 [(チャンクID, スコア)] にする（本文は持たず、resolve で引き直す）"""
+        return [(self.ref(doc)["chunk_id"], doc.metadata.get(SCORES_KEY)) for doc in docs]
+
+    def resolve(self, entry):
+        """cache_entry の一覧から検索結果の Document を作り直す。引けないチャンクがあれば None"""
+        from langchain_core.documents import Document
+
+        corpus = self.corpus
+        docs = []
+        for cid, scores in entry:
+            i = corpus.index_of(cid)
+            if i is not None:
+                doc = corpus.document(i)
+            else:
+                with self._lock:
+                    recent = self._recent.get(cid)
+                    if recent is not None:
+                        self._recent.move_to_end(cid)
+                if recent is None:
+                    return None
+                doc = Document(page_content=recent.text, metadata=dict(recent.metadata))
+            if scores:
+                doc.metadata[SCORES_KEY] = dict(scores)
+            docs.append(doc)
+        return docs
+
+    def in_corpus(self, cid):
+        """今のコーパスにあるチャンクか（直近に返しただけのチャンクは、再取り込みで消えることがある）"""
+        return self.corpus.index_of(cid) is not None
+
+    def get(self, cid):
+        """IDから {chunk_id, filename, page, text, metadata} を返す。無ければ None"""
+        corpus = self.corpus
+        i = corpus.index_of(cid)
+        if i is not None:
+            ref = corpus.ref(i)
+            text, metadata = corpus.text(i), corpus.metadata(i)
+        else:
+            with self._lock:
+                entry = self._recent.get(cid)
+            if entry is None:
+                return None
+            ref, text, metadata = entry.ref, entry.text, entry.metadata
+        return {
+            "chunk_id": cid,
+            "filename": ref["filename"],
+            "page": ref["page"],
+            "text": text,
+            "metadata": {k: v for k, v in metadata.items() if k not in ("source", SCORES_KEY, DEGRADED_KEY)},
+        }
+
+    def stats(self):
+        return {
+            "corpus": self.corpus.stats(),
+            "recent": len(self._recent),
+            "recent_bytes": self._recent_bytes,
+            "max_recent_bytes": self.max_recent_bytes,
+        }
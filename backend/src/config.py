@@ -1,3 +1,4 @@
+import json
 import os
 from dotenv import load_dotenv
 
@@ -9,9 +10,107 @@ class Config:
     LLM_MODEL_TYPE = os.getenv("LLM_MODEL_TYPE", "ollama")
     LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME", "qwen2.5:3b")
     EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "nomic-embed-text")
+    # Ollamaにモデルを常駐させておく時間（"30m"、秒数、"-1"で無期限）。リクエストごとに送る
+    OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+    # 起動時にチャットモデルと埋め込みモデルへ短いリクエストを送って読み込ませておく
+    MODEL_WARMUP = os.getenv("MODEL_WARMUP", "true").lower() == "true"
     DATA_RAW_DIR = os.getenv("DATA_RAW_DIR", "data/raw")
     DATA_PROCESSED_DIR = os.getenv("DATA_PROCESSED_DIR", "data/processed")
     CHROMA_DB_DIR = os.getenv("CHROMA_DB_DIR", "data/chroma_db")
+    # チャンク分割方式: "recursive" または "table"（早見表を1行＝1チャンクに分割）
+    # NOTE: 変更した場合は /ingest または main.py --ingest でインデックスを作り直すこと
+    CHUNK_STRATEGY = os.getenv("CHUNK_STRATEGY", "recursive")
+    # 再帰的分割のチャンクの大きさと重なり（文字数）
+    CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1500"))
+    CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "300"))
+    # 検索件数・ハイブリッド検索の重み（ベクトル, BM25）・プロンプトに入れる資料のトークン上限
+    RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "6"))
+    RETRIEVAL_WEIGHTS = [float(w) for w in os.getenv("RETRIEVAL_WEIGHTS", "0.6,0.4").split(",")]
+    MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "4000"))
+    # 適応的な検索深さ: スコアの分布を見て、明確な差があるところや関連度の下限で資料を打ち切る
+    # （関連度の下限を超える資料が1件もなければLLMを呼ばずに「見つからない」と答える）
+    RETRIEVAL_ADAPTIVE = os.getenv("RETRIEVAL_ADAPTIVE", "false").lower() == "true"
+    RETRIEVAL_MIN_RELEVANCE = float(os.getenv("RETRIEVAL_MIN_RELEVANCE", "0.3"))
+    RETRIEVAL_SCORE_GAP = float(os.getenv("RETRIEVAL_SCORE_GAP", "0.1"))
+    RETRIEVAL_BM25_GAP_RATIO = float(os.getenv("RETRIEVAL_BM25_GAP_RATIO", "0.5"))
+    # main.py --tune が書き出す推奨設定。存在すれば上の値を置き換える（環境変数で明示した値が優先）
+    RETRIEVAL_TUNING_FILE = os.getenv("RETRIEVAL_TUNING_FILE", "data/processed/retrieval_tuning.json")
+    # 自治体（data/raw/<市>/）ごとにインデックスを分け、初回利用時に読み込む
+    PARTITION_BY_MUNICIPALITY = os.getenv("PARTITION_BY_MUNICIPALITY", "false").lower() == "true"
+    # 同時にメモリへ常駐させるパーティション数（超えたら最も使われていないものを解放）
+    MAX_RESIDENT_PARTITIONS = int(os.getenv("MAX_RESIDENT_PARTITIONS", "4"))
+    # data/raw を監視し、追加・変更・削除されたファイルだけをバックグラウンドで取り込み直す
+    WATCH_RAW_DIR = os.getenv("WATCH_RAW_DIR", "false").lower() == "true"
+    # 変更が途切れてから取り込みを始めるまでの秒数（PDFのコピー中に読み込まないように）
+    WATCH_DEBOUNCE_SEC = float(os.getenv("WATCH_DEBOUNCE_SEC", "5"))
+    # OSの変更通知が使えない環境では、この間隔(秒)でディレクトリを走査する
+    WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "5"))
+    # Docker Desktop のバインドマウントなど、通知が届かない環境では true にする
+    WATCH_FORCE_POLLING = os.getenv("WATCH_FORCE_POLLING", "false").lower() == "true"
+    # POST /documents でのアップロード: 認証トークン（未設定ならアップロードは無効）と1ファイルの上限バイト数
+    UPLOAD_TOKEN = os.getenv("UPLOAD_TOKEN", "")
+    UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+    # SSEストリーミング: トークンをまとめて送出する時間窓(ms)と最大文字数
+    STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "30"))
+    STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "256"))
+    # ハイブリッド検索: レッグごとのタイムアウト(秒)
+    RETRIEVAL_VECTOR_TIMEOUT = float(os.getenv("RETRIEVAL_VECTOR_TIMEOUT", "5"))
+    RETRIEVAL_BM25_TIMEOUT = float(os.getenv("RETRIEVAL_BM25_TIMEOUT", "2"))
+    # 埋め込みAPIへの1回のHTTPリクエストのタイムアウト(秒)。タイムアウトした検索レッグのスレッドもこれで終わる
+    EMBEDDING_REQUEST_TIMEOUT = float(os.getenv("EMBEDDING_REQUEST_TIMEOUT", "60"))
+    # 予備のLLMバックエンド（"種別:モデル名[@URL]" をカンマ区切り。例: "openai:gpt-4o-mini"）
+    LLM_FALLBACKS = os.getenv("LLM_FALLBACKS", "")
+    # 最初のトークンがこの秒数で来なければ次のバックエンドにもヘッジする。どれも来なければ LLM_FIRST_TOKEN_TIMEOUT で諦める
+    LLM_TTFT_DEADLINE = float(os.getenv("LLM_TTFT_DEADLINE", "15"))
+    LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", "120"))
+    # LLMサーバーへの1回の通信（接続・応答の読み取り）を待つ上限の秒数
+    LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "120"))
+    # 連続で失敗（エラー・締め切り超過）したらしばらくそのバックエンドを使わない
+    LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+    LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+    # 受付制御: バックエンドごとの同時生成数、待ち行列の上限、最大待ち時間(秒)
+    LLM_MAX_CONCURRENCY_OLLAMA = int(os.getenv("LLM_MAX_CONCURRENCY_OLLAMA", "2"))
+    LLM_MAX_CONCURRENCY_OPENAI = int(os.getenv("LLM_MAX_CONCURRENCY_OPENAI", "8"))
+    LLM_QUEUE_MAX_DEPTH = int(os.getenv("LLM_QUEUE_MAX_DEPTH", "32"))
+    LLM_QUEUE_MAX_WAIT = float(os.getenv("LLM_QUEUE_MAX_WAIT", "30"))
+    # POST /query/batch: 1リクエストの質問数の上限と同時生成数（受付制御ではバッチの優先度で待つ）
+    BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "200"))
+    BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "2"))
+    # 会話履歴: プロンプトに残す直近メッセージ数とトークン予算、要約の最大文字数
+    HISTORY_RECENT_TURNS = int(os.getenv("HISTORY_RECENT_TURNS", "4"))
+    HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "600"))
+    HISTORY_SUMMARY_MAX_CHARS = int(os.getenv("HISTORY_SUMMARY_MAX_CHARS", "400"))
+    # サーバー側で保持する会話の数と保持期間(秒)
+    CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "1000"))
+    CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", "21600"))
+    # 画像入力: デコード後の上限バイト数、縮小後の長辺(px)、JPEG品質、キャッシュ件数
+    IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(8 * 1024 * 1024)))
+    IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+    IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+    IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "64"))
+    # /query 系リクエストボディの上限（base64画像を含む）
+    REQUEST_MAX_BODY_BYTES = int(os.getenv("REQUEST_MAX_BODY_BYTES", str(12 * 1024 * 1024)))
+    # リクエストのトレース: 有効にすると遅いリクエストのスパンツリーをJSONLに追記する
+    TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+    TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+    TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE", "data/traces/slow_traces.jsonl")
+    # X-Profile: 1 ヘッダーで1リクエストだけ cProfile を取ることを許可する（本番では無効のままに）
+    TRACE_ALLOW_PROFILE = os.getenv("TRACE_ALLOW_PROFILE", "false").lower() == "true"
+    # 回答キャッシュ（画像・会話履歴なしの質問のみ対象）
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "256"))
+    ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "3600"))
+    # 検索結果のキャッシュ（履歴付き・画像付きなど回答キャッシュの対象外でも効く）。TTLは回答キャッシュと同じ
+    RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "512"))
+    # コーパスに無いチャンク（パーティション・古いベクトルDBのもの）を本文ごと覚えておく上限のバイト数（概算）
+    CHUNK_RECENT_MAX_BYTES = int(os.getenv("CHUNK_RECENT_MAX_BYTES", str(32 * 1024 * 1024)))
+    # 質問ログ: 正規化した質問・自治体・応答時間だけを追記する（画像・位置情報・会話履歴は記録しない）
+    QUERY_LOG_ENABLED = os.getenv("QUERY_LOG_ENABLED", "false").lower() == "true"
+    QUERY_LOG_FILE = os.getenv("QUERY_LOG_FILE", "data/logs/queries.jsonl")
+    QUERY_LOG_MAX_BYTES = int(os.getenv("QUERY_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+    # 起動時と /ingest の後に、直近 CACHE_WARM_WINDOW_DAYS 日でよく聞かれた上位N件を生成してキャッシュしておく（0で無効）
+    CACHE_WARM_TOP_N = int(os.getenv("CACHE_WARM_TOP_N", "20"))
+    CACHE_WARM_WINDOW_DAYS = float(os.getenv("CACHE_WARM_WINDOW_DAYS", "7"))
 
     def to_dict(self):
         """設定を辞書として返す（APIキーは除外）"""
@@ -22,3 +121,57 @@ class Config:
             "ollama_base_url": self.OLLAMA_BASE_URL,
             "has_openai_key": bool(self.OPENAI_API_KEY and self.OPENAI_API_KEY != "none"),
         }
+
+
+# チューニング結果のキー -> (Config の属性名, 型)
+TUNABLE_PARAMS = {
+    "chunk_strategy": ("CHUNK_STRATEGY", str),
+    "chunk_size": ("CHUNK_SIZE", int),
+    "chunk_overlap": ("CHUNK_OVERLAP", int),
+    "k": ("RETRIEVAL_K", int),
+    "weights": ("RETRIEVAL_WEIGHTS", lambda value: [float(w) for w in value]),
+    "max_context_tokens": ("MAX_CONTEXT_TOKENS", int),
+}
+
+def llm_settings(override_config=None, config=Config):
+    """リクエストのモデル設定（PWAの type/name/address/temp）をサーバーの既定値で補い、実際に使う設定を返す"""
+    override = override_config or {}
+    model_type = override.get("type") or config.LLM_MODEL_TYPE
+    settings = {
+        "type": model_type,
+        "name": override.get("name") or config.LLM_MODEL_NAME,
+        "openai_api_key": config.OPENAI_API_KEY,
+        "ollama_base_url": config.OLLAMA_BASE_URL,
+        "temperature": 0.3,
+    }
+    address = override.get("address", "")
+    if address:
+        if model_type == "openai":
+            settings["openai_api_key"] = address
+        else:
+            settings["ollama_base_url"] = address
+    try:
+        settings["temperature"] = float(override.get("temp", 0.3))
+    except (ValueError, TypeError):
+        pass
+    return settings
+
+def apply_retrieval_tuning(config_cls=Config, path=None):
+    """チューニング結果の推奨設定を Config に反映する。環境変数で指定された項目はそのまま"""
+    path = path or config_cls.RETRIEVAL_TUNING_FILE
+    if not path or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            recommended = json.load(f)["recommended"]
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not load retrieval tuning from {path}: {e}")
+        return {}
+    applied = {}
+    for key, (attr, cast) in TUNABLE_PARAMS.items():
+        if key in recommended and os.getenv(attr) is None:
+            setattr(config_cls, attr, cast(recommended[key]))
+            applied[key] = recommended[key]
+    return applied
+
+apply_retrieval_tuning()
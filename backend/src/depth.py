@@ -0,0 +1,64 @@
+from .chunks import DEGRADED_KEY, SCORES_KEY
+
+# 打ち切った理由
+STOP_GAP = "gap"
+STOP_MIN_RELEVANCE = "min_relevance"
+STOP_EXHAUSTED = "exhausted"
+
+
+def _cut(ranked, is_relevant, is_gap):
+    """スコアの降順リストを先頭から見て、関連度の下限か明確な差のところで打ち切る。(残す件数, 理由) を返す"""
+    for i, score in enumerate(ranked):
+        if not is_relevant(score):
+            return i, STOP_MIN_RELEVANCE
+        if i > 0 and is_gap(ranked[i - 1], score):
+            return i, STOP_GAP
+    return len(ranked), STOP_EXHAUSTED
+
+
+def degraded_legs(docs):
+    """検索でタイムアウト・失敗したレッグの名前（無ければ空のリスト）"""
+    return sorted({name for doc in docs for name in doc.metadata.get(DEGRADED_KEY, ())})
+
+
+def select_depth(docs, min_relevance=0.3, score_gap=0.1, bm25_gap_ratio=0.5):
+    """検索スコアの分布から、プロンプトに入れるドキュメントの数を決める。
+
+    ベクトル検索とBM25のスコアは尺度が違うので、レッグごとに打ち切ってから和集合を取る。
+    - ベクトル: 関連度が min_relevance 未満、または直前との差が score_gap 以上になったところまで
+    - BM25: スコア0（質問の語を含まない）、または直前の bm25_gap_ratio 倍を下回ったところまで
+    どちらのレッグでも残らなければ空のリスト（資料に関連する情報なし）を返す。
+    並び順はRRFの統合順のまま。(選んだドキュメント, 判定の詳細) を返す。
+    """
+    info = {"mode": "adaptive", "candidates": len(docs)}
+    scores = [doc.metadata.get(SCORES_KEY) or {} for doc in docs]
+    if not any(scores):
+        # スコアを返さないリトリーバー（ベクトル検索のみのパーティションなど）では判定しない
+        info.update(depth=len(docs), reason="no_scores")
+        return docs, info
+    degraded = degraded_legs(docs)
+    if degraded:
+        # 片方のレッグしか無いとスコアが偏る（BM25は0ばかりのことも多い）ので、打ち切らずに固定のkで返す
+        info.update(depth=len(docs), reason="degraded", degraded=degraded)
+        return docs, info
+
+    keep = set()
+    legs = {
+        "vector": (lambda s: s >= min_relevance, lambda prev, s: prev - s >= score_gap),
+        "bm25": (lambda s: s > 0, lambda prev, s: s < prev * bm25_gap_ratio),
+    }
+    for name, (is_relevant, is_gap) in legs.items():
+        ranked = sorted(
+            ((s[name], i) for i, s in enumerate(scores) if s.get(name) is not None),
+            reverse=True
+        )
+        if not ranked:
+            continue
+        count, stop = _cut([score for score, _ in ranked], is_relevant, is_gap)
+        keep.update(i for _, i in ranked[:count])
+        info[name] = {"kept": count, "top": ranked[0][0], "stop": stop}
+
+    selected = [doc for i, doc in enumerate(docs) if i in keep]
+    info["depth"] = len(selected)
+    info["reason"] = "no_relevant_context" if not selected else "score_distribution"
+    return selected, info
@@ -0,0 +1,141 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .watcher import WATCHED_EXTENSIONS
+
+# 保持するアップロードのジョブ数（古いものから忘れる）
+MAX_JOBS = 200
+
+JOB_INDEXING = "indexing"
+JOB_DONE = "done"
+JOB_UNCHANGED = "unchanged"
+JOB_ERROR = "error"
+
+
+class UploadRejected(Exception):
+    """アップロードを受け付けられないことを表す（HTTPのステータスに変換される）"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _is_plain_name(name):
+    """パスの区切りや隠しファイル・親ディレクトリを含まない1つの名前か"""
+    return bool(name) and name == os.path.basename(name) and "\\" not in name and not name.startswith(".")
+
+
+def resolve_upload_path(raw_dir, filename, municipality=None):
+    """アップロード先のパス（data/raw/<自治体>/<ファイル名>）を検証して返す"""
+    if not _is_plain_name(filename):
+        raise UploadRejected(400, "ファイル名が不正です。")
+    if not filename.lower().endswith(WATCHED_EXTENSIONS):
+        raise UploadRejected(415, "PDFまたはTXTファイルのみアップロードできます。")
+    if municipality and not _is_plain_name(municipality):
+        raise UploadRejected(400, "自治体名が不正です。")
+    return os.path.join(raw_dir, municipality, filename) if municipality else os.path.join(raw_dir, filename)
+
+
+def file_sha256(path):
+    """ファイルのSHA-256。無ければ None"""
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def list_raw_files(raw_dir, extensions=(".pdf",)):
+    """data/raw 以下（サブフォルダを含む）のファイルを、"/" 区切りの相対パスで返す"""
+    files = []
+    for dirpath, dirnames, filenames in os.walk(raw_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for filename in sorted(filenames):
+            if filename.startswith(".") or not filename.lower().endswith(extensions):
+                continue
+            relative = os.path.relpath(os.path.join(dirpath, filename), raw_dir)
+            files.append(relative.replace(os.sep, "/"))
+    return files
+
+
+def find_raw_file(raw_dir, name, extensions=(".pdf",)):
+    """相対パスまたはファイル名から data/raw 内のファイルを探す。外を指すパスや見つからなければ None
+
+    回答のソースにはファイル名しか載らないので、サブフォルダ内のファイルもファイル名だけで引けるようにする。
+    """
+    root = os.path.realpath(raw_dir)
+    parts = name.replace("\\", "/").split("/")
+    if not name.lower().endswith(extensions) or any(part in ("", ".", "..") for part in parts):
+        return None
+    path = os.path.realpath(os.path.join(root, *parts))
+    if os.path.commonpath([root, path]) == root and os.path.isfile(path):
+        return path
+    if len(parts) == 1:
+        for relative in list_raw_files(raw_dir, extensions):
+            if relative.rsplit("/", 1)[-1] == name:
+                return os.path.join(root, *relative.split("/"))
+    return None
+
+
+class UploadJobs:
+    """アップロードしたファイルの取り込み状況（GET /documents/{id} で返す）"""
+
+    def __init__(self, max_jobs=MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+
+    def create(self, path, sha256, size, status=JOB_INDEXING):
+        now = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": status,
+            "path": path,
+            "sha256": sha256,
+            "bytes": size,
+            "created_at": now,
+            "finished_at": None if status == JOB_INDEXING else now,
+            "result": None,
+            "error": None,
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+        return dict(job)
+
+    def finish(self, job_id, result=None, error=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(
+                status=JOB_ERROR if error else JOB_DONE,
+                result=result,
+                error=error,
+                finished_at=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            )
+            if error:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def stats(self):
+        with self._lock:
+            indexing = sum(1 for job in self._jobs.values() if job["status"] == JOB_INDEXING)
+        return {"jobs": len(self._jobs), "indexing": indexing, "completed": self.completed, "failed": self.failed}
@@ -79,7 +79,10 @@ class RAGEvaluator:
             eval_score = self.evaluate_response(
                 query=query,
                 answer=rag_result["answer"],
-                contexts=rag_result["source_documents"]
+                contexts=[
+                    rag_generator.chunk_store.get(source["chunk_id"])["text"]
+                    for source in rag_result["sources"]
+                ]
             )
             
             results.append({
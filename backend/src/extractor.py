@@ -2,8 +2,6 @@ import json
 import os
 from typing import List, Dict
 from pydantic import BaseModel, Field
-from langchain_openai import ChatOpenAI
-from langchain_ollama import ChatOllama
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 from .config import Config
@@ -24,13 +22,16 @@ class DataExtractor:
         self.parser = PydanticOutputParser(pydantic_object=StructuredDataList)
 
     def _get_llm(self):
+        # 使用するバックエンドのクライアントだけをインポートする
         if self.config.LLM_MODEL_TYPE == "openai":
+            from langchain_openai import ChatOpenAI
             return ChatOpenAI(
                 model_name=self.config.LLM_MODEL_NAME,
                 openai_api_key=self.config.OPENAI_API_KEY,
                 temperature=0
             )
         else:
+            from langchain_ollama import ChatOllama
             return ChatOllama(
                 model=self.config.LLM_MODEL_NAME,
                 base_url=self.config.OLLAMA_BASE_URL,
@@ -1,127 +1,156 @@
-from langchain_openai import ChatOpenAI
-from langchain_ollama import ChatOllama
-from langchain_core.prompts import ChatPromptTemplate, SystemMessagePromptTemplate, HumanMessagePromptTemplate
-from langchain_core.messages import SystemMessage, HumanMessage
-from .config import Config
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
+from .config import Config, llm_settings
+from .tokens import estimate_tokens
+from .history import clean_messages, compact_history, rewrite_retrieval_query
+from .warmup import TTFTTracker, keep_alive_seconds, model_key, parse_keep_alive
+from .tracing import annotate, span
+from .router import BackendRouter, parse_backend_specs
+from .admission import backend_key
+from .chunks import ChunkStore
+from .cache import TTLCache, normalize_prompt
+from .depth import degraded_legs, select_depth
+import json
 import os
-import re
+import time
+
+# システムプロンプトは常に同一のバイト列にしておく（バックエンドのプレフィックスキャッシュに載せるため）
+SYSTEM_PROMPT = """あなたは自治体のごみ分別案内アシスタントです。提供された資料に基づいて、住民の質問に正確かつ簡潔に答えてください。
+
+## ルール
+- 回答は提供された【資料】の情報のみに基づくこと。外部知識は使わない。
+- 資料に答えがない場合は「資料に記載がありません」と正直に答える。推測しない。
+- 複数の資料から関連情報がある場合は統合して説明する。
+- 会話履歴がある場合は前の文脈を踏まえて答える。
+
+## 回答のフォーマット
+- 簡単な質問には1〜3文で簡潔に答える。長い前置きは不要。
+- 見出し（##）は複数のトピックを扱う場合のみ使用する。
+- 箇条書きは3項目以上の列挙がある場合のみ使う。 
+- 段落間に余計な空行を入れない。
+- 「以下に説明します」「まとめると」などの冗長な導入文は省く。
+
+## トーン
+市役所の窓口で丁寧に説明するような自然な日本語で答えてください。堅すぎず、カジュアルすぎない口調を心がけてください。"""
+
+# 関連する資料が見つからなかったときの回答（LLMは呼ばない）
+NO_CONTEXT_ANSWER = "申し訳ありませんが、提供された資料の中に、その質問に関連する情報は見つかりませんでした。"
+
+def build_context(docs, max_context_tokens):
+    """資料ブロックを組み立てる。(整形済みテキスト, 実際に含めたドキュメント) を返す"""
+    formatted_text = ""
+    current_tokens = 0
+    used_docs = []
+    for i, doc in enumerate(docs):
+        source = os.path.basename(doc.metadata.get("source", "Unknown"))
+        page = doc.metadata.get("page", "")
+        page_info = f" (Page {page})" if page else ""
+        block = f"---\n[Source {i+1}: {source}{page_info}]\n{doc.page_content}\n"
+        block_tokens = estimate_tokens(block)
+        if current_tokens + block_tokens > max_context_tokens and formatted_text:
+            break
+        formatted_text += block
+        current_tokens += block_tokens
+        used_docs.append(doc)
+    return formatted_text, used_docs
+
 
 class RAGGenerator:
-    def __init__(self, vectorstore=None, retriever=None):
+    def __init__(self, vectorstore=None, retriever=None, ttft_tracker=None, chunk_store=None, retrieval_cache=None,
+                 router=None):
         self.config = Config()
         self.vectorstore = vectorstore
         self.llm = self._get_llm()
+        # 主のバックエンドが詰まったときに使う予備（LLM_FALLBACKS の順）
+        fallback_specs = parse_backend_specs(self.config.LLM_FALLBACKS)
+        self.fallback_llms = [self._get_llm(spec) for spec in fallback_specs]
+        # 予備は呼び出すときに受付枠を取る（主のバックエンドの枠はリクエストを受け付けたときに取得済み）
+        self.fallback_backends = [(backend_key(spec["type"], spec["address"]), spec["type"]) for spec in fallback_specs]
+        # 最初のトークンの締め切りとサーキットブレーカー（再インジェストをまたいで状態を共有できる）
+        self.router = router or BackendRouter(
+            ttft_deadline=self.config.LLM_TTFT_DEADLINE,
+            first_token_timeout=self.config.LLM_FIRST_TOKEN_TIMEOUT,
+            failure_threshold=self.config.LLM_BREAKER_FAILURES,
+            cooldown_sec=self.config.LLM_BREAKER_COOLDOWN
+        )
+        # 回答には本文ではなくチャンクIDとスニペットを載せる（本文は /chunks/{id} で取得）
+        self.chunk_store = chunk_store or ChunkStore(max_recent_bytes=self.config.CHUNK_RECENT_MAX_BYTES)
+        # 検索結果のキャッシュ（インジェストで検索が差し替わったら呼び出し側でクリアする）
+        self.retrieval_cache = retrieval_cache if retrieval_cache is not None else TTLCache(
+            max_entries=self.config.RETRIEVAL_CACHE_SIZE, ttl_sec=self.config.ANSWER_CACHE_TTL
+        )
+        # 再インジェストで作り直されても計測が途切れないよう、呼び出し側から共有できる
+        self.ttft = ttft_tracker or TTFTTracker(keep_alive_seconds(self.config.OLLAMA_KEEP_ALIVE))
         
         if retriever:
             self.retriever = retriever
         elif vectorstore:
-            self.retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
+            self.retriever = vectorstore.as_retriever(search_kwargs={"k": self.config.RETRIEVAL_K})
         else:
             raise ValueError("Either vectorstore or retriever must be provided.")
 
     def _get_llm(self, override_config=None):
         """LLMインスタンスを取得する"""
-        model_type = self.config.LLM_MODEL_TYPE
-        model_name = self.config.LLM_MODEL_NAME
-        openai_api_key = self.config.OPENAI_API_KEY
-        ollama_base_url = self.config.OLLAMA_BASE_URL
-        temperature = 0.3
-
-        if override_config:
-            model_type = override_config.get("type", model_type)
-            model_name = override_config.get("name", model_name)
-            address = override_config.get("address", "")
-            if address:
-                if model_type == "openai":
-                    openai_api_key = address
-                else:
-                    ollama_base_url = address
-            try:
-                temperature = float(override_config.get("temp", 0.3))
-            except (ValueError, TypeError):
-                temperature = 0.3
+        settings = llm_settings(override_config, self.config)
 
-        if model_type == "openai":
+        # 使用するバックエンドのクライアントだけをインポートする（起動時間短縮）
+        if settings["type"] == "openai":
+            from langchain_openai import ChatOpenAI
             return ChatOpenAI(
-                model_name=model_name,
-                openai_api_key=openai_api_key,
-                temperature=temperature
+                model_name=settings["name"],
+                openai_api_key=settings["openai_api_key"],
+                temperature=settings["temperature"],
+                request_timeout=self.config.LLM_REQUEST_TIMEOUT
             )
         else:
+            from langchain_ollama import ChatOllama
             return ChatOllama(
-                model=model_name,
-                base_url=ollama_base_url,
-                temperature=temperature,
-                num_ctx=8192
+                model=settings["name"],
+                base_url=settings["ollama_base_url"],
+                temperature=settings["temperature"],
+                num_ctx=8192,
+                keep_alive=parse_keep_alive(self.config.OLLAMA_KEEP_ALIVE),
+                # 応答しないサーバーを待ち続けない（打ち切ったヘッジの呼び出しのスレッドと受付枠を解放する）
+                client_kwargs={"timeout": self.config.LLM_REQUEST_TIMEOUT}
             )
 
     @staticmethod
     def _estimate_tokens(text):
         """Rough token count: ~1.5 chars per token for Japanese, ~4 chars for ASCII."""
-        ja_chars = len(re.findall(r'[\u3000-\u9fff\uf900-\ufaff]', text))
-        ascii_chars = len(text) - ja_chars
-        return int(ja_chars / 1.5 + ascii_chars / 4)
+        return estimate_tokens(text)
 
     def _format_docs_with_metadata(self, docs, max_context_tokens=None):
         """ドキュメントをメタデータ付きで整形する。max_context_tokensを超えたら打ち切る。"""
         if max_context_tokens is None:
-            max_context_tokens = 4000
-        formatted_text = ""
-        current_tokens = 0
-        for i, doc in enumerate(docs):
-            source = os.path.basename(doc.metadata.get("source", "Unknown"))
-            page = doc.metadata.get("page", "")
-            page_info = f" (Page {page})" if page else ""
-            block = f"---\n[Source {i+1}: {source}{page_info}]\n{doc.page_content}\n"
-            block_tokens = self._estimate_tokens(block)
-            if current_tokens + block_tokens > max_context_tokens and formatted_text:
-                break
-            formatted_text += block
-            current_tokens += block_tokens
-        return formatted_text
+            max_context_tokens = self.config.MAX_CONTEXT_TOKENS
+        return build_context(docs, max_context_tokens)[0]
 
     def _build_system_prompt(self):
         """システムプロンプトを構築する"""
-        return """あなたは自治体のごみ分別案内アシスタントです。提供された資料に基づいて、住民の質問に正確かつ簡潔に答えてください。
-
-## ルール
-- 回答は提供された【資料】の情報のみに基づくこと。外部知識は使わない。
-- 資料に答えがない場合は「資料に記載がありません」と正直に答える。推測しない。
-- 複数の資料から関連情報がある場合は統合して説明する。
-- 会話履歴がある場合は前の文脈を踏まえて答える。
-
-## 回答のフォーマット
-- 簡単な質問には1〜3文で簡潔に答える。長い前置きは不要。
-- 見出し（##）は複数のトピックを扱う場合のみ使用する。
-- 箇条書きは3項目以上の列挙がある場合のみ使う。 
-- 段落間に余計な空行を入れない。
-- 「以下に説明します」「まとめると」などの冗長な導入文は省く。
-
-## トーン
-市役所の窓口で丁寧に説明するような自然な日本語で答えてください。堅すぎず、カジュアルすぎない口調を心がけてください。"""
+        return SYSTEM_PROMPT
 
     def _build_messages(self, query, context_text, chat_history=None, image_data=None):
-        """プロンプトメッセージを構築する"""
+        """プロンプトメッセージを構築する。
+
+        変化しにくいものから順に並べる（システムプロンプト → 会話履歴 → 毎回変わる資料と質問）。
+        前回のリクエストと先頭が一致する分だけ、バックエンドのKV/プレフィックスキャッシュが効く。
+        """
         messages = [SystemMessage(content=self._build_system_prompt())]
 
-        # 会話履歴を含める
+        # 会話履歴は「要約＋直近の数ターン」だけを含める
         if chat_history:
-            for msg in chat_history[-10:]:  # 最新10件まで
-                role = msg.get("role", "")
-                text = msg.get("text", "")
-                if not text:
-                    continue
-                if role == "user":
-                    messages.append(HumanMessage(content=text))
-                elif role == "system":
-                    from langchain_core.messages import AIMessage
-                    messages.append(AIMessage(content=text))
+            for msg in chat_history["turns"]:
+                if msg["role"] == "user":
+                    messages.append(HumanMessage(content=msg["text"]))
+                else:
+                    messages.append(AIMessage(content=msg["text"]))
 
         image_note = "画像も提供されています。内容を考慮して回答してください。\n\n" if image_data else ""
-        human_text = f"""{image_note}【資料】
+        summary = chat_history["summary"] if chat_history else ""
+        summary_note = f"【これまでの会話の要約】\n{summary}\n\n" if summary else ""
+        human_text = f"""{summary_note}【資料】
 {context_text}
 
-【質問】
+{image_note}【質問】
 {query}"""
 
         if image_data:
@@ -135,8 +164,134 @@ class RAGGenerator:
 
         return messages
 
-    def get_answer(self, query, config_override=None, image_data=None, chat_history=None):
-        """質問に対してNotebookLMスタイルの深い回答を生成する"""
+    def _backends(self, primary_llm):
+        """優先順のバックエンド（リクエストで指定されたモデル、続いて LLM_FALLBACKS）"""
+        return [primary_llm] + self.fallback_llms
+
+    def _admission_backends(self):
+        """_backends と同じ順の受付制御のバックエンド（主はリクエストが取得済みなので None）"""
+        return [None] + self.fallback_backends
+
+    def _find_embeddings(self):
+        """リトリーバーが使っている埋め込みクライアントを探す"""
+        vectorstore = getattr(self.retriever, "vectorstore", None) or self.vectorstore
+        if vectorstore is not None:
+            return getattr(vectorstore, "embeddings", None)
+        partition_manager = getattr(self.retriever, "partition_manager", None)
+        if partition_manager is not None:
+            return partition_manager.get_embeddings()
+        return None
+
+    def _accepts_query_vector(self):
+        """埋め込み済みのベクトルで検索できるリトリーバーか（ハイブリッド検索・パーティション）"""
+        return hasattr(self.retriever, "weights") or hasattr(self.retriever, "partition_manager")
+
+    def embed_queries(self, queries):
+        """複数の質問を1回の呼び出しでまとめて埋め込む。使えなければ None（検索時に1件ずつ埋め込む）"""
+        embeddings = self._find_embeddings()
+        if embeddings is None or not queries or not self._accepts_query_vector():
+            return None
+        with span("embedding.batch", queries=len(queries)):
+            return embeddings.embed_documents(list(queries))
+
+    def warm_up(self):
+        """埋め込みモデルとチャットモデルに短いリクエストを送って読み込ませる（ブロッキング）"""
+        timings = {}
+        embeddings = self._find_embeddings()
+        if embeddings is not None:
+            started = time.monotonic()
+            try:
+                embeddings.embed_query("ウォームアップ")
+                timings["embedding_sec"] = round(time.monotonic() - started, 2)
+            except Exception as e:
+                print(f"Embedding warm-up failed: {e}")
+
+        # OpenAIは読み込み待ちがなく、呼ぶと課金されるのでOllamaのときだけ行う
+        if self.config.LLM_MODEL_TYPE != "openai":
+            started = time.monotonic()
+            try:
+                # 本番と同じシステムプロンプト・num_ctx で送る（オプションが変わるとモデルが読み込み直される）
+                self.llm.model_copy(update={"num_predict": 1}).invoke([
+                    SystemMessage(content=self._build_system_prompt()),
+                    HumanMessage(content="こんにちは")
+                ])
+                timings["chat_sec"] = round(time.monotonic() - started, 2)
+                self.ttft.mark_warm(model_key(self.llm))
+            except Exception as e:
+                print(f"Chat model warm-up failed: {e}")
+        return timings
+
+    def _prepare_history(self, query, chat_history):
+        """会話履歴を圧縮済みの形式 {"summary", "turns"} にそろえる"""
+        if not chat_history:
+            return None
+        if isinstance(chat_history, dict):
+            return chat_history
+        # 旧形式（メッセージのリスト）はその場で圧縮する
+        return compact_history(
+            clean_messages(chat_history, query),
+            recent_turns=self.config.HISTORY_RECENT_TURNS,
+            max_tokens=self.config.HISTORY_MAX_TOKENS,
+            summary_max_chars=self.config.HISTORY_SUMMARY_MAX_CHARS
+        )
+
+    def _retrieve(self, query, chat_history=None, retrieval_options=None, query_vector=None):
+        """関連ドキュメントを検索する。retrieval_options で k と重みを上書きできる"""
+        kwargs = {}
+        if retrieval_options:
+            if retrieval_options.get("k"):
+                kwargs["k"] = retrieval_options["k"]
+            # 重みはハイブリッド検索のときだけ意味を持つ
+            if retrieval_options.get("weights") and (
+                hasattr(self.retriever, "weights") or hasattr(self.retriever, "partition_manager")
+            ):
+                kwargs["weights"] = retrieval_options["weights"]
+            # 自治体の指定はパーティション分割時だけ意味を持つ
+            if retrieval_options.get("municipality") and hasattr(self.retriever, "partition_manager"):
+                kwargs["municipality"] = retrieval_options["municipality"]
+        retrieval_query = rewrite_retrieval_query(query, chat_history)
+        cache_key = json.dumps([normalize_prompt(retrieval_query), kwargs], ensure_ascii=False, sort_keys=True)
+        with span("retrieval", **kwargs):
+            # キャッシュにはチャンクIDとスコアだけを持ち、本文はチャンクストアから引き直す
+            cached = self.retrieval_cache.get(cache_key)
+            docs = self.chunk_store.resolve(cached) if cached is not None else None
+            annotate(cache_hit=docs is not None)
+            if docs is None:
+                # 埋め込み済みのベクトルは履歴で書き換えていない質問のものなので、そのときだけ使う
+                if query_vector is not None and retrieval_query == query and self._accepts_query_vector():
+                    docs = self.retriever.invoke(retrieval_query, query_vector=query_vector, **kwargs)
+                else:
+                    docs = self.retriever.invoke(retrieval_query, **kwargs)
+                # 一時的にレッグが失敗した結果は、キャッシュに残さない
+                if not degraded_legs(docs):
+                    self.retrieval_cache.set(cache_key, self.chunk_store.cache_entry(docs))
+            annotate(docs=len(docs))
+            return docs
+
+    def _select_depth(self, docs, retrieval_options=None):
+        """適応モードなら検索スコアの分布で資料の数を絞る。(ドキュメント, 応答に載せる検索の情報) を返す"""
+        adaptive = self.config.RETRIEVAL_ADAPTIVE
+        if retrieval_options and retrieval_options.get("adaptive") is not None:
+            adaptive = retrieval_options["adaptive"]
+        if not adaptive or not docs:
+            info = {"mode": "fixed", "candidates": len(docs), "depth": len(docs)}
+            degraded = degraded_legs(docs)
+            if degraded:
+                info["degraded"] = degraded
+            return docs, info
+        with span("depth"):
+            selected, info = select_depth(
+                docs,
+                min_relevance=self.config.RETRIEVAL_MIN_RELEVANCE,
+                score_gap=self.config.RETRIEVAL_SCORE_GAP,
+                bm25_gap_ratio=self.config.RETRIEVAL_BM25_GAP_RATIO
+            )
+            annotate(candidates=info["candidates"], depth=info["depth"], reason=info["reason"])
+        return selected, info
+
+    def get_answer(self, query, config_override=None, image_data=None, chat_history=None, retrieval_options=None,
+                   query_vector=None):
+        """質問に対してNotebookLMスタイルの深い回答を生成する（query_vector は embed_queries の結果）"""
         
         # LLMの準備 (オーバーライドがあれば一時的なLLMを作成)
         current_llm = self.llm
@@ -146,36 +301,52 @@ class RAGGenerator:
             except Exception as e:
                 print(f"Error creating override LLM, falling back to default: {e}")
 
-        # 関連ドキュメントの検索
-        source_docs = self.retriever.invoke(query)
+        # 関連ドキュメントの検索（フォローアップ質問は履歴で検索クエリを補完する）
+        chat_history = self._prepare_history(query, chat_history)
+        source_docs = self._retrieve(query, chat_history, retrieval_options, query_vector)
+        # 決定的な一致があれば少ない資料で答える（関連度が低すぎればLLMを呼ばない）
+        source_docs, retrieval_info = self._select_depth(source_docs, retrieval_options)
         
         if not source_docs:
             return {
-                "answer": "申し訳ありませんが、提供された資料の中に、その質問に関連する情報は見つかりませんでした。",
-                "source_documents": [],
-                "metadata": []
+                "answer": NO_CONTEXT_ANSWER,
+                "sources": [],
+                "retrieval": retrieval_info
             }
 
-        # コンテキストの整形 (ソース情報を明示)
-        context_text = self._format_docs_with_metadata(source_docs)
+        # コンテキストの整形 (ソース情報を明示) とメッセージの構築
+        with span("packing"):
+            context_text = self._format_docs_with_metadata(source_docs)
+            messages = self._build_messages(query, context_text, chat_history, image_data)
+            annotate(context_tokens=self._estimate_tokens(context_text))
 
-        # メッセージの構築
-        messages = self._build_messages(query, context_text, chat_history, image_data)
-
-        # 回答の生成
+        # 回答の生成（主のバックエンドが締め切りまでに応答しなければ予備にもヘッジする）
+        error = None
+        key = model_key(current_llm)
+        started = time.monotonic()
         try:
-            response = current_llm.invoke(messages)
-            content = response.content
+            with span("llm", model=key):
+                stream = self.router.stream(self._backends(current_llm), messages, self._admission_backends())
+                try:
+                    parts = list(stream)
+                finally:
+                    stream.close()
+                annotate(backend=stream.backend, hedged=stream.hedged)
+            content = "".join(parts)
+            self.ttft.record(stream.backend, time.monotonic() - started, self.ttft.is_cold(stream.backend),
+                             kind="invoke")
         except Exception as e:
-            content = f"エラーが発生しました: {str(e)}"
+            error = str(e)
+            content = f"エラーが発生しました: {error}"
 
         return {
             "answer": content,
-            "source_documents": [doc.page_content for doc in source_docs],
-            "metadata": [doc.metadata for doc in source_docs]
+            "sources": self.chunk_store.refs(source_docs),
+            "retrieval": retrieval_info,
+            "error": error
         }
 
-    def get_answer_stream(self, query, config_override=None, image_data=None, chat_history=None):
+    def get_answer_stream(self, query, config_override=None, image_data=None, chat_history=None, retrieval_options=None):
         """ストリーミングで回答を生成するジェネレータ"""
         
         current_llm = self.llm
@@ -185,38 +356,56 @@ class RAGGenerator:
             except Exception as e:
                 print(f"Error creating override LLM, falling back to default: {e}")
 
-        # 関連ドキュメントの検索
-        source_docs = self.retriever.invoke(query)
+        # 関連ドキュメントの検索（フォローアップ質問は履歴で検索クエリを補完する）
+        chat_history = self._prepare_history(query, chat_history)
+        source_docs = self._retrieve(query, chat_history, retrieval_options)
+        source_docs, retrieval_info = self._select_depth(source_docs, retrieval_options)
         
         if not source_docs:
             yield {
                 "type": "complete",
-                "answer": "申し訳ありませんが、提供された資料の中に、その質問に関連する情報は見つかりませんでした。",
-                "source_documents": [],
-                "metadata": []
+                "answer": NO_CONTEXT_ANSWER,
+                "sources": [],
+                "retrieval": retrieval_info
             }
             return
 
-        context_text = self._format_docs_with_metadata(source_docs)
-        messages = self._build_messages(query, context_text, chat_history, image_data)
-
-        # ソース情報を先に送信
+        # ソース情報を先に送信（プロンプト構築やLLM呼び出しより前）
         yield {
             "type": "sources",
-            "source_documents": [doc.page_content for doc in source_docs],
-            "metadata": [doc.metadata for doc in source_docs]
+            "sources": self.chunk_store.refs(source_docs),
+            "retrieval": retrieval_info
         }
 
-        # ストリーミングで回答を生成
-        full_answer = ""
-        try:
-            for chunk in current_llm.stream(messages):
-                token = chunk.content
-                if token:
-                    full_answer += token
+        with span("packing"):
+            context_text = self._format_docs_with_metadata(source_docs)
+            messages = self._build_messages(query, context_text, chat_history, image_data)
+            annotate(context_tokens=self._estimate_tokens(context_text))
+
+        # ストリーミングで回答を生成（文字列の += を避けてリストに蓄積）
+        answer_parts = []
+        key = model_key(current_llm)
+        started = time.monotonic()
+        # 主のバックエンドが締め切りまでに最初のトークンを出さなければ予備にもヘッジし、先に出た方を使う
+        stream = self.router.stream(self._backends(current_llm), messages, self._admission_backends())
+        with span("llm.stream", model=key):
+            try:
+                for token in stream:
+                    if not answer_parts:
+                        ttft = time.monotonic() - started
+                        cold = self.ttft.is_cold(stream.backend)
+                        self.ttft.record(stream.backend, ttft, cold, kind="stream")
+                        annotate(ttft_ms=round(ttft * 1000, 1), backend=stream.backend,
+                                 hedged=stream.hedged, cold=cold)
+                    answer_parts.append(token)
                     yield {"type": "token", "token": token}
-        except Exception as e:
-            yield {"type": "error", "message": str(e)}
-            return
+            except Exception as e:
+                annotate(error=str(e))
+                yield {"type": "error", "message": str(e)}
+                return
+            finally:
+                # 呼び出し側が途中で close() した場合も上流のLLMストリームを確実に閉じる
+                stream.close()
+                annotate(tokens=len(answer_parts))
 
-        yield {"type": "done", "answer": full_answer}
+        yield {"type": "done", "answer": "".join(answer_parts)}
@@ -0,0 +1,134 @@
+import re
+import secrets
+from .cache import TTLCache
+from .tokens import estimate_tokens
+
+# 直前の話題を指す表現（文中のどこにあってもフォローアップ質問とみなす）
+ANAPHORA_MARKERS = ("それ", "これ", "あれ", "その", "この", "あの", "そっち", "こっち", "どっち", "どちら")
+# 前の質問を受けて続ける言い方（文頭にあるときだけフォローアップ質問とみなす）
+FOLLOW_UP_PREFIXES = ("じゃあ", "じゃ", "では", "なら", "他に", "ほかに", "あと", "さっきの", "同じく")
+
+_TAG_RE = re.compile(r"<[^>]+>")
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？!?])")
+
+
+def clean_messages(messages, current_query=None):
+    """クライアントから送られた履歴を {"role", "text"} のリストに正規化する"""
+    cleaned = []
+    for msg in messages or []:
+        role = msg.get("role", "")
+        text = " ".join(_TAG_RE.sub(" ", msg.get("text", "") or "").split())
+        # 最初の質問より前のシステムメッセージ（挨拶など）は会話の文脈に含めない
+        if role == "system" and not cleaned:
+            continue
+        if role in ("user", "system") and text:
+            cleaned.append({"role": role, "text": text})
+    # フロントエンドは今回の質問も履歴の末尾に含めて送ってくるので取り除く
+    if current_query and cleaned and cleaned[-1]["role"] == "user" and cleaned[-1]["text"] in current_query:
+        cleaned.pop()
+    return cleaned
+
+
+def summarize_turns(summary, messages, max_chars=400):
+    """古いターンを抽出的に要約に畳み込む（LLMは呼ばない）。質問は残し、回答は最初の一文だけ残す"""
+    lines = [summary] if summary else []
+    for msg in messages:
+        if msg["role"] == "user":
+            lines.append(f"Q: {msg['text'][:80]}")
+        else:
+            first_sentence = _SENTENCE_END_RE.split(msg["text"], maxsplit=1)[0]
+            lines.append(f"A: {first_sentence[:80]}")
+    text = "\n".join(lines)
+    if len(text) > max_chars:
+        # 新しい内容を優先し、行の途中で切れないようにする
+        text = text[-max_chars:]
+        text = text[text.find("\n") + 1:] if "\n" in text else text
+    return text
+
+
+def compact_history(turns, summary="", recent_turns=4, max_tokens=600, summary_max_chars=400):
+    """直近のターンをトークン予算内で残し、それより古いものは要約に畳み込む"""
+    keep = []
+    budget = max_tokens
+    for msg in reversed(turns):
+        cost = estimate_tokens(msg["text"])
+        if len(keep) >= recent_turns or cost > budget:
+            break
+        keep.append(msg)
+        budget -= cost
+    keep.reverse()
+
+    dropped = turns[:len(turns) - len(keep)]
+    if dropped:
+        summary = summarize_turns(summary, dropped, summary_max_chars)
+    return {"summary": summary, "turns": keep}
+
+
+def is_follow_up(query):
+    """前の話題を指す表現があるか。短いだけの質問（「電池の捨て方」など）は新しい話題として扱う"""
+    text = query.strip()
+    return text.startswith(FOLLOW_UP_PREFIXES) or any(marker in text for marker in ANAPHORA_MARKERS)
+
+
+def rewrite_retrieval_query(query, history):
+    """フォローアップ質問なら直前のユーザー質問を補って検索クエリを作る"""
+    if not history or not is_follow_up(query):
+        return query
+    last_question = next(
+        (m["text"] for m in reversed(history["turns"]) if m["role"] == "user"), None
+    )
+    if not last_question:
+        return query
+    return f"{last_question} {query}"
+
+
+class HistoryManager:
+    """会話ごとの「要約＋直近ターン」をサーバー側に保持する。
+
+    会話IDはサーバーが推測できない値で発行し、クライアントはそれを送り返すだけでよい。
+    発行していない・期限切れのIDは使わない（他人の会話を読めないように）。
+    """
+
+    def __init__(self, recent_turns=4, max_tokens=600, summary_max_chars=400,
+                 max_conversations=1000, ttl_sec=21600):
+        self.recent_turns = recent_turns
+        self.max_tokens = max_tokens
+        self.summary_max_chars = summary_max_chars
+        self._store = TTLCache(max_entries=max_conversations, ttl_sec=ttl_sec)
+
+    def _compact(self, turns, summary=""):
+        return compact_history(
+            turns, summary, self.recent_turns, self.max_tokens, self.summary_max_chars
+        )
+
+    @staticmethod
+    def new_id():
+        return secrets.token_urlsafe(16)
+
+    def get_history(self, conversation_id, client_history=None, current_query=None):
+        """(会話ID, 圧縮済みの履歴) を返す。
+
+        サーバー側に無いID（発行していない・期限切れ）は使わずに新しいIDを発行し、
+        履歴はそのクライアントが送ってきた分から作る。
+        """
+        state = self._store.get(conversation_id) if conversation_id else None
+        if state is None:
+            conversation_id = self.new_id()
+            state = self._compact(clean_messages(client_history, current_query))
+            if state["turns"]:
+                self._store.set(conversation_id, state)
+        return conversation_id, state
+
+    def record_turn(self, conversation_id, question, answer):
+        """1往復分の質問と回答を会話に追加する（conversation_id は get_history が返したもの）"""
+        if not conversation_id:
+            return
+        state = self._store.get(conversation_id) or {"summary": "", "turns": []}
+        turns = state["turns"] + [
+            {"role": "user", "text": question},
+            {"role": "system", "text": answer},
+        ]
+        self._store.set(conversation_id, self._compact(turns, state["summary"]))
+
+    def stats(self):
+        return self._store.stats()
@@ -0,0 +1,99 @@
+import base64
+import binascii
+import hashlib
+import io
+from .cache import TTLCache
+
+ALLOWED_IMAGE_TYPES = ("image/jpeg", "image/png", "image/webp", "image/gif", "image/bmp")
+
+
+class ImageRejected(ValueError):
+    """受け付けられない画像（HTTP 400/413 に変換される）"""
+
+    def __init__(self, status_code, detail):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def parse_data_url(data_url):
+    """data URL を (MIMEタイプ, base64文字列) に分解する"""
+    header, sep, payload = data_url.partition(",")
+    if not sep or not header.startswith("data:") or not header.endswith(";base64"):
+        raise ImageRejected(400, "画像は base64 の data URL で送信してください。")
+    mime_type = header[len("data:"):-len(";base64")].lower()
+    if mime_type not in ALLOWED_IMAGE_TYPES:
+        raise ImageRejected(400, f"対応していない画像形式です: {mime_type}")
+    return mime_type, payload
+
+
+class ImagePreprocessor:
+    """マルチモーダル呼び出しの前に画像を検証・縮小・再エンコードする。
+
+    処理結果は入力のハッシュでキャッシュし、同じ画像の再送ではデコードを省く。
+    process() はブロッキングなのでイベントループ外（executor）で呼ぶこと。
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_side=1024, quality=80, cache_size=64):
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.quality = quality
+        self._cache = TTLCache(max_entries=cache_size, ttl_sec=3600)
+
+    def process(self, data_url):
+        """data URL を受け取り、縮小済みの JPEG data URL を返す"""
+        # base64 は元データの約4/3倍なので、デコード前に大きさを判定できる
+        if len(data_url) > self.max_bytes * 4 // 3 + 1024:
+            raise ImageRejected(413, f"画像が大きすぎます（上限 {self.max_bytes // (1024 * 1024)}MB）。")
+
+        key = hashlib.sha256(data_url.encode("ascii", "ignore")).hexdigest()
+        cached = self._cache.get(key)
+        if cached is not None:
+            return cached
+
+        mime_type, payload = parse_data_url(data_url)
+        try:
+            raw = base64.b64decode(payload, validate=False)
+        except (binascii.Error, ValueError):
+            raise ImageRejected(400, "画像データを読み取れませんでした。")
+
+        result = self._resize(raw, mime_type) or data_url
+        self._cache.set(key, result)
+        return result
+
+    def _resize(self, raw, mime_type):
+        """Pillow で縮小・再エンコードする。Pillow が無い場合は None（元画像をそのまま使う）"""
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            return None
+
+        try:
+            image = Image.open(io.BytesIO(raw))
+            # JPEG はデコード時点で縮小できる（フル解像度の展開を避ける）
+            image.draft("RGB", (self.max_side, self.max_side))
+            image = ImageOps.exif_transpose(image)
+            if (mime_type == "image/jpeg" and len(raw) <= 512 * 1024
+                    and max(image.size) <= self.max_side):
+                return None  # 既に十分小さい
+
+            image.thumbnail((self.max_side, self.max_side))
+            if image.mode != "RGB":
+                # 透過部分は白で塗りつぶす
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                rgba = image.convert("RGBA")
+                background.paste(rgba, mask=rgba.split()[-1])
+                image = background
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=self.quality)
+        except Image.DecompressionBombError:
+            raise ImageRejected(413, "画像の解像度が大きすぎます。")
+        except (OSError, ValueError, SyntaxError):
+            raise ImageRejected(400, "画像データを読み取れませんでした。")
+
+        encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+        return f"data:image/jpeg;base64,{encoded}"
+
+    def stats(self):
+        return self._cache.stats()
@@ -1,27 +1,50 @@
 import os
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, DirectoryLoader
+from pathlib import Path
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from .chunks import assign_chunk_ids
+from .config import Config
+
+# 分割方式: "recursive"（文字数ベース）または "table"（早見表の1行＝1チャンク）
+SPLITTER_STRATEGIES = ("recursive", "table")
+
+
+def source_path(path, raw_dir):
+    """ファイルのパスを、load_documents(raw_dir) がメタデータの source に入れるのと同じ形にする"""
+    relative = os.path.relpath(os.path.abspath(path), os.path.abspath(raw_dir))
+    return str(Path(raw_dir) / relative)
+
 class DocumentProcessor:
-    def __init__(self, chunk_size=1500, chunk_overlap=300):
+    def __init__(self, chunk_size=None, chunk_overlap=None, strategy=None):
         # Larger chunks preserve more context for better answers
         # More overlap ensures continuity between chunks
+        # 既定値は Config（main.py --tune の推奨設定を含む）から取る
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
+            chunk_size=chunk_size or Config.CHUNK_SIZE,
+            chunk_overlap=chunk_overlap if chunk_overlap is not None else Config.CHUNK_OVERLAP,
             length_function=len,
             is_separator_regex=False,
             separators=["\n\n", "\n", "。", "、", " ", ""],  # Japanese-aware separators
         )
+        self.strategy = strategy or Config.CHUNK_STRATEGY
+        if self.strategy not in SPLITTER_STRATEGIES:
+            raise ValueError(f"Unknown splitter strategy: {self.strategy} (choose from {SPLITTER_STRATEGIES})")
+        if self.strategy == "table":
+            from .splitters import TableAwareSplitter
+            # 表と判定できないページは従来の分割にフォールバックする
+            self.text_splitter = TableAwareSplitter(fallback_splitter=self.text_splitter)
 
-    def load_documents(self, directory_path):
+    def load_documents(self, directory_path, recursive=True):
         """指定されたディレクトリからドキュメントを読み込む"""
         print(f"Loading documents from {directory_path}...")
+        # pypdf を含むローダーは重いため、実際に読み込むときだけインポートする
+        from langchain_community.document_loaders import PyPDFLoader, TextLoader, DirectoryLoader
         
         # PDFの読み込み (recursive=True を指定してサブフォルダも探索)
-        pdf_loader = DirectoryLoader(directory_path, glob="**/*.pdf", loader_cls=PyPDFLoader, recursive=True)
+        prefix = "**/" if recursive else ""
+        pdf_loader = DirectoryLoader(directory_path, glob=f"{prefix}*.pdf", loader_cls=PyPDFLoader, recursive=recursive)
         # テキストの読み込み
-        txt_loader = DirectoryLoader(directory_path, glob="**/*.txt", loader_cls=TextLoader, recursive=True)
+        txt_loader = DirectoryLoader(directory_path, glob=f"{prefix}*.txt", loader_cls=TextLoader, recursive=recursive)
         
         docs = []
         try:
@@ -36,9 +59,30 @@ class DocumentProcessor:
             
         return docs
 
+    def load_files(self, paths):
+        """個別のファイルを読み込む（変更されたファイルだけを取り込み直すとき用）。
+
+        (ドキュメント, 読み込めなかったパス) を返す。存在しないファイルは削除されたものとして飛ばし、
+        存在するのに読み込めなかったファイル（コピー途中のPDFなど）は失敗として返す。
+        """
+        from langchain_community.document_loaders import PyPDFLoader, TextLoader
+
+        docs = []
+        failed = []
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            loader_cls = PyPDFLoader if path.lower().endswith(".pdf") else TextLoader
+            try:
+                docs.extend(loader_cls(path).load())
+            except Exception as e:
+                print(f"Error loading {path}: {e}")
+                failed.append(path)
+        return docs, failed
+
     def split_documents(self, documents):
         """ドキュメントをチャンクに分割する"""
-        print(f"Splitting {len(documents)} documents into chunks...")
-        chunks = self.text_splitter.split_documents(documents)
+        print(f"Splitting {len(documents)} documents into chunks ({self.strategy})...")
+        chunks = assign_chunk_ids(self.text_splitter.split_documents(documents))
         print(f"Created {len(chunks)} chunks.")
         return chunks
@@ -0,0 +1,118 @@
+import json
+
+
+class BodySizeLimitMiddleware:
+    """リクエストボディを読み込みながら大きさを数え、上限を超えたら即座に413を返す。
+
+    Content-Length があればボディを読む前に判定し、無い場合（chunked）も
+    上限までしかメモリに載せない。
+    """
+
+    def __init__(self, app, max_bytes, path_prefixes=("/query",)):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.path_prefixes = tuple(path_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        content_length = headers.get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        chunks = []
+        received = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body = message.get("body", b"")
+            received += len(body)
+            if received > self.max_bytes:
+                await self._reject(send)
+                return
+            chunks.append(body)
+            if not message.get("more_body", False):
+                break
+
+        replayed = False
+
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": b"".join(chunks), "more_body": False}
+            return await receive()
+
+        await self.app(scope, replay_receive, send)
+
+    async def _reject(self, send):
+        body = json.dumps(
+            {"detail": f"リクエストが大きすぎます（上限 {self.max_bytes // (1024 * 1024)}MB）。"},
+            ensure_ascii=False
+        ).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode("ascii")),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+class RequestTracingMiddleware:
+    """すべての応答に X-Request-ID を付け、トレースが有効なら対象パスのリクエストをスパンツリーで計測する。
+
+    ストリーミング応答は最後のチャンクを送り終えるまでを1つのトレースとして扱う。
+    """
+
+    def __init__(self, app, recorder, path_prefixes=("/query", "/ingest")):
+        self.app = app
+        self.recorder = recorder
+        self.path_prefixes = tuple(path_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        from .tracing import new_request_id
+
+        headers = dict(scope.get("headers") or [])
+        request_id = new_request_id(headers.get(b"x-request-id", b"").decode("latin-1"))
+        scope.setdefault("state", {})["request_id"] = request_id
+        status = None
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-request-id", request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        trace = None
+        if scope["path"].startswith(self.path_prefixes):
+            trace = self.recorder.start(request_id, f"{scope['method']} {scope['path']}", headers)
+        if trace is None:
+            await self.app(scope, receive, send_with_request_id)
+            return
+
+        tokens = self.recorder.activate(trace)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        except Exception as e:
+            trace.root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            trace.root.set(status=status)
+            self.recorder.deactivate(tokens)
+            self.recorder.finish(trace)
@@ -0,0 +1,290 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .chunks import CompactChunks
+from .config import Config
+from .retrievers import reciprocal_rank_fusion
+from .tracing import span
+
+# DATA_RAW_DIR 直下に置かれたファイル（どの自治体にも属さない共通資料）のパーティション名
+SHARED_PARTITION = "_shared"
+
+
+def partition_dir_name(name):
+    """パーティション名から保存先ディレクトリ名を作る（日本語名でも衝突しないようにハッシュを付ける）"""
+    digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return f"{name}-{digest}"
+
+
+class PartitionManager:
+    """自治体（data/raw/<市>/）ごとのインデックスを初回利用時に読み込み、LRUで常駐数を制限する。
+
+    起動時はディレクトリ一覧を見るだけなので、自治体が増えても起動時間とメモリは一定に保たれる。
+    """
+
+    def __init__(self, raw_dir=None, db_dir=None, max_resident=4, processor=None, embeddings=None):
+        self.config = Config()
+        self.raw_dir = raw_dir or self.config.DATA_RAW_DIR
+        self.db_dir = os.path.join(db_dir or self.config.CHROMA_DB_DIR, "partitions")
+        self.max_resident = max(1, max_resident)
+        self._processor = processor
+        self._embeddings = embeddings
+        self._resident = OrderedDict()  # name -> {"retriever", "corpus"（検索と共有する CompactChunks）}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def _get_processor(self):
+        if self._processor is None:
+            from .loader import DocumentProcessor
+            self._processor = DocumentProcessor()
+        return self._processor
+
+    def get_embeddings(self):
+        """全パーティションで共有する埋め込みクライアント"""
+        if self._embeddings is None:
+            from .vectorstore import VectorStoreManager
+            self._embeddings = VectorStoreManager(persist_directory=self.db_dir).embeddings
+        return self._embeddings
+
+    def list_partitions(self):
+        """利用可能なパーティション名の一覧（サブフォルダ名。直下にファイルがあれば共通パーティションも含む）"""
+        if not os.path.isdir(self.raw_dir):
+            return []
+        names = []
+        has_shared = False
+        for entry in sorted(os.listdir(self.raw_dir)):
+            path = os.path.join(self.raw_dir, entry)
+            if os.path.isdir(path):
+                names.append(entry)
+            elif entry.lower().endswith((".pdf", ".txt")):
+                has_shared = True
+        if has_shared:
+            names.append(SHARED_PARTITION)
+        return names
+
+    def partition_of(self, path):
+        """ファイルが属するパーティション名（data/raw 直下のファイルは共通パーティション）"""
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.raw_dir))
+        parts = relative.split(os.sep)
+        return parts[0] if len(parts) > 1 else SHARED_PARTITION
+
+    def _vectorstore_manager(self, name):
+        from .vectorstore import VectorStoreManager
+
+        return VectorStoreManager(
+            persist_directory=os.path.join(self.db_dir, partition_dir_name(name)),
+            embeddings=self.get_embeddings()
+        )
+
+    def match(self, text):
+        """住所や自治体名の文字列から該当するパーティション名を返す（最長一致）"""
+        if not text:
+            return None
+        candidates = [name for name in self.list_partitions() if name != SHARED_PARTITION and name in text]
+        return max(candidates, key=len) if candidates else None
+
+    def _build(self, name, force_reingest=False):
+        """1つのパーティションのチャンク・ベクトルストア・BM25を構築する（ブロッキング）
+
+        保存済みのベクトルストアがあれば、チャンクもそこから読み出す（追い出した後の再読み込みで資料を解析し直さない）。
+        """
+        vs_manager = self._vectorstore_manager(name)
+        if not force_reingest and vs_manager.has_existing_vectorstore():
+            vectorstore = vs_manager.load_vectorstore()
+            chunks = vs_manager.load_chunks(vectorstore)
+            if chunks:
+                retriever = vs_manager.build_hybrid_retriever(vectorstore, chunks)
+                return {"retriever": retriever, "corpus": retriever.corpus}
+
+        processor = self._get_processor()
+        if name == SHARED_PARTITION:
+            docs = processor.load_documents(self.raw_dir, recursive=False)
+        else:
+            docs = processor.load_documents(os.path.join(self.raw_dir, name))
+        chunks = processor.split_documents(docs)
+        retriever = vs_manager.get_hybrid_retriever(chunks, force_reingest=force_reingest)
+        # 文書のないパーティションはベクトル検索のみのリトリーバーになり、コーパスを持たない
+        return {"retriever": retriever, "corpus": getattr(retriever, "corpus", None) or CompactChunks()}
+
+    def get(self, name, force_reingest=False):
+        """パーティションのリトリーバーを返す。未読込なら読み込み、上限を超えたら最も古いものを追い出す"""
+        with self._lock:
+            entry = self._resident.get(name)
+            if entry is not None and not force_reingest:
+                self._resident.move_to_end(name)
+                return entry["retriever"]
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # 同じパーティションの同時読み込みは1回にまとめる
+        with load_lock:
+            with self._lock:
+                entry = self._resident.get(name)
+                if entry is not None and not force_reingest:
+                    self._resident.move_to_end(name)
+                    return entry["retriever"]
+
+            print(f"Loading partition: {name}")
+            with span("partition.load", partition=name):
+                entry = self._build(name, force_reingest=force_reingest)
+
+            with self._lock:
+                self.loads += 1
+                self._resident[name] = entry
+                self._resident.move_to_end(name)
+                while len(self._resident) > self.max_resident:
+                    evicted, _ = self._resident.popitem(last=False)
+                    self.evictions += 1
+                    print(f"Evicted partition: {evicted}")
+            return entry["retriever"]
+
+    def resident_partitions(self):
+        """常駐しているパーティション名（最近使った順）"""
+        with self._lock:
+            return list(reversed(self._resident))
+
+    def rebuild_all(self):
+        """すべてのパーティションを作り直す（/ingest 用）。常駐数の上限はそのまま守られる"""
+        with self._lock:
+            self._resident.clear()
+        total = 0
+        for name in self.list_partitions():
+            self.get(name, force_reingest=True)
+            # 新しいコレクションに切り替わってから古いものを消す
+            self._vectorstore_manager(name).drop_stale_collections()
+            with self._lock:
+                entry = self._resident.get(name)
+                total += len(entry["corpus"]) if entry is not None else 0
+        return total
+
+    def update_files(self, paths):
+        """変更されたファイルだけを、それぞれのパーティションのインデックスに反映する（ファイル監視用）
+
+        (更新したパーティション名, 読み込めなかったパス) を返す。読み込めなかったファイルは今のチャンクを残す。
+        """
+        by_partition = defaultdict(set)
+        for path in paths:
+            by_partition[self.partition_of(path)].add(path)
+        failed = []
+        for name, partition_paths in sorted(by_partition.items()):
+            failed.extend(self._update_partition(name, partition_paths))
+        return sorted(by_partition), sorted(failed)
+
+    def _update_partition(self, name, paths):
+        from .loader import source_path
+
+        with self._lock:
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+        # 同じパーティションの読み込みとは同時に走らせない
+        with load_lock:
+            vs_manager = self._vectorstore_manager(name)
+            with self._lock:
+                entry = self._resident.get(name)
+            if entry is not None:
+                vectorstore = entry["retriever"].vectorstore
+            elif vs_manager.has_existing_vectorstore():
+                # 常駐していなくても保存済みのDBは更新しておく（次の読み込みで古いベクトルが使われないように）
+                vectorstore = vs_manager.load_vectorstore()
+            else:
+                # まだ作られていないパーティションは初回利用時にすべて読み込まれる
+                return []
+
+            processor = self._get_processor()
+            by_source = {source_path(path, self.raw_dir): path for path in paths}
+            with span("partition.update", partition=name, files=len(by_source)):
+                docs, failed = processor.load_files(sorted(by_source))
+                # 読み込めなかったファイルは置き換え対象から外し、今のベクトルとチャンクを残す
+                sources = set(by_source) - set(failed)
+                failed = [by_source[source] for source in failed]
+                if not sources:
+                    return failed
+                added = vs_manager.replace_sources(vectorstore, sources, processor.split_documents(docs))
+            print(f"Updated partition {name}: {len(sources)} file(s), {len(added)} chunks")
+            if entry is None:
+                return failed
+
+            corpus = entry["corpus"].replace_sources(sources, added)
+            if len(corpus):
+                retriever = vs_manager.build_hybrid_retriever(vectorstore, corpus)
+            else:
+                retriever = vectorstore.as_retriever(search_kwargs={"k": self.config.RETRIEVAL_K})
+            with self._lock:
+                # 更新中に追い出されていたら戻さない
+                if self._resident.get(name) is entry:
+                    self._resident[name] = {"retriever": retriever, "corpus": corpus}
+            return failed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "partitions": self.list_partitions(),
+                "resident": {name: len(entry["corpus"]) for name, entry in self._resident.items()},
+                "max_resident": self.max_resident,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+class PartitionedRetriever(BaseRetriever):
+    """リクエストの自治体に対応するパーティションだけを検索するリトリーバー。
+
+    invoke(query, municipality="柏市") のように指定する。自治体が分からない場合は
+    常駐しているパーティションだけを検索してRRFで統合する（自治体を指定しない質問のたびに
+    全自治体を読み込み直さないように）。何も常駐していなければすべてを検索する。
+    共通パーティションは常に含める。
+    """
+
+    partition_manager: Any
+
+    def _partitions_for(self, municipality):
+        names = self.partition_manager.list_partitions()
+        shared = [SHARED_PARTITION] if SHARED_PARTITION in names else []
+        matched = self.partition_manager.match(municipality)
+        if matched:
+            return [matched] + shared
+        resident = [
+            name for name in self.partition_manager.resident_partitions()
+            if name in names and name != SHARED_PARTITION
+        ]
+        if resident:
+            return resident + shared
+        return names
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        weights: Optional[List[float]] = None,
+        municipality: Optional[str] = None,
+        query_vector: Optional[List[float]] = None,
+    ) -> List[Document]:
+        kwargs = {}
+        if k:
+            kwargs["k"] = k
+        if weights:
+            kwargs["weights"] = weights
+        if query_vector is not None:
+            kwargs["query_vector"] = query_vector
+
+        doc_lists = []
+        for name in self._partitions_for(municipality):
+            retriever = self.partition_manager.get(name)
+            # 文書のないパーティションはベクトル検索のみのリトリーバーになるので重み・ベクトルは渡さない
+            if not hasattr(retriever, "weights"):
+                doc_lists.append(retriever.invoke(query, **({"k": k} if k else {})))
+            else:
+                doc_lists.append(retriever.invoke(query, **kwargs))
+
+        if len(doc_lists) == 1:
+            return doc_lists[0]
+        return reciprocal_rank_fusion(doc_lists, [1.0] * len(doc_lists))
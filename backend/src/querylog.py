@@ -0,0 +1,89 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from .cache import normalize_prompt
+
+# 個人情報になりうる部分（メールアドレス、電話番号・郵便番号などの4桁以上の数字）は伏せて記録する
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_DIGITS_RE = re.compile(r"\d[\d-]{3,}")
+REDACTED = "＊"
+# 記録する質問文の最大文字数
+MAX_PROMPT_CHARS = 200
+
+
+def scrub_prompt(prompt):
+    """質問文を正規化し、個人情報になりうる部分を伏せる"""
+    text = normalize_prompt(prompt)
+    text = _EMAIL_RE.sub(REDACTED, text)
+    text = _DIGITS_RE.sub(REDACTED, text)
+    return text[:MAX_PROMPT_CHARS]
+
+
+class QueryLog:
+    """質問の追記専用ログ（JSONL）。
+
+    1行に {"t": 時刻(秒), "q": 正規化した質問, "m": 自治体, "ms": 応答時間, "c": キャッシュヒットなら1} だけを書く。
+    画像・位置情報（座標や住所）・会話履歴・会話IDは記録しない。max_bytes を超えたら .1 に退避して新しく始める。
+    """
+
+    def __init__(self, path="data/logs/queries.jsonl", enabled=True, max_bytes=5 * 1024 * 1024):
+        self.path = path
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.written = 0
+
+    def record(self, prompt, municipality="", latency_ms=0.0, cache_hit=False):
+        if not self.enabled or not prompt:
+            return
+        entry = {"t": int(time.time()), "q": scrub_prompt(prompt), "m": municipality or "", "ms": int(latency_ms)}
+        if cache_hit:
+            entry["c"] = 1
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        try:
+            with self._lock:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+                self.written += 1
+        except OSError as e:
+            # ログが書けなくても応答は止めない
+            print(f"Could not write query log: {e}")
+
+    def _entries(self, since):
+        for path in (self.path + ".1", self.path):
+            if not os.path.isfile(path):
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("t", 0) >= since:
+                        yield entry
+
+    def top_queries(self, n=20, window_days=7):
+        """直近 window_days 日でよく聞かれた質問を [{"prompt", "municipality", "count"}] で返す"""
+        if n <= 0:
+            return []
+        since = time.time() - window_days * 86400
+        counts = Counter()
+        with self._lock:
+            for entry in self._entries(since):
+                # 伏せ字を含む質問は元の文に戻せないので再生しない
+                if entry.get("q") and REDACTED not in entry["q"]:
+                    counts[(entry["q"], entry.get("m", ""))] += 1
+        return [
+            {"prompt": prompt, "municipality": municipality, "count": count}
+            for (prompt, municipality), count in counts.most_common(n)
+        ]
+
+    def stats(self):
+        return {"enabled": self.enabled, "path": self.path, "written": self.written}
@@ -0,0 +1,161 @@
+import heapq
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from .chunks import DEGRADED_KEY, SCORES_KEY
+from .tracing import annotate, in_context, span
+
+# 検索レッグ用のスレッドプール（タイムアウトしたレッグはバックグラウンドで完走させる）
+# ベクトル側は埋め込みのHTTP呼び出しで止まることがあるので、BM25とは別のプールにして
+# ベクトル側のスレッドが埋まってもBM25だけで応答できるようにする
+_VECTOR_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retrieval-vector")
+_BM25_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval-bm25")
+
+
+def rrf_scores(doc_lists, weights, c=60):
+    """重み付き RRF のスコアを計算する。(スコア順のドキュメント, 内容 -> スコア) を返す"""
+    scores = defaultdict(float)
+    first_seen = {}
+    for doc_list, weight in zip(doc_lists, weights):
+        for rank, doc in enumerate(doc_list, start=1):
+            scores[doc.page_content] += weight / (rank + c)
+            first_seen.setdefault(doc.page_content, doc)
+    ranked = sorted(first_seen.values(), key=lambda doc: scores[doc.page_content], reverse=True)
+    return ranked, scores
+
+
+def reciprocal_rank_fusion(doc_lists, weights, c=60):
+    """重み付き Reciprocal Rank Fusion。同一内容のチャンクはスコアを合算して1件にまとめる"""
+    return rrf_scores(doc_lists, weights, c)[0]
+
+
+def build_bm25_index(corpus):
+    """コーパス（CompactChunks）の本文からBM25のインデックスを作る。ドキュメントの複製は持たない"""
+    from rank_bm25 import BM25Okapi
+
+    # 語の分け方は BM25Retriever の既定（空白区切り）と同じ
+    return BM25Okapi([text.split() for text in corpus.texts()])
+
+
+class HybridRetriever(BaseRetriever):
+    """ベクトル検索とBM25を並列に実行し、RRFで統合するリトリーバー。
+
+    レッグごとにタイムアウトを持ち、埋め込みが遅い・Ollamaが落ちている場合は
+    BM25の結果だけで応答する。k と重みは invoke(query, k=..., weights=...) で
+    リクエストごとに上書きできる。query_vector を渡すと質問の埋め込みを省く（バッチで埋め込み済みの場合）。返すドキュメントのメタデータには、各レッグの
+    スコアとRRFのスコアが入る（適応的な検索深さの判定と応答のメタデータに使う）。
+
+    チャンクは corpus（CompactChunks）の整数IDで扱い、Document は結果を返すときだけ作る。
+    """
+
+    vectorstore: Any
+    corpus: Any
+    bm25_index: Any
+    k: int = 6
+    weights: List[float] = [0.6, 0.4]
+    vector_timeout: float = 5.0
+    bm25_timeout: float = 2.0
+    c: int = 60
+
+    def _vector_leg(self, query, k, query_vector=None):
+        """(ドキュメント, 関連度) のリスト。関連度はベクトルストアが距離から換算した値（大きいほど近い）"""
+        if query_vector is None:
+            scored = self.vectorstore.similarity_search_with_relevance_scores(query, k=k)
+        else:
+            # ベクトルで検索すると距離が返るので、テキストで検索したときと同じ関連度に換算する
+            to_relevance = self.vectorstore._select_relevance_score_fn()
+            scored = self.vectorstore.similarity_search_by_vector_with_relevance_scores(query_vector, k=k)
+            scored = [(doc, to_relevance(distance)) for doc, distance in scored]
+        return [(self._from_corpus(doc), score) for doc, score in scored]
+
+    def _from_corpus(self, doc):
+        """ベクトルストアが返したドキュメントを、コーパスにあればそちらから作り直す（メタデータをそろえる）"""
+        i = self.corpus.index_of(doc.metadata.get("chunk_id"))
+        return doc if i is None else self.corpus.document(i)
+
+    def _bm25_leg(self, query, k):
+        """(ドキュメント, BM25スコア) のリスト。スコアが0なら質問の語を1つも含まない"""
+        scores = self.bm25_index.get_scores(query.split())
+        top = heapq.nlargest(k, range(len(scores)), key=scores.__getitem__)
+        return [(self.corpus.document(i), float(scores[i])) for i in top]
+
+    @staticmethod
+    def _run_leg(name, leg, query, k, **kwargs):
+        with span(f"retrieval.{name}", k=k):
+            scored = leg(query, k, **kwargs)
+            annotate(docs=len(scored), top_score=round(scored[0][1], 4) if scored else None)
+            return scored
+
+    @staticmethod
+    def _with_scores(docs, leg_scores, fused_scores, degraded=()):
+        """統合結果のコピーにスコアを付ける（元のメタデータは書き換えない）
+
+        タイムアウト・失敗したレッグがあれば DEGRADED_KEY にその名前を入れる（スコアでの打ち切りをしないため）。
+        """
+        results = []
+        for doc in docs:
+            scores = {"rrf": round(fused_scores[doc.page_content], 6)}
+            for name, by_content in leg_scores.items():
+                if doc.page_content in by_content:
+                    scores[name] = round(by_content[doc.page_content], 4)
+            metadata = {**doc.metadata, SCORES_KEY: scores}
+            if degraded:
+                metadata[DEGRADED_KEY] = list(degraded)
+            results.append(Document(page_content=doc.page_content, metadata=metadata))
+        return results
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        k: Optional[int] = None,
+        weights: Optional[List[float]] = None,
+        query_vector: Optional[List[float]] = None,
+    ) -> List[Document]:
+        k = k or self.k
+        weights = weights or self.weights
+
+        started = time.monotonic()
+        legs = [
+            ("vector", _VECTOR_EXECUTOR.submit(in_context(self._run_leg), "vector", self._vector_leg, query, k,
+                                               query_vector=query_vector),
+             self.vector_timeout),
+            ("bm25", _BM25_EXECUTOR.submit(in_context(self._run_leg), "bm25", self._bm25_leg, query, k),
+             self.bm25_timeout),
+        ]
+
+        doc_lists, leg_weights, leg_scores, errors, degraded = [], [], {}, [], []
+        for (name, future, timeout), weight in zip(legs, weights):
+            # 各レッグの締め切りは検索開始時点から数える（レッグは並列に走っている）
+            remaining = max(0.0, started + timeout - time.monotonic())
+            try:
+                scored = future.result(timeout=remaining)
+                doc_lists.append([doc for doc, _ in scored])
+                leg_weights.append(weight)
+                by_content = leg_scores.setdefault(name, {})
+                for doc, score in scored:
+                    by_content.setdefault(doc.page_content, score)
+            except FutureTimeoutError:
+                # まだ始まっていない（プールが埋まっていて待っている）レッグは走らせない
+                future.cancel()
+                errors.append(f"{name}: timed out after {timeout}s")
+                degraded.append(name)
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+                degraded.append(name)
+
+        if errors:
+            print(f"Retrieval degraded ({'; '.join(errors)})")
+            annotate(degraded=errors)
+        if not doc_lists:
+            raise RuntimeError(f"All retrieval legs failed: {'; '.join(errors)}")
+
+        fused, fused_scores = rrf_scores(doc_lists, leg_weights, self.c)
+        return self._with_scores(fused, leg_scores, fused_scores, degraded)
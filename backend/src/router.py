@@ -0,0 +1,308 @@
+import queue
+import threading
+import time
+
+from .warmup import model_key
+
+# 失敗（エラー・締め切り超過）が続いたバックエンドを一時的に外す
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+# ヘッジ・予備のバックエンドの受付枠が空いていなかったとき、次に試すまでの秒数
+ADMISSION_RETRY_SEC = 1.0
+
+
+def parse_backend_specs(value):
+    """LLM_FALLBACKS の値を [{"type", "name", "address"}] にする。
+
+    形式: "種別:モデル名[@URL]" をカンマ区切り。例: "ollama:qwen2.5:1.5b@http://gpu-host:11434,openai:gpt-4o-mini"
+    """
+    specs = []
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model_type, _, rest = item.partition(":")
+        name, _, address = rest.partition("@")
+        if model_type not in ("ollama", "openai") or not name:
+            raise ValueError(f"Invalid LLM backend spec: {item!r} (expected type:model[@url])")
+        specs.append({"type": model_type, "name": name, "address": address})
+    return specs
+
+
+class CircuitBreaker:
+    """連続して failure_threshold 回失敗したら cooldown_sec の間そのバックエンドを使わない。
+    時間が経ったら1回だけ試し（half-open）、成功すれば元に戻す。"""
+
+    def __init__(self, failure_threshold=3, cooldown_sec=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown_sec = cooldown_sec
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == BREAKER_CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == BREAKER_OPEN and now - self.opened_at >= self.cooldown_sec:
+                self.state = BREAKER_HALF_OPEN
+                self._trial_at = None
+            # 試しの1回が結果を返さないまま cooldown_sec たったら（使われなかった場合など）もう1回試す
+            if self.state == BREAKER_HALF_OPEN and (
+                self._trial_at is None or now - self._trial_at >= self.cooldown_sec
+            ):
+                self._trial_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == BREAKER_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != BREAKER_OPEN:
+                    print(f"Circuit opened after {self.failures} failure(s)")
+                self.state = BREAKER_OPEN
+                self.opened_at = time.monotonic()
+                self._trial_at = None
+
+
+class _Attempt:
+    """1つのバックエンドへのストリーミング呼び出し（専用スレッドで回す）"""
+
+    def __init__(self, key, llm, messages, events, permit=None):
+        self.key = key
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.finished = False
+        self.cancelled = threading.Event()
+        self._llm = llm
+        self._messages = messages
+        self._events = events
+        self._permit = permit
+        threading.Thread(target=self._run, name=f"llm-{key}", daemon=True).start()
+
+    def _run(self):
+        try:
+            stream = self._llm.stream(self._messages)
+            try:
+                for chunk in stream:
+                    if self.cancelled.is_set():
+                        break
+                    if chunk.content:
+                        self._events.put((self, "token", chunk.content))
+            finally:
+                # 負けた・打ち切られた呼び出しは上流の接続ごと閉じる
+                stream.close()
+            self._events.put((self, "done", None))
+        except Exception as e:
+            self._events.put((self, "error", e))
+        finally:
+            # 打ち切った後も上流の応答を待っている間はバックエンドを使っているので、スレッドが終わるまで枠を返さない
+            if self._permit is not None:
+                self._permit.release()
+
+
+class RoutedStream:
+    """BackendRouter.stream の戻り値。トークン（文字列）を順に返す。
+
+    最初のトークンが出た時点で backend（採用したバックエンドのキー）と hedged（予備も走らせたか）が決まる。
+    """
+
+    def __init__(self, router, candidates, messages):
+        self.router = router
+        self.backend = None
+        self.hedged = False
+        self.errors = []
+        self._candidates = list(candidates)
+        self._messages = messages
+        self._events = queue.Queue()
+        self._attempts = []
+        self._iterator = self._iterate()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+    def close(self):
+        self._iterator.close()
+
+    def _start_next(self):
+        """次のバックエンドへの呼び出しを始める。受付枠に空きが無いものは飛ばし（後でまた試す）、
+        どれも始められなければ False"""
+        admission = self.router.admission
+        for index, (key, llm, backend) in enumerate(self._candidates):
+            permit = None
+            # backend が None のもの（リクエストが枠を取得済みのバックエンド）以外は、ヘッジ・予備でも枠を取る
+            if backend is not None and admission is not None:
+                permit = admission.try_acquire_nowait(*backend)
+                if permit is None:
+                    continue
+            del self._candidates[index]
+            self._attempts.append(_Attempt(key, llm, self._messages, self._events, permit))
+            return True
+        self.router.admission_skips += 1
+        return False
+
+    def _cancel(self, attempts):
+        for attempt in attempts:
+            attempt.cancelled.set()
+
+    def _wait_first_token(self):
+        """どれかのバックエンドが最初のトークンを出すまで待つ。(勝ったバックエンド, トークン) を返す"""
+        router = self.router
+        started = time.monotonic()
+        give_up_at = started + router.first_token_timeout
+        running = 1 if self._start_next() else 0
+        next_hedge_at = started + (router.ttft_deadline if running else ADMISSION_RETRY_SEC)
+        while True:
+            now = time.monotonic()
+            wait_until = min(next_hedge_at, give_up_at) if self._candidates else give_up_at
+            try:
+                attempt, kind, payload = self._events.get(timeout=max(0.0, wait_until - now))
+            except queue.Empty:
+                if time.monotonic() >= give_up_at:
+                    for attempt in self._attempts:
+                        if not attempt.finished:
+                            router.breaker(attempt.key).record_failure()
+                    raise TimeoutError(
+                        f"No LLM backend produced a token within {router.first_token_timeout}s"
+                    )
+                # 締め切りまでに最初のトークンが来なければ、次のバックエンドにも同じリクエストを送る
+                if self._start_next():
+                    if running:
+                        print(f"No first token within {router.ttft_deadline}s; hedging to {self._attempts[-1].key}")
+                        self.hedged = True
+                        router.hedges += 1
+                    running += 1
+                    next_hedge_at = time.monotonic() + router.ttft_deadline
+                else:
+                    next_hedge_at = time.monotonic() + ADMISSION_RETRY_SEC
+                continue
+
+            if kind == "token":
+                attempt.first_token_at = time.monotonic()
+                return attempt, payload
+            # 最初のトークンより前に終わった・失敗したら、締め切りを待たずに次へ
+            attempt.finished = True
+            running -= 1
+            if kind == "error":
+                self.errors.append(f"{attempt.key}: {payload}")
+                router.breaker(attempt.key).record_failure()
+            else:
+                router.breaker(attempt.key).record_success()
+                return attempt, ""
+            if running == 0:
+                if not self._candidates:
+                    raise RuntimeError(f"All LLM backends failed: {'; '.join(self.errors)}")
+                if self._start_next():
+                    running += 1
+                    next_hedge_at = time.monotonic() + router.ttft_deadline
+                else:
+                    next_hedge_at = time.monotonic() + ADMISSION_RETRY_SEC
+
+    def _iterate(self):
+        router = self.router
+        try:
+            winner, token = self._wait_first_token()
+            self.backend = winner.key
+            router.wins[winner.key] = router.wins.get(winner.key, 0) + 1
+            losers = [attempt for attempt in self._attempts if attempt is not winner]
+            self._cancel(losers)
+            # 締め切りを過ぎても最初のトークンを出せなかったものは不調とみなす
+            for attempt in losers:
+                if not attempt.finished and attempt.started + router.ttft_deadline <= winner.first_token_at:
+                    router.breaker(attempt.key).record_failure()
+            if not token:
+                return
+            yield token
+
+            while True:
+                attempt, kind, payload = self._events.get()
+                if attempt is not winner:
+                    continue
+                if kind == "token":
+                    yield payload
+                elif kind == "done":
+                    router.breaker(winner.key).record_success()
+                    return
+                else:
+                    router.breaker(winner.key).record_failure()
+                    raise payload
+        finally:
+            # 呼び出し側が途中で閉じた場合も、走っている呼び出しをすべて止める
+            self._cancel(self._attempts)
+
+
+class BackendRouter:
+    """順序付きのLLMバックエンドに、最初のトークンの締め切りとサーキットブレーカーを付けて振り分ける。
+
+    先頭のバックエンドが ttft_deadline 秒以内に最初のトークンを出さなければ、次のバックエンドにも
+    同じリクエストを送り（ヘッジ）、先にトークンを出した方を採用して他方は打ち切る。
+    first_token_timeout 秒たってもどれも出さなければ諦める（無期限には待たない）。
+    admission を渡すと、ヘッジ・予備のバックエンドへの呼び出しもその受付枠を取ってから始める
+    （枠が空いていなければ空くまで始めない）。
+    """
+
+    def __init__(self, ttft_deadline=15.0, first_token_timeout=120.0, failure_threshold=3, cooldown_sec=30.0,
+                 admission=None):
+        self.ttft_deadline = ttft_deadline
+        self.first_token_timeout = first_token_timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown_sec = cooldown_sec
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.admission = admission
+        self.hedges = 0
+        self.admission_skips = 0
+        self.wins = {}
+
+    def breaker(self, key):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.cooldown_sec)
+                self._breakers[key] = breaker
+            return breaker
+
+    def candidates(self, llms, backends=None):
+        """ブレーカーが開いているバックエンドを除いた [(キー, LLM, 受付制御のバックエンド)]。全部開いていれば全部試す"""
+        backends = backends or [None] * len(llms)
+        unique = {}
+        for llm, backend in zip(llms, backends):
+            unique.setdefault(model_key(llm), (llm, backend))
+        allowed = [(key, llm, backend) for key, (llm, backend) in unique.items() if self.breaker(key).allow()]
+        return allowed or [(key, llm, backend) for key, (llm, backend) in unique.items()]
+
+    def stream(self, llms, messages, backends=None):
+        """llms を優先順に使ってストリーミングする。トークンを返す RoutedStream を返す
+
+        backends は llms と同じ順の (受付制御のキー, 種別)。None のものは呼び出し側が枠を取得済みとして扱う。
+        """
+        return RoutedStream(self, self.candidates(llms, backends), messages)
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {
+            "ttft_deadline_sec": self.ttft_deadline,
+            "first_token_timeout_sec": self.first_token_timeout,
+            "hedges": self.hedges,
+            "admission_skips": self.admission_skips,
+            "wins": dict(self.wins),
+            "backends": {
+                key: {"state": breaker.state, "failures": breaker.failures}
+                for key, breaker in breakers.items()
+            },
+        }
@@ -0,0 +1,270 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from collections import defaultdict
+
+from .splitters import CATEGORY_WORDS, HEADER_WORDS, ROW_TERMINATOR_RE, TableAwareSplitter
+
+# 形式を変えたら上げる（PWA側は知らない形式のバンドルを使わない）
+BUNDLE_FORMAT = 1
+BUNDLE_FILENAME = "rules_bundle.json"
+EXTRACTED_RULES_FILENAME = "garbage_rules.json"
+
+# 表の行から分別区分を探す（splitters の CATEGORY_RE と違い、品目名に続けて書かれていても拾う）
+_CATEGORY_SEARCH_RE = re.compile(CATEGORY_WORDS)
+_HEADER_PREFIX_RE = re.compile(r"^\[[^\]]*\]\s*")
+# 分別区分として認める形（「資源品(金属類)」「不燃ごみ,小型家電」など）。区分の語にほかの文字が続いたものは認めない
+_CATEGORY_VALUE_RE = re.compile(rf"(?:{CATEGORY_WORDS})(?:\([^()]*\))?(?:,(?:{CATEGORY_WORDS})(?:\([^()]*\))?)*")
+# 柏市の早見表の行頭に紛れ込む列見出し（「北部 南部」は直接搬入可否の列）
+_HEADER_FRAGMENT_RE = re.compile(r"^(?:(?:北部|南部|備考|直接搬入|可否)\s*)+")
+# 行末の読み方（カタカナ。折り返しで空白を挟むことがある）
+_READING_RE = re.compile(r"([ァ-ヶー]+(?:\s+[ァ-ヶー]+)*)$")
+_HALFWIDTH_KANA_RE = re.compile(r"[ｦ-ﾟ]")
+
+
+def normalize_item(text):
+    """品目名を検索キーに正規化する（全角/半角・大小文字・空白・カタカナ/ひらがなの揺れを吸収）"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = "".join(text.split())
+    # カタカナをひらがなにそろえる（PWA側の normalizeItem と同じ規則）
+    return "".join(chr(ord(ch) - 0x60) if "ァ" <= ch <= "ヶ" else ch for ch in text)
+
+
+class _DiscardSplitter:
+    """表と判定できなかったページを捨てる（バンドルには表の行だけを入れる）"""
+
+    def split_documents(self, documents):
+        return []
+
+
+def _municipality_of(source, raw_dir):
+    """ファイルのパスから自治体名（data/raw 直下のフォルダ名）を返す"""
+    try:
+        relative = os.path.relpath(source, raw_dir)
+    except ValueError:
+        return ""
+    parts = relative.split(os.sep)
+    return parts[0] if len(parts) > 1 and parts[0] != ".." else ""
+
+
+def parse_table_row(text):
+    """早見表の1行を GarbageRule の項目に分ける。区分が既知の形でない・品目が見出しの断片なら None"""
+    text = _HEADER_PREFIX_RE.sub("", text).strip()
+    text = ROW_TERMINATOR_RE.sub("", text).strip()
+    match = _CATEGORY_SEARCH_RE.search(text)
+    if not match or match.start() == 0:
+        return None
+    item = _HEADER_FRAGMENT_RE.sub("", text[:match.start()].strip())
+    # 品目名に句点は無いので、前の行から折り返した注意書きが付いていれば除く
+    item = item.rpartition("。")[2].strip()
+    # 区分は「資源品(金属類)」「不燃ごみ,小型家電」のように空白までを1つとみなす
+    rest = text[match.start():]
+    category, _, method = rest.partition(" ")
+    # ○/× の後ろは直接搬入可否の列と、ページ末尾の品目名の一覧
+    method = re.split(r"[○×]", method)[0].strip().lstrip("-").strip()
+    # 区分の後ろに次の行の品目や注意書きが続いている（「燃やさないごみ枝」など）行は区切りを誤っている
+    if not _CATEGORY_VALUE_RE.fullmatch(category):
+        return None
+    if not item or any(word in item for word in HEADER_WORDS) or _CATEGORY_SEARCH_RE.search(item):
+        return None
+    return {"item": item, "category": category, "disposal_method": method, "schedule": ""}
+
+
+def page_item_names(text):
+    """柏市の早見表のように、品目列が行と離れてページ末尾にまとめて取り出されたときの品目名の一覧。
+
+    行が ○/× で終わる形式のページでなければ None（品目名は行の中にある）。
+    """
+    lines = text.splitlines()
+    if sum(1 for line in lines if ROW_TERMINATOR_RE.search(line)) < TableAwareSplitter.MIN_ROWS:
+        return None
+    names = set()
+    for line in lines:
+        # 品目名の一覧はページ最後の行の ○/× の直後から始まる
+        name = unicodedata.normalize("NFKC", re.split(r"[○×]", line)[-1]).strip()
+        if (not name or len(name) > 25 or name.isdigit() or _HALFWIDTH_KANA_RE.search(line)
+                or _CATEGORY_SEARCH_RE.search(name) or any(word in name for word in HEADER_WORDS)):
+            continue
+        names.add(name)
+    return names
+
+
+def resolve_item_name(item, names):
+    """読み方（カタカナ）しか無い品目を、同じページの品目列にある名前に置き換える。分からなければ None
+
+    漢字の品目名は読み方から決められないので、読み方が品目名と同じ（カタカナ・ひらがなの品目）場合だけ分かる。
+    残りの語（「金属製」など）は品目名の後ろに残す。
+    """
+    match = _READING_RE.search(item)
+    if not match:
+        return None
+    by_reading = {normalize_item(name): name for name in names}
+    rest = item[:match.start()].strip()
+    tokens = match.group(1).split()
+    # 読み方の前にカタカナの語（「アルミコーティング」など）があることもあるので、長い方から試す
+    for start in range(len(tokens)):
+        name = by_reading.get(normalize_item("".join(tokens[start:])))
+        if name:
+            return " ".join(part for part in (name, rest, " ".join(tokens[:start])) if part)
+    return None
+
+
+def rules_from_documents(documents, raw_dir):
+    """読み込んだ資料から早見表の行を取り出して品目ルールの一覧にする"""
+    splitter = TableAwareSplitter(fallback_splitter=_DiscardSplitter())
+    pages = {(doc.metadata.get("source", ""), doc.metadata.get("page")): doc.page_content for doc in documents}
+    page_names = {}
+    rules = []
+    for chunk in splitter.split_documents(documents):
+        if chunk.metadata.get("chunk_type") != "table_row":
+            continue
+        rule = parse_table_row(chunk.page_content)
+        if rule is None:
+            continue
+        source = chunk.metadata.get("source", "")
+        key = (source, chunk.metadata.get("page"))
+        if key not in page_names:
+            page_names[key] = page_item_names(pages.get(key, ""))
+        if page_names[key] is not None:
+            # ○/× で終わる形式の行には品目の読み方しか無いので、ページの品目列から名前を探す
+            rule["item"] = resolve_item_name(rule["item"], page_names[key])
+            if rule["item"] is None:
+                continue
+        rule["municipality"] = _municipality_of(source, raw_dir)
+        rule["source"] = os.path.basename(source)
+        rule["page"] = chunk.metadata.get("page")
+        rules.append(rule)
+    return rules
+
+
+def load_extracted_rules(processed_dir):
+    """main.py --extract で抽出済みの garbage_rules.json があれば読み込む"""
+    from .extractor import GarbageRule
+
+    path = os.path.join(processed_dir, EXTRACTED_RULES_FILENAME)
+    if not os.path.isfile(path):
+        return []
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {path}: {e}")
+        return []
+    rules = []
+    for entry in data:
+        try:
+            rule = GarbageRule(**entry).model_dump()
+        except Exception:
+            continue
+        rule["municipality"] = ""
+        rule["source"] = EXTRACTED_RULES_FILENAME
+        rule["page"] = None
+        rules.append(rule)
+    return rules
+
+
+def build_index(rules):
+    """正規化した品目名（と空白で区切った語）からルール番号への索引を作る"""
+    index = defaultdict(list)
+    for i, rule in enumerate(rules):
+        keys = {normalize_item(rule["item"])}
+        keys.update(normalize_item(word) for word in rule["item"].split() if len(word) >= 2)
+        for key in keys:
+            if key:
+                index[key].append(i)
+    return dict(sorted(index.items()))
+
+
+class RulesBundle:
+    """PWA向けの品目ルールバンドル。JSON本体とgzip圧縮版、ETagを持つ"""
+
+    def __init__(self, body):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        parsed = json.loads(body)
+        self.version = parsed["version"]
+        self.rule_count = len(parsed["rules"])
+        self.etag = f'"{self.version}"'
+
+    @classmethod
+    def build(cls, rules):
+        rules = sorted(rules, key=lambda r: (r["municipality"], normalize_item(r["item"]), r["category"]))
+        # 内容が同じなら同じバージョンになるよう、生成日時はハッシュに含めない
+        content = json.dumps({"rules": rules}, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        version = hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+        bundle = {
+            "format": BUNDLE_FORMAT,
+            "version": version,
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "municipalities": sorted({r["municipality"] for r in rules if r["municipality"]}),
+            "rules": rules,
+            "index": build_index(rules),
+        }
+        return cls(json.dumps(bundle, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def load(cls, processed_dir):
+        """保存済みのバンドルを読み込む。無い・壊れている・形式が古い場合は None"""
+        path = os.path.join(processed_dir, BUNDLE_FILENAME)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+            if json.loads(body).get("format") != BUNDLE_FORMAT:
+                return None
+            return cls(body)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not load rules bundle: {e}")
+            return None
+
+    def save(self, processed_dir):
+        """JSONとgzip版を書き出す（一時ファイルから置き換えるので読み込み途中の壊れたファイルは見えない）"""
+        os.makedirs(processed_dir, exist_ok=True)
+        path = os.path.join(processed_dir, BUNDLE_FILENAME)
+        for target, data in ((path, self.body), (path + ".gz", self.gzipped)):
+            tmp = target + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, target)
+        return path
+
+    def rules(self):
+        """バンドルに入っている品目ルールの一覧"""
+        return json.loads(self.body)["rules"]
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "rules": self.rule_count,
+            "bytes": len(self.body),
+            "gzip_bytes": len(self.gzipped),
+        }
+
+
+def publish_rules_bundle(documents, raw_dir, processed_dir):
+    """資料と抽出済みデータからバンドルを作って保存する（インジェストのたびに呼ぶ）"""
+    rules = rules_from_documents(documents, raw_dir) + load_extracted_rules(processed_dir)
+    bundle = RulesBundle.build(rules)
+    path = bundle.save(processed_dir)
+    print(f"Rules bundle {bundle.version}: {len(rules)} rules -> {path}")
+    return bundle
+
+
+def update_rules_bundle(bundle, documents, sources, raw_dir, processed_dir):
+    """変更されたファイル（メタデータの source）のルールだけを入れ替えて保存する（ファイル監視・アップロード用）
+
+    documents は変更されたファイルを読み込んだもの。削除されたファイルは sources にだけ含めればルールが消える。
+    ほかのファイルは解析し直さない。
+    """
+    replaced = {(_municipality_of(source, raw_dir), os.path.basename(source)) for source in sources}
+    kept = [rule for rule in bundle.rules() if (rule["municipality"], rule["source"]) not in replaced]
+    rules = kept + rules_from_documents(documents, raw_dir)
+    bundle = RulesBundle.build(rules)
+    path = bundle.save(processed_dir)
+    print(f"Rules bundle {bundle.version}: {len(rules)} rules ({len(sources)} file(s) updated) -> {path}")
+    return bundle
@@ -0,0 +1,120 @@
+import re
+import unicodedata
+from collections import defaultdict
+from langchain_core.documents import Document
+
+# 分別区分を表す語（表の「区分」列）。行の途中にあれば品目行とみなす
+CATEGORY_WORDS = (
+    r"((?:市では処理できない|収集できない|燃やさない|燃やす|有害危険|可燃|不燃|粗大|資源|危険|有害)ごみ"
+    r"|資源品|容器包装プラスチック類|家電リサイクル法対象品|小型家電)"
+)
+CATEGORY_RE = re.compile(r"(?:^|\s|(?<=[ｦ-ﾟ）)]))" + CATEGORY_WORDS)
+# 柏市の早見表のように、行末が「直接搬入可否」の ○/× で終わる形式
+ROW_TERMINATOR_RE = re.compile(r"[○×]\s*[○×]\s*$")
+HEADER_WORDS = ("品目", "区分", "分別", "出し方", "注意", "備考", "読み方", "可否", "収集日")
+INDEX_LINE_RE = re.compile(r"^[ぁ-ゖ]{1,2}$")
+
+
+class TableAwareSplitter:
+    """早見表のような表形式のページを、1行（1品目）ずつの小さなチャンクに分割する。
+
+    各チャンクには表の列見出しを付けて文脈を保つ。表と判定できなかったページは
+    fallback_splitter（通常の再帰的分割）に回す。
+    """
+
+    MIN_ROWS = 5
+
+    def __init__(self, fallback_splitter, max_row_chars=400, min_rows=MIN_ROWS, min_row_ratio=0.3):
+        self.fallback_splitter = fallback_splitter
+        self.max_row_chars = max_row_chars
+        self.min_rows = min_rows
+        self.min_row_ratio = min_row_ratio
+
+    @staticmethod
+    def _lines(text):
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    @staticmethod
+    def _is_header(line):
+        return sum(word in line for word in HEADER_WORDS) >= 2
+
+    def _find_headers(self, documents):
+        """ファイルごとに最初に見つかった列見出しの行を返す（見出しは先頭ページにしかないことが多い）"""
+        headers = {}
+        for doc in documents:
+            source = doc.metadata.get("source", "")
+            if source in headers:
+                continue
+            for line in self._lines(doc.page_content):
+                if self._is_header(line) and not CATEGORY_RE.search(line):
+                    headers[source] = unicodedata.normalize("NFKC", line)
+                    break
+        return headers
+
+    def _is_table_page(self, lines):
+        rows = sum(1 for line in lines if CATEGORY_RE.search(line) or ROW_TERMINATOR_RE.search(line))
+        return rows >= self.min_rows and rows / len(lines) >= self.min_row_ratio
+
+    def _group_rows(self, lines):
+        """行を品目ごとにまとめる。折り返された注意書きは直前の品目に連結する"""
+        terminated = sum(1 for line in lines if ROW_TERMINATOR_RE.search(line)) >= self.min_rows
+        rows, current, preamble = [], [], []
+        for line in lines:
+            if "早見表" in line or self._is_header(line) or INDEX_LINE_RE.match(line):
+                continue
+            if terminated:
+                # 行末の ○/× までを1品目とする
+                current.append(line)
+                if ROW_TERMINATOR_RE.search(line):
+                    rows.append(current)
+                    current = []
+            elif CATEGORY_RE.search(line):
+                current = [line]
+                rows.append(current)
+            elif rows:
+                rows[-1].append(line)
+            else:
+                preamble.append(line)
+        if current and terminated:
+            rows.append(current)
+        return rows, preamble
+
+    def _row_document(self, text, doc, header, row_index):
+        metadata = dict(doc.metadata)
+        metadata["chunk_type"] = "table_row"
+        metadata["row"] = row_index
+        if header:
+            metadata["columns"] = header
+        content = f"[{header}] {text}" if header else text
+        return Document(page_content=content, metadata=metadata)
+
+    def split_documents(self, documents):
+        headers = self._find_headers(documents)
+        chunks = []
+        fallback_docs = []
+        row_counts = defaultdict(int)
+        for doc in documents:
+            lines = self._lines(doc.page_content)
+            if not lines or not self._is_table_page(lines):
+                fallback_docs.append(doc)
+                continue
+
+            source = doc.metadata.get("source", "")
+            header = headers.get(source)
+            rows, preamble = self._group_rows(lines)
+            # 表の前の日付・注記など、ある程度まとまった文章だけを残す
+            if sum(len(line) for line in preamble) >= 20:
+                fallback_docs.append(Document(page_content="\n".join(preamble), metadata=dict(doc.metadata)))
+            for row in rows:
+                # 半角カナ（品目の読み方）を全角にそろえてキーワード検索に掛かりやすくする
+                text = unicodedata.normalize("NFKC", " ".join(row))
+                if len(text) > self.max_row_chars:
+                    # 行の区切りを誤った可能性が高いので通常の分割に任せる
+                    fallback_docs.append(Document(page_content="\n".join(row), metadata=dict(doc.metadata)))
+                    continue
+                chunks.append(self._row_document(text, doc, header, row_counts[source]))
+                row_counts[source] += 1
+
+        if fallback_docs:
+            chunks.extend(self.fallback_splitter.split_documents(fallback_docs))
+        return chunks
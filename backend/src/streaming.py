@@ -0,0 +1,103 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import threading
+import time
+
+_DONE = object()
+
+
+class _StreamError:
+    """ワーカースレッド内で発生した例外を呼び出し側に受け渡すための入れ物"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def sse_event(payload):
+    """辞書をSSEフレーム文字列に変換する"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+class TokenCoalescer:
+    """トークンを時間窓・サイズ窓でまとめ、SSEフレーム数とJSONエンコード回数を減らす"""
+
+    def __init__(self, window_ms=30, max_chars=256):
+        self.window = window_ms / 1000
+        self.max_chars = max_chars
+        self._parts = []
+        self._size = 0
+        self._last_flush = 0.0  # 最初のトークンは即座に送出する（TTFTを悪化させない）
+
+    def add(self, token):
+        """トークンを追加し、送出すべきときはまとめた文字列を返す（それ以外はNone）"""
+        self._parts.append(token)
+        self._size += len(token)
+        now = time.monotonic()
+        if self._size >= self.max_chars or now - self._last_flush >= self.window:
+            return self.flush(now)
+        return None
+
+    def flush(self, now=None):
+        """溜まっているトークンをまとめて返す（空ならNone）"""
+        if not self._parts:
+            return None
+        text = "".join(self._parts)
+        self._parts.clear()
+        self._size = 0
+        self._last_flush = now if now is not None else time.monotonic()
+        return text
+
+
+async def iterate_in_thread(make_iterator, max_buffer=64):
+    """同期イテレータを専用スレッドで実行し、要素を非同期に返す。
+
+    バッファが満杯になるとワーカーは待機する（バックプレッシャー）。
+    呼び出し側が反復を打ち切るとワーカーはイテレータを close() し、上流のLLMストリームも停止する。
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max_buffer)
+    cancelled = threading.Event()
+
+    def put(item):
+        if cancelled.is_set():
+            return False
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=0.1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if cancelled.is_set():
+                    future.cancel()
+                    return False
+
+    def worker():
+        iterator = None
+        try:
+            iterator = iter(make_iterator())
+            for item in iterator:
+                if not put(item):
+                    break
+        except Exception as e:
+            put(_StreamError(e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+            put(_DONE)
+
+    # 呼び出し元のコンテキスト（リクエストのトレースなど）をワーカーに引き継ぐ
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(worker,), name="stream-worker", daemon=True).start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StreamError):
+                raise item.error
+            yield item
+    finally:
+        cancelled.set()
@@ -0,0 +1,10 @@
+import re
+
+_JA_CHARS = re.compile(r'[\u3000-\u9fff\uf900-\ufaff]')
+
+
+def estimate_tokens(text):
+    """Rough token count: ~1.5 chars per token for Japanese, ~4 chars for ASCII."""
+    ja_chars = len(_JA_CHARS.findall(text))
+    ascii_chars = len(text) - ja_chars
+    return int(ja_chars / 1.5 + ascii_chars / 4)
@@ -0,0 +1,233 @@
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# 現在のリクエストのトレースと、その中で開いているスパン（トレース無効時は None）
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# クライアントが送ってきたリクエストIDは、ログに書いても安全な形のときだけ引き継ぐ
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+# cProfile は同時に1つしか有効にできない環境がある（Python 3.12以降）ので1件ずつ
+_profile_lock = threading.Lock()
+
+
+class Span:
+    """処理区間1つ分の計測結果"""
+
+    __slots__ = ("name", "attributes", "start", "end", "children", "error")
+
+    def __init__(self, name, attributes=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.start = time.perf_counter()
+        self.end = None
+        self.children = []
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self, origin):
+        end = self.end if self.end is not None else time.perf_counter()
+        data = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 2),
+            "duration_ms": round((end - self.start) * 1000, 2),
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in list(self.children)]
+        return data
+
+
+class Trace:
+    """1リクエスト分のスパンツリー"""
+
+    def __init__(self, request_id, name, force=False, profile=False):
+        self.request_id = request_id
+        self.started_at = time.time()
+        self.root = Span(name)
+        self.force = force
+        self.profile = profile
+        self.profile_result = None
+        self.profiler = None
+
+    @property
+    def duration_ms(self):
+        end = self.root.end if self.root.end is not None else time.perf_counter()
+        return (end - self.root.start) * 1000
+
+    def to_dict(self):
+        data = {
+            "request_id": self.request_id,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started_at)),
+            "duration_ms": round(self.duration_ms, 2),
+            "root": self.root.to_dict(self.root.start),
+        }
+        if self.profile_result:
+            data["profile"] = self.profile_result
+        return data
+
+
+def new_request_id(incoming=None):
+    """リクエストIDを決める（妥当なものが送られてきたらそれを使う）"""
+    if incoming and _REQUEST_ID_RE.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """現在のスパンの子として処理区間を計測する。トレースが無効なら何もしない"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, attributes)
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except GeneratorExit:
+        # ストリームが途中で閉じられた（クライアント切断など）
+        child.attributes["cancelled"] = True
+        raise
+    except Exception as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def annotate(**attributes):
+    """現在のスパンに属性を追加する（トレース無効時は何もしない）"""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def in_context(fn):
+    """別スレッドで実行する関数に、現在のトレースを引き継がせる（呼び出し1回分）"""
+    return functools.partial(contextvars.copy_context().run, fn)
+
+
+@contextmanager
+def maybe_profile(top_n=25):
+    """プロファイル指定のリクエストなら、このブロックを実行するスレッドを cProfile で計測する"""
+    trace = _current_trace.get()
+    if trace is None or not trace.profile:
+        yield
+        return
+    if not _profile_lock.acquire(blocking=False):
+        annotate(profile_skipped="another request is being profiled")
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(top_n)
+        trace.profile_result = {"thread": threading.current_thread().name, "stats": out.getvalue()}
+        trace.profiler = profiler
+    finally:
+        _profile_lock.release()
+
+
+def profile_iterator(iterator):
+    """ストリーミング生成をワーカースレッド内でまるごとプロファイルする"""
+    with maybe_profile():
+        yield from iterator
+
+
+class TraceRecorder:
+    """遅いリクエストのトレースを追記専用のJSONLに書き出す"""
+
+    def __init__(self, enabled=False, log_path="data/traces/slow_traces.jsonl", slow_ms=5000,
+                 sample_rate=1.0, allow_profile=False, profile_dir=None):
+        self.enabled = enabled
+        self.log_path = log_path
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.allow_profile = allow_profile
+        self.profile_dir = profile_dir or os.path.join(os.path.dirname(log_path) or ".", "profiles")
+        self._lock = threading.Lock()
+        self.traced = 0
+        self.written = 0
+
+    def start(self, request_id, name, headers):
+        """トレースを開始する。無効なら None"""
+        if not self.enabled:
+            return None
+        # X-Trace: 1 なら速さに関係なく書き出す。X-Profile: 1 は許可されているときだけ
+        force = headers.get(b"x-trace", b"") in (b"1", b"true")
+        profile = self.allow_profile and headers.get(b"x-profile", b"") in (b"1", b"true")
+        self.traced += 1
+        return Trace(request_id, name, force=force or profile, profile=profile)
+
+    def activate(self, trace):
+        """トレースを現在のコンテキストに設定する。戻り値は deactivate に渡す"""
+        return _current_trace.set(trace), _current_span.set(trace.root)
+
+    def deactivate(self, tokens):
+        trace_token, span_token = tokens
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+    def finish(self, trace):
+        """トレースを閉じ、遅ければ（またはサンプリングに当たれば）書き出す"""
+        trace.root.end = time.perf_counter()
+        if not trace.force:
+            if trace.duration_ms < self.slow_ms or random.random() >= self.sample_rate:
+                return False
+        if trace.profile_result:
+            self._save_profile(trace)
+        line = json.dumps(trace.to_dict(), ensure_ascii=False)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.written += 1
+        return True
+
+    def _save_profile(self, trace):
+        """snakeviz などで開けるよう、生の統計も .prof として保存する"""
+        if trace.profiler is None:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"{trace.request_id}.prof")
+        trace.profiler.dump_stats(path)
+        trace.profile_result["path"] = path
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "slow_ms": self.slow_ms,
+            "sample_rate": self.sample_rate,
+            "traced": self.traced,
+            "written": self.written,
+            "log_path": self.log_path,
+        }
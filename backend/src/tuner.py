@@ -0,0 +1,243 @@
+import hashlib
+import itertools
+import json
+import os
+import statistics
+import time
+import unicodedata
+
+from langchain_core.embeddings import Embeddings
+
+from .config import Config
+from .tokens import estimate_tokens
+
+# 掃引するパラメータ。チャンク分割はインデックスの作り直しが必要なので組み合わせの外側に置く
+DEFAULT_GRID = {
+    "chunking": [
+        {"chunk_strategy": "recursive", "chunk_size": 800, "chunk_overlap": 150},
+        {"chunk_strategy": "recursive", "chunk_size": 1500, "chunk_overlap": 300},
+        {"chunk_strategy": "recursive", "chunk_size": 2000, "chunk_overlap": 400},
+        {"chunk_strategy": "table", "chunk_size": 1500, "chunk_overlap": 300},
+    ],
+    "k": [4, 6, 8],
+    "weights": [[0.6, 0.4], [0.5, 0.5], [0.3, 0.7]],
+    "max_context_tokens": [1500, 2500, 4000],
+}
+
+# パレート比較に使う指標（True: 大きいほど良い）
+OBJECTIVES = {
+    "context_recall": True,
+    "mrr": True,
+    "context_tokens": False,
+    "latency_p50_ms": False,
+}
+
+
+class CachedEmbeddings(Embeddings):
+    """同じテキストの埋め込みを掃引の間で使い回す（質問と、分割方法が違っても同じになるチャンク）"""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(text):
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        missing = list(dict.fromkeys(t for t in texts if self._key(t) not in self._cache))
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for text, vector in zip(missing, self.embeddings.embed_documents(missing)):
+                self._cache[self._key(text)] = vector
+        return [self._cache[self._key(t)] for t in texts]
+
+    def embed_query(self, text):
+        key = "query:" + self._key(text)
+        if key in self._cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._cache[key] = self.embeddings.embed_query(text)
+        return self._cache[key]
+
+
+def load_cases(path):
+    """ラベル付きの質問セットを読み込む。
+
+    形式: [{"query": "...", "expected_sources": ["file.pdf", ...], "expected_text": "品目名"}, ...]
+    expected_sources のファイルのチャンクで、expected_text（省略可）を含むものを正解とみなす。
+    """
+    with open(path, encoding="utf-8") as f:
+        cases = json.load(f)
+    for case in cases:
+        if not case.get("query") or not (case.get("expected_sources") or case.get("expected_text")):
+            raise ValueError(f"Each case needs a query and expected_sources or expected_text: {case}")
+    return cases
+
+
+def is_relevant(doc, case):
+    """検索結果のチャンクが質問の正解に当たるか"""
+    sources = case.get("expected_sources")
+    if sources and os.path.basename(doc.metadata.get("source", "")) not in sources:
+        return False
+    text = case.get("expected_text")
+    if text:
+        content = unicodedata.normalize("NFKC", doc.page_content)
+        texts = [text] if isinstance(text, str) else text
+        return any(unicodedata.normalize("NFKC", t) in content for t in texts)
+    return True
+
+
+def _percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def evaluate_point(retriever, cases, k, weights, max_context_tokens):
+    """1つのパラメータの組み合わせで全ケースを検索し、指標を計算する（LLMは呼ばない）"""
+    from .generator import build_context
+
+    hits, context_hits, reciprocal_ranks, tokens, latencies = 0, 0, [], [], []
+    for case in cases:
+        started = time.perf_counter()
+        # サーバーと同じく、RRFで統合した結果をそのままコンテキストの候補にする（k はレッグごとの件数）
+        docs = retriever.invoke(case["query"], k=k, weights=weights)
+        latencies.append((time.perf_counter() - started) * 1000)
+
+        rank = next((i for i, doc in enumerate(docs, start=1) if is_relevant(doc, case)), None)
+        hits += rank is not None
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+
+        context_text, used_docs = build_context(docs, max_context_tokens)
+        context_hits += any(is_relevant(doc, case) for doc in used_docs)
+        tokens.append(estimate_tokens(context_text))
+
+    n = len(cases)
+    return {
+        "recall_at_k": round(hits / n, 4),
+        "context_recall": round(context_hits / n, 4),
+        "mrr": round(sum(reciprocal_ranks) / n, 4),
+        "context_tokens": round(statistics.mean(tokens), 1),
+        "latency_p50_ms": round(statistics.median(latencies), 2),
+        "latency_p95_ms": round(_percentile(latencies, 0.95), 2),
+    }
+
+
+def _dominates(a, b):
+    """a が b をパレート支配するか（すべての指標で同等以上、かつどれかで真に良い）"""
+    better = False
+    for name, maximize in OBJECTIVES.items():
+        x, y = (a[name], b[name]) if maximize else (b[name], a[name])
+        if x < y:
+            return False
+        if x > y:
+            better = True
+    return better
+
+
+def pareto_front(points):
+    """どの点にも支配されない点の一覧"""
+    return [p for p in points if not any(_dominates(q, p) for q in points if q is not p)]
+
+
+def recommend(front, recall_tolerance=0.02):
+    """パレート集合から1つ選ぶ: 資料内の再現率が最良に近いものの中で、MRRが高く、トークンとレイテンシが小さいもの"""
+    best_recall = max(p["context_recall"] for p in front)
+    candidates = [p for p in front if p["context_recall"] >= best_recall - recall_tolerance]
+    return max(candidates, key=lambda p: (round(p["mrr"], 2), -p["context_tokens"], -p["latency_p50_ms"]))
+
+
+class RetrievalTuner:
+    """チャンク分割・k・重み・コンテキスト上限を掃引し、検索だけで品質とコストを測る"""
+
+    def __init__(self, cases, grid=None, raw_dir=None, embeddings=None):
+        self.config = Config()
+        self.cases = cases
+        self.grid = grid or DEFAULT_GRID
+        self.raw_dir = raw_dir or self.config.DATA_RAW_DIR
+        self._embeddings = embeddings
+
+    def _get_embeddings(self):
+        if self._embeddings is None:
+            from .vectorstore import VectorStoreManager
+            self._embeddings = CachedEmbeddings(VectorStoreManager().embeddings)
+        return self._embeddings
+
+    def _build_retriever(self, docs, chunking, index):
+        """チャンク分割の設定ごとにメモリ上のインデックスを作る（保存済みのDBには触れない）"""
+        from langchain_community.vectorstores import Chroma
+        from .loader import DocumentProcessor
+        from .vectorstore import VectorStoreManager
+
+        processor = DocumentProcessor(
+            chunk_size=chunking["chunk_size"],
+            chunk_overlap=chunking["chunk_overlap"],
+            strategy=chunking["chunk_strategy"]
+        )
+        chunks = processor.split_documents(docs)
+        embeddings = self._get_embeddings()
+        vectorstore = Chroma.from_documents(
+            documents=chunks,
+            embedding=embeddings,
+            collection_name=f"retrieval-tuning-{index}"
+        )
+        manager = VectorStoreManager(embeddings=embeddings)
+        return manager.build_hybrid_retriever(vectorstore, chunks), vectorstore, len(chunks)
+
+    def run(self):
+        from .loader import DocumentProcessor
+
+        docs = DocumentProcessor().load_documents(self.raw_dir)
+        if not docs:
+            raise ValueError(f"No documents found in {self.raw_dir}")
+
+        embeddings = self._get_embeddings()
+        # 質問の埋め込みは先に作っておく（初回だけ埋め込みが遅いとレイテンシの比較が歪む）
+        for case in self.cases:
+            embeddings.embed_query(case["query"])
+
+        points = []
+        for index, chunking in enumerate(self.grid["chunking"]):
+            print(f"[{index + 1}/{len(self.grid['chunking'])}] Building index for {chunking}...")
+            started = time.perf_counter()
+            retriever, vectorstore, chunk_count = self._build_retriever(docs, chunking, index)
+            build_sec = round(time.perf_counter() - started, 2)
+            try:
+                for k, weights, max_tokens in itertools.product(
+                    self.grid["k"], self.grid["weights"], self.grid["max_context_tokens"]
+                ):
+                    metrics = evaluate_point(retriever, self.cases, k, weights, max_tokens)
+                    params = dict(chunking, k=k, weights=weights, max_context_tokens=max_tokens)
+                    points.append(dict(params, chunks=chunk_count, index_build_sec=build_sec, **metrics))
+            finally:
+                vectorstore.delete_collection()
+
+        front = pareto_front(points)
+        best = recommend(front)
+        return {
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "cases": len(self.cases),
+            "embedding_cache": {"hits": embeddings.hits, "misses": embeddings.misses},
+            "objectives": OBJECTIVES,
+            "recommended": {
+                key: best[key]
+                for key in ("chunk_strategy", "chunk_size", "chunk_overlap", "k", "weights", "max_context_tokens")
+            },
+            "recommended_metrics": {key: best[key] for key in OBJECTIVES},
+            "pareto": front,
+            "points": points,
+        }
+
+
+def save_tuning(result, path):
+    """チューニング結果を書き出す（サーバーは起動時に recommended を読み込む）"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+    return path
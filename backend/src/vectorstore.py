@@ -1,51 +1,134 @@
 import os
+import time
+import uuid
 from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
-from langchain_ollama import OllamaEmbeddings
-from langchain_community.retrievers import BM25Retriever
-from langchain_classic.retrievers import EnsembleRetriever
 from .config import Config
 
+# 使用中のコレクション名を記録するファイル（無ければ Chroma の既定のコレクションを使う）
+ACTIVE_COLLECTION_FILE = "active_collection"
+DEFAULT_COLLECTION = Chroma._LANGCHAIN_DEFAULT_COLLECTION_NAME
+
 class VectorStoreManager:
-    def __init__(self):
+    def __init__(self, persist_directory=None, embeddings=None):
         self.config = Config()
-        self.embeddings = self._get_embeddings()
+        # 自治体ごとのパーティションでは保存先を分け、埋め込みクライアントは共有する
+        self.persist_directory = persist_directory or self.config.CHROMA_DB_DIR
+        self.embeddings = embeddings or self._get_embeddings()
 
     def _get_embeddings(self):
+        # 使用するバックエンドのクライアントだけをインポートする（起動時間短縮）
         if self.config.LLM_MODEL_TYPE == "openai":
-            return OpenAIEmbeddings(openai_api_key=self.config.OPENAI_API_KEY)
+            from langchain_openai import OpenAIEmbeddings
+            return OpenAIEmbeddings(
+                openai_api_key=self.config.OPENAI_API_KEY,
+                request_timeout=self.config.EMBEDDING_REQUEST_TIMEOUT
+            )
         else:
+            from langchain_ollama import OllamaEmbeddings
+            from .warmup import keep_alive_int
             return OllamaEmbeddings(
                 model=self.config.EMBEDDING_MODEL_NAME,
-                base_url=self.config.OLLAMA_BASE_URL
+                base_url=self.config.OLLAMA_BASE_URL,
+                keep_alive=keep_alive_int(self.config.OLLAMA_KEEP_ALIVE),
+                # 応答しないサーバーを待ち続けない（タイムアウトした検索レッグのスレッドを解放する）
+                client_kwargs={"timeout": self.config.EMBEDDING_REQUEST_TIMEOUT}
             )
 
+    def active_collection(self):
+        """使用中のコレクション名"""
+        try:
+            with open(os.path.join(self.persist_directory, ACTIVE_COLLECTION_FILE), encoding="utf-8") as f:
+                return f.read().strip() or DEFAULT_COLLECTION
+        except FileNotFoundError:
+            return DEFAULT_COLLECTION
+
     def create_vectorstore(self, chunks):
-        """チャンクからベクトルデータベースを作成する"""
+        """チャンクからベクトルデータベースを作成する
+
+        新しい名前のコレクションに作ってから使用中のコレクションを切り替える。作り直している間も
+        今のコレクションで検索できるよう、古いものは消さない（切り替え後に drop_stale_collections で消す）。
+        """
         print("Creating vector store...")
+        name = f"{DEFAULT_COLLECTION}-{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
         vectorstore = Chroma.from_documents(
             documents=chunks,
             embedding=self.embeddings,
-            persist_directory=self.config.CHROMA_DB_DIR
+            collection_name=name,
+            persist_directory=self.persist_directory
         )
-        print(f"Vector store created and saved to {self.config.CHROMA_DB_DIR}")
+        pointer = os.path.join(self.persist_directory, ACTIVE_COLLECTION_FILE)
+        with open(pointer + ".tmp", "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(pointer + ".tmp", pointer)
+        print(f"Vector store created and saved to {self.persist_directory} ({name})")
         return vectorstore
 
     def load_vectorstore(self):
         """既存のベクトルデータベースを読み込む"""
         return Chroma(
-            persist_directory=self.config.CHROMA_DB_DIR,
+            collection_name=self.active_collection(),
+            persist_directory=self.persist_directory,
             embedding_function=self.embeddings
         )
 
+    def load_chunks(self, vectorstore):
+        """保存済みのベクトルストアからチャンク（本文とメタデータ）を読み出す（資料を解析し直さずにBM25を作る）"""
+        from langchain_core.documents import Document
+
+        stored = vectorstore.get(include=["documents", "metadatas"])
+        chunks = []
+        for cid, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+            metadata = dict(metadata or {})
+            # replace_sources で追加したチャンクはIDがチャンクIDになっている
+            metadata.setdefault("chunk_id", cid)
+            chunks.append(Document(page_content=text or "", metadata=metadata))
+        return chunks
+
+    def drop_stale_collections(self):
+        """使用中以外のコレクション（作り直す前のもの・作成途中で失敗したもの）を消す"""
+        if not self.has_existing_vectorstore():
+            return []
+        active = self.active_collection()
+        try:
+            client = self.load_vectorstore()._client
+            # chromadb のバージョンによって名前かコレクションのどちらかが返る
+            names = [getattr(c, "name", c) for c in client.list_collections()]
+            stale = [name for name in names if name != active]
+            for name in stale:
+                client.delete_collection(name)
+        except Exception as e:
+            # 消せなくても検索には影響しない（次に作り直したときに消える）
+            print(f"⚠ Could not drop old collections: {e}")
+            return []
+        if stale:
+            print(f"Dropped {len(stale)} old collection(s) from {self.persist_directory}")
+        return stale
+
     def has_existing_vectorstore(self):
         """既存のベクトルデータベースが存在するか確認する"""
-        db_dir = self.config.CHROMA_DB_DIR
+        db_dir = self.persist_directory
         return os.path.exists(db_dir) and any(
             f.endswith('.sqlite3') or f.endswith('.bin') or f == 'chroma.sqlite3'
             for f in os.listdir(db_dir)
         ) if os.path.exists(db_dir) else False
 
+    def replace_sources(self, vectorstore, sources, new_chunks):
+        """指定したファイル（メタデータの source）のチャンクだけを置き換える。
+
+        新しいチャンクを先に追加してから古いチャンクを消すので、途中で失敗しても
+        そのファイルが検索から消えることはない（埋め込みに失敗した場合は何も変わらない）。
+        new_chunks に無い source のチャンクは消えるので、読み込めなかったファイルは sources に含めないこと。
+        """
+        old_ids = set(vectorstore.get(where={"source": {"$in": list(sources)}}, include=[])["ids"])
+        # 同じページに同じ内容のチャンクがあるとIDが重複するので1件にまとめる
+        unique = list({chunk.metadata["chunk_id"]: chunk for chunk in new_chunks}.values())
+        if unique:
+            vectorstore.add_documents(unique, ids=[chunk.metadata["chunk_id"] for chunk in unique])
+        stale = old_ids - {chunk.metadata["chunk_id"] for chunk in unique}
+        if stale:
+            vectorstore.delete(ids=list(stale))
+        return unique
+
     def get_hybrid_retriever(self, chunks, force_reingest=False):
         """ベクトル検索とキーワード検索（BM25）を組み合わせたハイブリッドリトリーバーを返す"""
         print("Initializing hybrid retriever...")
@@ -59,10 +142,10 @@ class VectorStoreManager:
                 vectorstore = self.load_vectorstore()
             else:
                 vectorstore = Chroma(
-                    persist_directory=self.config.CHROMA_DB_DIR,
+                    persist_directory=self.persist_directory,
                     embedding_function=self.embeddings
                 )
-            return vectorstore.as_retriever(search_kwargs={"k": 6})
+            return vectorstore.as_retriever(search_kwargs={"k": self.config.RETRIEVAL_K})
         
         # 既存のベクトルストアがあり、強制再取り込みでなければ再利用
         if self.has_existing_vectorstore() and not force_reingest:
@@ -71,15 +154,28 @@ class VectorStoreManager:
         else:
             vectorstore = self.create_vectorstore(chunks)
         
-        vector_retriever = vectorstore.as_retriever(search_kwargs={"k": 6})
-        
-        bm25_retriever = BM25Retriever.from_documents(chunks)
-        bm25_retriever.k = 6
+        return self.build_hybrid_retriever(vectorstore, chunks)
+
+    def build_hybrid_retriever(self, vectorstore, chunks):
+        """ベクトルストアとチャンクからハイブリッドリトリーバーを組み立てる（main.py --tune からも使う）
+
+        chunks は Document のリストか CompactChunks。リストなら詰め直すので、呼び出し側は手放してよい。
+        """
+        from .chunks import CompactChunks
+        from .retrievers import HybridRetriever, build_bm25_index
+
+        corpus = chunks if isinstance(chunks, CompactChunks) else CompactChunks(chunks)
         
-        # アンサンブル（重み付け：ベクトル 0.6, BM25 0.4 - セマンティック検索を優先）
-        ensemble_retriever = EnsembleRetriever(
-            retrievers=[vector_retriever, bm25_retriever],
-            weights=[0.6, 0.4]
+        # ハイブリッド（既定の重み：ベクトル 0.6, BM25 0.4 - セマンティック検索を優先）
+        # 2つの検索は並列に実行し、ベクトル側が遅い・失敗した場合はBM25のみで応答する
+        hybrid_retriever = HybridRetriever(
+            vectorstore=vectorstore,
+            corpus=corpus,
+            bm25_index=build_bm25_index(corpus),
+            k=self.config.RETRIEVAL_K,
+            weights=self.config.RETRIEVAL_WEIGHTS,
+            vector_timeout=self.config.RETRIEVAL_VECTOR_TIMEOUT,
+            bm25_timeout=self.config.RETRIEVAL_BM25_TIMEOUT
         )
         
-        return ensemble_retriever
+        return hybrid_retriever
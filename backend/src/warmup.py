@@ -0,0 +1,94 @@
+import re
+import threading
+import time
+from collections import deque
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(h|m|s|ms)")
+_DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+def parse_keep_alive(value):
+    """OLLAMA_KEEP_ALIVE の値をOllama APIに渡す形にする（数字だけなら秒数の整数）"""
+    if value is None or str(value).strip() == "":
+        return None
+    value = str(value).strip()
+    if value.lstrip("-").isdigit():
+        return int(value)
+    return value
+
+
+def keep_alive_int(value):
+    """keep_alive を秒数の整数にする（OllamaEmbeddings は "30m" のような文字列を受け付けない）。無期限は -1"""
+    seconds = keep_alive_seconds(value)
+    return -1 if seconds is None else int(seconds)
+
+
+def keep_alive_seconds(value):
+    """keep_alive の値を秒数にする。負の値（無期限）は None、解釈できなければ Ollama 既定の5分"""
+    value = parse_keep_alive(value)
+    if value is None:
+        return 300.0
+    if isinstance(value, int):
+        return None if value < 0 else float(value)
+    if value.startswith("-"):
+        return None
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return 300.0
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def model_key(llm):
+    """LLMインスタンスから「どのサーバーのどのモデルか」を表すキーを作る"""
+    name = getattr(llm, "model", None) or getattr(llm, "model_name", None) or type(llm).__name__
+    base_url = getattr(llm, "base_url", None) or ""
+    return f"{name}@{base_url}" if base_url else str(name)
+
+
+class TTFTTracker:
+    """モデルごとに最後の呼び出し時刻を覚えておき、最初のトークンまでの時間を cold/warm に分けて集計する。
+
+    プロセス起動後の初回呼び出しと、keep_alive を超えて間が空いた呼び出し（Ollamaがモデルを
+    解放している可能性が高い）を cold とみなす。
+    """
+
+    def __init__(self, keep_alive_sec=300.0, window=200):
+        self.keep_alive_sec = keep_alive_sec
+        self._last_used = {}
+        self._samples = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def is_cold(self, key):
+        """次の呼び出しがモデル読み込みを伴いそうかどうか"""
+        with self._lock:
+            last = self._last_used.get(key)
+        if last is None:
+            return True
+        return self.keep_alive_sec is not None and time.monotonic() - last > self.keep_alive_sec
+
+    def mark_warm(self, key):
+        """ウォームアップなどでモデルが読み込まれたことを記録する"""
+        with self._lock:
+            self._last_used[key] = time.monotonic()
+
+    def record(self, key, seconds, cold, kind="stream"):
+        """1回分の計測を記録する。kind は "stream"（最初のトークン）か "invoke"（応答全体）"""
+        bucket = f"{kind}_{'cold' if cold else 'warm'}"
+        with self._lock:
+            self._last_used[key] = time.monotonic()
+            self._samples.setdefault(bucket, deque(maxlen=self._window)).append(seconds)
+
+    def stats(self):
+        with self._lock:
+            buckets = {name: sorted(samples) for name, samples in self._samples.items()}
+            warm_models = len(self._last_used)
+        result = {"keep_alive_sec": self.keep_alive_sec, "models_seen": warm_models}
+        for name, samples in buckets.items():
+            result[name] = {
+                "count": len(samples),
+                "avg_ms": round(sum(samples) / len(samples) * 1000, 1),
+                "p50_ms": round(samples[len(samples) // 2] * 1000, 1),
+                "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 1),
+            }
+        return result
@@ -0,0 +1,201 @@
+import os
+import threading
+import time
+
+# 監視対象の拡張子（DocumentProcessor が読み込めるもの）
+WATCHED_EXTENSIONS = (".pdf", ".txt")
+
+
+def is_watched(path):
+    """取り込み対象のファイルか（コピー途中の一時ファイルや隠しファイルは除く）"""
+    name = os.path.basename(path)
+    return not name.startswith(".") and name.lower().endswith(WATCHED_EXTENSIONS)
+
+
+def file_state(path):
+    """(更新時刻, サイズ)。無ければ None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def snapshot(root):
+    """root 以下の対象ファイルの {パス: (更新時刻, サイズ)}（ポーリング用）"""
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not is_watched(path):
+                continue
+            state = file_state(path)
+            if state is not None:
+                files[path] = state
+    return files
+
+
+def diff_snapshots(before, after):
+    """2つのスナップショットの間で追加・変更・削除されたパス"""
+    changed = {path for path, state in after.items() if before.get(path) != state}
+    changed.update(path for path in before if path not in after)
+    return changed
+
+
+class RawDirWatcher:
+    """DATA_RAW_DIR をサブフォルダも含めて監視し、変更されたファイルをまとめて on_change に渡す。
+
+    inotify などのOSの通知が使えれば watchfiles で受け取り、使えない環境（watchfiles が無い、
+    Docker Desktop のバインドマウントなど）では一定間隔でディレクトリを走査する。
+    PDFのコピーなど連続した変更は、debounce_sec の間変更が途切れるまで待ってから1回にまとめる。
+    on_change は監視用のスレッドで1回ずつ順番に呼ばれる。結果の "failed" に入っていたパス
+    （読み込めなかったファイル）は、max_retries 回まで次のまとまりで取り込み直す。
+    """
+
+    def __init__(self, root, on_change, debounce_sec=5.0, poll_interval=5.0, force_polling=False,
+                 max_retries=3):
+        self.root = os.path.abspath(root)
+        self.on_change = on_change
+        self.debounce_sec = debounce_sec
+        self.poll_interval = poll_interval
+        self.force_polling = force_polling
+        self.mode = None  # "notify" または "polling"
+        self._pending = set()
+        self._indexed = {}  # 別の経路（アップロード）で取り込み済みのパス -> 取り込んだときの状態
+        self.max_retries = max_retries
+        self._retries = {}  # 読み込めなかったパス -> 再試行した回数
+        self._last_event = 0.0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self.batches = 0
+        self.failures = 0
+        self.retries = 0
+        self.last_batch = None
+
+    def start(self):
+        for target, name in ((self._watch, "raw-watcher"), (self._dispatch, "raw-watcher-dispatch")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def mark_indexed(self, paths):
+        """別の経路で取り込んだファイルを登録する。その後に変更されていなければ、通知が来ても取り込み直さない"""
+        with self._cond:
+            for path in paths:
+                path = os.path.abspath(path)
+                self._indexed[path] = file_state(path)
+
+    def _add(self, paths):
+        paths = {os.path.abspath(p) for p in paths if is_watched(p)}
+        if not paths:
+            return
+        with self._cond:
+            self._pending.update(paths)
+            # ファイルが変わったので再試行の回数は数え直す
+            for path in paths:
+                self._retries.pop(path, None)
+            self._last_event = time.monotonic()
+            self._cond.notify_all()
+
+    def _requeue(self, paths):
+        """読み込めなかったパスを次のまとまりに戻す（コピーが終わっていれば次は読み込める）"""
+        with self._cond:
+            for path in paths:
+                path = os.path.abspath(path)
+                count = self._retries.get(path, 0) + 1
+                if count > self.max_retries:
+                    # 壊れたままのファイルを読み続けないよう、次に変更されるまで諦める
+                    self._retries.pop(path, None)
+                    print(f"⚠ Giving up on {path} after {self.max_retries} retries; it will be retried when it changes.")
+                    continue
+                self._retries[path] = count
+                self._pending.add(path)
+                self.retries += 1
+            self._last_event = time.monotonic()
+            self._cond.notify_all()
+
+    def _watch(self):
+        """OSの通知で監視する。使えなければポーリングに切り替える"""
+        if not self.force_polling:
+            try:
+                from watchfiles import watch
+            except ImportError:
+                print("watchfiles is not installed; polling data/raw for changes.")
+            else:
+                try:
+                    self.mode = "notify"
+                    for changes in watch(self.root, stop_event=self._stop, recursive=True,
+                                         debounce=500, raise_interrupt=False):
+                        self._add(path for _, path in changes)
+                    return
+                except Exception as e:
+                    # inotify の監視数の上限・未対応のファイルシステムなど
+                    print(f"File notifications unavailable ({e}); polling data/raw for changes.")
+        self._poll()
+
+    def _poll(self):
+        self.mode = "polling"
+        before = snapshot(self.root)
+        while not self._stop.wait(self.poll_interval):
+            after = snapshot(self.root)
+            self._add(diff_snapshots(before, after))
+            before = after
+
+    def _dispatch(self):
+        """変更が debounce_sec の間途切れたら、溜まったパスをまとめて on_change に渡す"""
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._pending and not self._stop.is_set():
+                    self._cond.wait()
+                quiet = self._last_event + self.debounce_sec - time.monotonic()
+                if quiet > 0:
+                    self._cond.wait(quiet)
+                    continue
+                paths = sorted(
+                    path for path in self._pending
+                    if path not in self._indexed or self._indexed.pop(path) != file_state(path)
+                )
+                self._pending.clear()
+            if self._stop.is_set():
+                return
+            if not paths:
+                continue
+            self.batches += 1
+            self.last_batch = {"at": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "files": len(paths), "error": None}
+            try:
+                result = self.on_change(paths)
+            except Exception as e:
+                # 失敗しても監視は続ける（現在のインデックスはそのまま使われる）
+                self.failures += 1
+                self.last_batch["error"] = str(e)
+                print(f"⚠ Auto-ingest failed: {e}")
+                continue
+            failed = (result or {}).get("failed") or []
+            with self._cond:
+                for path in set(paths) - {os.path.abspath(p) for p in failed}:
+                    self._retries.pop(path, None)
+            if failed:
+                self.last_batch["failed"] = len(failed)
+                self._requeue(failed)
+
+    def stats(self):
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "root": self.root,
+            "mode": self.mode,
+            "debounce_sec": self.debounce_sec,
+            "pending": pending,
+            "batches": self.batches,
+            "failures": self.failures,
+            "retries": self.retries,
+            "last_batch": self.last_batch,
+        }
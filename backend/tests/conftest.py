@@ -0,0 +1,7 @@
+import os
+import sys
+
+# backend/ から実行しなくても app・src を読み込めるようにする
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+from src.admission import PRIORITY_BATCH, PRIORITY_INTERACTIVE, AdmissionController, AdmissionRejected
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_admits_up_to_the_limit_and_hands_over_on_release():
+    async def scenario():
+        controller = AdmissionController({"ollama": 1}, max_queue=4, max_wait_sec=5)
+        first = await controller.acquire("ollama", "ollama")
+        waiter = asyncio.create_task(controller.acquire("ollama", "ollama"))
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        assert controller.stats()["ollama"]["queue_depth"] == 1
+
+        first.release()
+        first.release()  # 2回目は何もしない
+        second = await asyncio.wait_for(waiter, 1)
+        stats = controller.stats()["ollama"]
+        assert stats["active"] == 1 and stats["queue_depth"] == 0 and stats["admitted"] == 2
+        second.release()
+        assert controller.stats()["ollama"]["active"] == 0
+
+    run(scenario())
+
+
+def test_interactive_requests_are_served_before_batch():
+    async def scenario():
+        controller = AdmissionController({"ollama": 1}, max_queue=4, max_wait_sec=5)
+        permit = await controller.acquire("ollama", "ollama")
+        order = []
+
+        async def wait(name, priority):
+            granted = await controller.acquire("ollama", "ollama", priority=priority)
+            order.append(name)
+            granted.release()
+
+        batch = asyncio.create_task(wait("batch", PRIORITY_BATCH))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(wait("interactive", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0.01)
+        permit.release()
+        await asyncio.wait_for(asyncio.gather(batch, interactive), 1)
+        assert order == ["interactive", "batch"]
+
+    run(scenario())
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        controller = AdmissionController({"ollama": 1}, max_queue=1, max_wait_sec=5)
+        permit = await controller.acquire("ollama", "ollama")
+        waiter = asyncio.create_task(controller.acquire("ollama", "ollama"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("ollama", "ollama")
+        assert rejected.value.status_code == 429
+        assert rejected.value.retry_after >= 1
+        assert controller.stats()["ollama"]["rejected"] == 1
+        permit.release()
+        (await waiter).release()
+
+    run(scenario())
+
+
+def test_waiting_too_long_is_rejected_with_503():
+    async def scenario():
+        controller = AdmissionController({"ollama": 1}, max_queue=4, max_wait_sec=0.1)
+        permit = await controller.acquire("ollama", "ollama")
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire("ollama", "ollama")
+        assert rejected.value.status_code == 503
+        stats = controller.stats()["ollama"]
+        assert stats["timed_out"] == 1 and stats["queue_depth"] == 0
+        # タイムアウトした待ち手には枠を渡さない
+        permit.release()
+        assert controller.stats()["ollama"]["active"] == 0
+
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_keep_a_slot():
+    async def scenario():
+        controller = AdmissionController({"ollama": 1}, max_queue=4, max_wait_sec=5)
+        permit = await controller.acquire("ollama", "ollama")
+        waiter = asyncio.create_task(controller.acquire("ollama", "ollama"))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        permit.release()
+        assert controller.stats()["ollama"]["active"] == 0
+
+    run(scenario())
+
+
+def test_backends_have_separate_limits():
+    async def scenario():
+        controller = AdmissionController({"ollama": 1, "openai": 2}, max_queue=0, max_wait_sec=5)
+        await controller.acquire("ollama", "ollama")
+        await controller.acquire("openai", "openai")
+        await controller.acquire("openai", "openai")
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire("openai", "openai")
+        # 同じ種別でも接続先が違えば別の枠
+        await controller.acquire("ollama@http://gpu-host:11434", "ollama")
+
+    run(scenario())
+
+
+def test_rejection_is_returned_with_retry_after():
+    import app
+
+    response = run(app.admission_rejected_handler(None, AdmissionRejected(429, "混雑しています。", 7)))
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
@@ -0,0 +1,113 @@
+from langchain_core.documents import Document
+
+from src.cache import TTLCache
+from src.chunks import SCORES_KEY, ChunkStore, CompactChunks, assign_chunk_ids
+from src.generator import RAGGenerator
+
+
+def make_docs(*texts, source="data/raw/a.txt"):
+    return assign_chunk_ids([Document(page_content=text, metadata={"source": source, "page": 0}) for text in texts])
+
+
+def test_compact_chunks_round_trip():
+    docs = make_docs("傘は不燃ごみ。", "電池は有害ごみ。")
+    corpus = CompactChunks(docs)
+    assert len(corpus) == 2
+    assert [corpus.document(i) for i in range(2)] == docs
+    assert corpus.index_of(docs[1].metadata["chunk_id"]) == 1
+
+
+def test_replace_sources_keeps_other_files():
+    corpus = CompactChunks(make_docs("a1", "a2") + make_docs("b1", source="data/raw/b.txt"))
+    replaced = corpus.replace_sources({"data/raw/a.txt"}, make_docs("a3"))
+    assert sorted(replaced.texts()) == ["a3", "b1"]
+
+
+def test_store_distinguishes_corpus_and_recent_chunks():
+    store = ChunkStore()
+    store.register_all(make_docs("傘は不燃ごみ。"))
+    corpus_id = store.corpus.chunk_id(0)
+    # 古いベクトルDBなど、コーパスに無いチャンクを返したとき
+    (old,) = make_docs("古い資料の本文", source="data/raw/old.txt")
+    recent_id = store.ref(old)["chunk_id"]
+
+    assert store.in_corpus(corpus_id)
+    assert not store.in_corpus(recent_id)
+    assert store.get(recent_id)["text"] == "古い資料の本文"
+    assert store.get("missing") is None
+
+
+def test_recent_chunks_are_bounded_by_bytes():
+    store = ChunkStore(max_recent_bytes=20_000)
+    docs = [make_docs(f"{i} " + "古い資料の本文" * 300, source=f"data/raw/old{i}.txt")[0] for i in range(10)]
+    ids = [store.ref(doc)["chunk_id"] for doc in docs]
+    stats = store.stats()
+    assert 0 < stats["recent"] < 10
+    assert stats["recent_bytes"] <= stats["max_recent_bytes"]
+    # 古いものから捨てる
+    assert store.get(ids[0]) is None
+    assert store.get(ids[-1])["text"] == docs[-1].page_content
+
+    # 上限より大きいチャンクでも、直近の1件は引ける
+    (huge,) = make_docs("大きな表" * 20_000, source="data/raw/huge.txt")
+    assert store.get(store.ref(huge)["chunk_id"])["text"] == huge.page_content
+    assert store.stats()["recent"] == 1
+
+
+def test_retrieval_cache_entries_hold_only_ids_and_scores():
+    store = ChunkStore()
+    corpus_docs = make_docs("傘は不燃ごみ。", "電池は有害ごみ。")
+    store.register_all(corpus_docs)
+    (old,) = make_docs("古い資料の本文", source="data/raw/old.txt")
+    results = [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in (corpus_docs[1], old)]
+    results[0].metadata[SCORES_KEY] = {"rrf": 0.5, "bm25": 3.0}
+
+    entry = store.cache_entry(results)
+    assert entry == [(corpus_docs[1].metadata["chunk_id"], {"rrf": 0.5, "bm25": 3.0}), (old.metadata["chunk_id"], None)]
+    assert store.resolve(entry) == results
+    # 作り直した Document を書き換えても、キャッシュのスコアは変わらない
+    store.resolve(entry)[0].metadata[SCORES_KEY]["rrf"] = 0.0
+    assert store.resolve(entry)[0].metadata[SCORES_KEY]["rrf"] == 0.5
+
+    # 引けなくなったチャンクがあれば、キャッシュは使わない
+    store.register_all(make_docs("傘は不燃ごみ。"))
+    assert store.resolve(entry) is None
+
+
+class RecordingCache(TTLCache):
+    def __init__(self):
+        super().__init__(max_entries=8, ttl_sec=60)
+        self.values = []
+
+    def set(self, key, value):
+        self.values.append(value)
+        super().set(key, value)
+
+
+class CountingRetriever:
+    def __init__(self, docs):
+        self.docs = docs
+        self.calls = 0
+
+    def invoke(self, query, **kwargs):
+        self.calls += 1
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in self.docs]
+
+
+def test_generator_caches_retrieval_results_by_chunk_id():
+    docs = make_docs("傘は不燃ごみ。", "電池は有害ごみ。")
+    store = ChunkStore()
+    store.register_all(docs)
+    retriever = CountingRetriever(docs)
+    generator = RAGGenerator(retriever=retriever, chunk_store=store, retrieval_cache=RecordingCache())
+
+    first = generator._retrieve("電池")
+    assert generator._retrieve("電池") == first
+    assert retriever.calls == 1
+    # キャッシュには本文を持たない
+    assert generator.retrieval_cache.values == [[(doc.metadata["chunk_id"], None) for doc in docs]]
+
+    # 再取り込みでチャンクが消えたら検索し直す
+    store.register_all(make_docs("傘は不燃ごみ。"))
+    generator._retrieve("電池")
+    assert retriever.calls == 2
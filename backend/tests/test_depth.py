@@ -0,0 +1,35 @@
+from langchain_core.documents import Document
+
+from src.chunks import DEGRADED_KEY, SCORES_KEY
+from src.depth import select_depth
+
+
+def scored(*scores):
+    return [Document(page_content=f"doc{i}", metadata={SCORES_KEY: s}) for i, s in enumerate(scores)]
+
+
+def test_cuts_at_min_relevance_and_keeps_bm25_matches():
+    docs = scored({"vector": 0.8, "bm25": 0.0}, {"vector": 0.75, "bm25": 2.0}, {"vector": 0.1, "bm25": 0.0})
+    selected, info = select_depth(docs, min_relevance=0.3, score_gap=0.2)
+    assert [doc.page_content for doc in selected] == ["doc0", "doc1"]
+    assert info["reason"] == "score_distribution"
+    assert info["vector"]["stop"] == "min_relevance"
+
+
+def test_nothing_relevant_returns_no_context():
+    docs = scored({"vector": 0.1, "bm25": 0.0}, {"vector": 0.05, "bm25": 0.0})
+    selected, info = select_depth(docs, min_relevance=0.3)
+    assert selected == []
+    assert info["reason"] == "no_relevant_context"
+
+
+def test_degraded_retrieval_falls_back_to_fixed_k():
+    # ベクトル検索がタイムアウトし、BM25のスコアしか無い（質問の語を含まず0ばかり）
+    docs = scored(*({"bm25": 0.0} for _ in range(4)))
+    for doc in docs:
+        doc.metadata[DEGRADED_KEY] = ["vector"]
+    selected, info = select_depth(docs, min_relevance=0.3)
+    assert selected == docs
+    assert info["reason"] == "degraded"
+    assert info["degraded"] == ["vector"]
+    assert info["depth"] == 4
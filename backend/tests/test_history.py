@@ -0,0 +1,65 @@
+from src.history import HistoryManager, clean_messages, compact_history, rewrite_retrieval_query
+
+
+def history_after(question, answer="資源ごみです。"):
+    return {"summary": "", "turns": [{"role": "user", "text": question}, {"role": "system", "text": answer}]}
+
+
+def test_short_question_on_a_new_topic_is_not_rewritten():
+    history = history_after("ペットボトルの出し方は？")
+    for query in ("スプレー缶は？", "電池の捨て方", "傘は何ごみ？"):
+        assert rewrite_retrieval_query(query, history) == query
+
+
+def test_follow_up_question_gets_the_previous_question():
+    history = history_after("ペットボトルの出し方は？")
+    assert rewrite_retrieval_query("それは何曜日？", history) == "ペットボトルの出し方は？ それは何曜日？"
+    assert rewrite_retrieval_query("じゃあキャップは？", history) == "ペットボトルの出し方は？ じゃあキャップは？"
+
+
+def test_no_history_is_not_rewritten():
+    assert rewrite_retrieval_query("それは何曜日？", None) == "それは何曜日？"
+    assert rewrite_retrieval_query("それは何曜日？", {"summary": "", "turns": []}) == "それは何曜日？"
+
+
+def test_clean_messages_drops_greeting_markup_and_current_query():
+    messages = [
+        {"role": "system", "text": "ようこそ"},
+        {"role": "user", "text": "電池は？"},
+        {"role": "system", "text": "<b>有害ごみ</b>です。"},
+        {"role": "user", "text": "それは何曜日？"},
+    ]
+    assert clean_messages(messages, "それは何曜日？") == [
+        {"role": "user", "text": "電池は？"},
+        {"role": "system", "text": "有害ごみ です。"},
+    ]
+
+
+def test_compact_history_folds_old_turns_into_summary():
+    turns = []
+    for i in range(4):
+        turns += [{"role": "user", "text": f"質問{i}"}, {"role": "system", "text": f"回答{i}です。補足。"}]
+    compacted = compact_history(turns, recent_turns=2)
+    assert compacted["turns"] == turns[-2:]
+    assert "Q: 質問0" in compacted["summary"] and "A: 回答0です。" in compacted["summary"]
+    assert "補足" not in compacted["summary"]
+
+
+def test_conversation_ids_are_issued_by_the_server():
+    manager = HistoryManager()
+    conversation_id, state = manager.get_history(None, None, "電池は？")
+    assert len(conversation_id) >= 20 and state["turns"] == []
+    manager.record_turn(conversation_id, "電池は？", "有害ごみです。")
+
+    same_id, state = manager.get_history(conversation_id, None, "それは何曜日？")
+    assert same_id == conversation_id
+    assert [m["text"] for m in state["turns"]] == ["電池は？", "有害ごみです。"]
+
+
+def test_unknown_conversation_id_is_not_used():
+    manager = HistoryManager()
+    # クライアントが勝手に決めたID（推測できる・他人と衝突する）には保存も読み出しもしない
+    conversation_id, state = manager.get_history("1712345678901", None, "電池は？")
+    assert conversation_id != "1712345678901"
+    assert state["turns"] == []
+    assert manager._store.get("1712345678901") is None
@@ -0,0 +1,79 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from src.images import ImagePreprocessor, ImageRejected
+from src.middleware import BodySizeLimitMiddleware
+
+
+def data_url(size, fmt="PNG", mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, size, (200, 100, 50) if mode == "RGB" else (200, 100, 50, 128)).save(buffer, format=fmt)
+    mime = "jpeg" if fmt == "JPEG" else fmt.lower()
+    return f"data:image/{mime};base64,{base64.b64encode(buffer.getvalue()).decode('ascii')}"
+
+
+def decode(url):
+    header, _, payload = url.partition(",")
+    return header, Image.open(io.BytesIO(base64.b64decode(payload)))
+
+
+def test_large_image_is_downscaled_to_jpeg():
+    result = ImagePreprocessor(max_side=256).process(data_url((2000, 1000), mode="RGBA"))
+    header, image = decode(result)
+    assert header == "data:image/jpeg;base64"
+    assert image.format == "JPEG" and image.mode == "RGB"
+    assert max(image.size) == 256
+
+
+def test_small_jpeg_is_passed_through():
+    url = data_url((100, 80), fmt="JPEG")
+    assert ImagePreprocessor(max_side=256).process(url) == url
+
+
+def test_results_are_cached_by_image_hash():
+    preprocessor = ImagePreprocessor(max_side=256)
+    url = data_url((600, 600))
+    first = preprocessor.process(url)
+    assert preprocessor.process(url) == first
+    assert preprocessor.stats()["hits"] == 1
+
+
+@pytest.mark.parametrize("url, status", [
+    ("not a data url", 400),
+    ("data:image/svg+xml;base64,PHN2Zz4=", 400),
+    ("data:image/png;base64," + base64.b64encode(b"not an image").decode("ascii"), 400),
+])
+def test_invalid_images_are_rejected(url, status):
+    with pytest.raises(ImageRejected) as rejected:
+        ImagePreprocessor().process(url)
+    assert rejected.value.status_code == status
+
+
+def test_oversized_payload_is_rejected_before_decoding():
+    with pytest.raises(ImageRejected) as rejected:
+        ImagePreprocessor(max_bytes=1024).process("data:image/png;base64," + "A" * 4096)
+    assert rejected.value.status_code == 413
+
+
+def test_body_size_limit_rejects_large_requests_with_413():
+    async def echo(request):
+        return PlainTextResponse(str(len(await request.body())))
+
+    app = BodySizeLimitMiddleware(Starlette(routes=[Route("/query", echo, methods=["POST"])]), max_bytes=1000)
+    client = TestClient(app)
+    assert client.post("/query", content=b"x" * 1000).text == "1000"
+    assert client.post("/query", content=b"x" * 1001).status_code == 413
+
+    def chunked():
+        for _ in range(10):
+            yield b"x" * 200
+
+    # Content-Length の無い（chunked）ボディも上限を超えた時点で拒否する
+    assert client.post("/query", content=chunked()).status_code == 413
@@ -0,0 +1,60 @@
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+
+from src.loader import DocumentProcessor
+from src.partitions import SHARED_PARTITION, PartitionedRetriever, PartitionManager
+
+
+class CountingProcessor(DocumentProcessor):
+    """資料を読み込んだ回数を数える"""
+
+    def __init__(self):
+        super().__init__(chunk_size=200, chunk_overlap=0, strategy="recursive")
+        self.loads = []
+
+    def load_documents(self, directory_path, recursive=True):
+        self.loads.append(directory_path)
+        return super().load_documents(directory_path, recursive=recursive)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    raw = tmp_path / "raw"
+    for name, text in (("柏市", "電池 は 有害ごみ です。"), ("流山市", "電池 は 燃やさないごみ です。")):
+        (raw / name).mkdir(parents=True)
+        (raw / name / "rules.txt").write_text(text, encoding="utf-8")
+    (raw / "common.txt").write_text("粗大ごみ は 予約制 です。", encoding="utf-8")
+    return PartitionManager(
+        raw_dir=str(raw), db_dir=str(tmp_path / "db"), max_resident=1,
+        processor=CountingProcessor(), embeddings=DeterministicFakeEmbedding(size=16)
+    )
+
+
+def test_evicted_partition_is_reloaded_from_the_vector_store(manager):
+    first = manager.get("柏市")
+    texts = sorted(first.corpus.texts())
+    manager.get("流山市")
+    assert manager.resident_partitions() == ["流山市"]
+    assert len(manager._get_processor().loads) == 2
+
+    # 追い出された後は保存済みのベクトルストアから読み込み、資料は解析し直さない
+    reloaded = manager.get("柏市")
+    assert len(manager._get_processor().loads) == 2
+    assert sorted(reloaded.corpus.texts()) == texts
+    assert manager.evictions == 2
+    assert reloaded.invoke("電池")[0].page_content == "電池 は 有害ごみ です。"
+
+
+def test_unknown_municipality_searches_resident_partitions_only(manager):
+    retriever = PartitionedRetriever(partition_manager=manager)
+    # 何も常駐していなければすべてを検索する
+    assert retriever._partitions_for(None) == ["柏市", "流山市", SHARED_PARTITION]
+
+    manager.get("流山市")
+    assert retriever._partitions_for(None) == ["流山市", SHARED_PARTITION]
+    assert retriever._partitions_for("千葉県柏市柏1丁目") == ["柏市", SHARED_PARTITION]
+
+    docs = retriever.invoke("電池")
+    assert {doc.page_content for doc in docs} >= {"電池 は 燃やさないごみ です。"}
+    # 自治体を指定しない質問で他の自治体を読み込まない
+    assert manager.loads == 2 and manager.resident_partitions() == [SHARED_PARTITION]
@@ -0,0 +1,42 @@
+import pytest
+from langchain_core.documents import Document
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from starlette.testclient import TestClient
+
+import app
+from src.chunks import ChunkStore, CompactChunks, assign_chunk_ids
+from src.generator import RAGGenerator
+from src.retrievers import HybridRetriever, build_bm25_index
+
+
+class FailingVectorStore:
+    """埋め込みサーバーに接続できない状態のベクトルストア"""
+
+    def similarity_search_with_relevance_scores(self, query, k):
+        raise ConnectionError("embedding server refused the connection")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    docs = assign_chunk_ids([
+        Document(page_content=text, metadata={"source": "data/raw/柏市/rules.txt", "page": 0})
+        for text in ("電池 は 有害ごみ です。", "傘 は 不燃ごみ です。")
+    ])
+    corpus = CompactChunks(docs)
+    retriever = HybridRetriever(vectorstore=FailingVectorStore(), corpus=corpus, bm25_index=build_bm25_index(corpus))
+    monkeypatch.setattr(RAGGenerator, "_get_llm", lambda self, override=None: FakeListChatModel(responses=["有害ごみです。"]))
+    generator = RAGGenerator(retriever=retriever, chunk_store=ChunkStore(), retrieval_cache=app.retrieval_cache)
+    monkeypatch.setattr(app, "generator", generator)
+    return TestClient(app.app)
+
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_query_with_a_failed_retrieval_leg(client, adaptive):
+    response = client.post("/query", json={"prompt": f"電池 ({adaptive})", "retrieval": {"adaptive": adaptive}})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["answer"] == "有害ごみです。"
+    # BM25だけで答え、失敗したレッグは検索の情報に載る（ソースごとのスコアには入れない）
+    assert body["retrieval"]["degraded"] == ["vector"]
+    assert body["sources"][0]["snippet"].startswith("電池")
+    assert set(body["sources"][0]["scores"]) == {"rrf", "bm25"}
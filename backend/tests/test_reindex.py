@@ -0,0 +1,143 @@
+import time
+
+import pytest
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from starlette.testclient import TestClient
+
+import app
+from src.chunks import ChunkStore
+from src.generator import RAGGenerator
+from src.loader import DocumentProcessor
+from src.rules_bundle import RulesBundle
+from src.vectorstore import VectorStoreManager
+
+
+def table(*rows):
+    return "\n".join(["品目 分別区分 処分時の注意", *rows, "空き缶 資源ごみ", "びん 資源ごみ", "ペットボトル 資源ごみ", "電球 燃やさないごみ"])
+
+
+def categories(item):
+    return sorted(rule["category"] for rule in app.rules_bundle.rules() if rule["item"] == item)
+
+
+@pytest.fixture
+def raw(tmp_path, monkeypatch):
+    """柏市と流山市の早見表（テキスト）を取り込んだ状態を作る"""
+    raw = tmp_path / "raw"
+    for name, row in (("柏市", "電池 有害危険ごみ"), ("流山市", "傘 燃やさないごみ")):
+        (raw / name).mkdir(parents=True)
+        (raw / name / "rules.txt").write_text(table(row), encoding="utf-8")
+    monkeypatch.setattr(app.Config, "DATA_RAW_DIR", str(raw))
+    monkeypatch.setattr(app.Config, "DATA_PROCESSED_DIR", str(tmp_path / "processed"))
+
+    processor = DocumentProcessor(chunk_size=200, chunk_overlap=0, strategy="recursive")
+    docs = processor.load_documents(str(raw))
+    chunks = processor.split_documents(docs)
+    manager = VectorStoreManager(persist_directory=str(tmp_path / "db"), embeddings=DeterministicFakeEmbedding(size=16))
+    corpus_store = ChunkStore()
+    corpus_store.register_all(chunks)
+    retriever = manager.build_hybrid_retriever(manager.create_vectorstore(chunks), corpus_store.corpus)
+    monkeypatch.setattr(app, "chunk_store", corpus_store)
+    monkeypatch.setattr(app, "partitions", None)
+    monkeypatch.setattr(app, "generator", RAGGenerator(retriever=retriever, chunk_store=corpus_store))
+    app._publish_rules_bundle(docs)
+
+    def load_documents(self, directory_path, recursive=True):
+        raise AssertionError(f"re-parsed the whole directory: {directory_path}")
+
+    # ここから先は変更されたファイルだけを読み込むこと
+    monkeypatch.setattr(DocumentProcessor, "load_documents", load_documents)
+    yield raw
+    app.rules_bundle = None
+
+
+def test_changed_file_updates_only_its_rules(raw):
+    assert categories("電池") == ["有害危険ごみ"] and categories("傘") == ["燃やさないごみ"]
+    (raw / "柏市" / "rules.txt").write_text(table("電池 有害ごみ"), encoding="utf-8")
+    result = app._reindex_files([str(raw / "柏市" / "rules.txt")])
+    assert result["failed"] == []
+    assert categories("電池") == ["有害ごみ"]
+    assert categories("傘") == ["燃やさないごみ"]
+    assert RulesBundle.load(app.Config.DATA_PROCESSED_DIR).version == app.rules_bundle.version
+
+
+def test_deleted_file_removes_its_rules(raw):
+    (raw / "流山市" / "rules.txt").unlink()
+    app._reindex_files([str(raw / "流山市" / "rules.txt")])
+    assert categories("傘") == []
+    assert categories("電池") == ["有害危険ごみ"]
+    assert app.rules_bundle.stats()["rules"] == 5
+
+
+def test_unreadable_file_keeps_its_rules(raw):
+    broken = raw / "流山市" / "rules.txt"
+    broken.write_bytes(b"\xff\xfe\x00broken")
+    (raw / "柏市" / "rules.txt").write_text(table("電池 有害ごみ"), encoding="utf-8")
+    result = app._reindex_files([str(broken), str(raw / "柏市" / "rules.txt")])
+    assert result["failed"] == [str(broken)]
+    # 読み込めなかったファイルのルールは消さない（ファイル監視が次の回に再試行する）
+    assert categories("傘") == ["燃やさないごみ"]
+    assert categories("電池") == ["有害ごみ"]
+
+
+@pytest.fixture
+def client(raw, monkeypatch):
+    monkeypatch.setattr(app.Config, "UPLOAD_TOKEN", "secret")
+    return TestClient(app.app, headers={"Authorization": "Bearer secret"})
+
+
+def upload(client, filename, content, municipality="柏市"):
+    return client.post("/documents", params={"filename": filename, "municipality": municipality}, content=content)
+
+
+def wait_for(client, response):
+    assert response.status_code == 202
+    for _ in range(100):
+        job = client.get(response.headers["location"]).json()
+        if job["status"] != "indexing":
+            return job
+        time.sleep(0.05)
+    raise AssertionError("upload was not ingested")
+
+
+def test_upload_updates_only_the_uploaded_file(client, raw):
+    job = wait_for(client, upload(client, "new.txt", table("鍋 燃やさないごみ").encode()))
+    assert job["status"] == "done" and job["path"] == "柏市/new.txt"
+    assert categories("鍋") == ["燃やさないごみ"]
+    assert categories("電池") == ["有害危険ごみ"] and categories("傘") == ["燃やさないごみ"]
+
+    # 同じ内容なら取り込み直さない
+    again = upload(client, "new.txt", table("鍋 燃やさないごみ").encode())
+    assert again.json()["status"] == "unchanged"
+
+
+def test_unreadable_upload_is_reported_and_keeps_the_bundle(client, raw):
+    version = app.rules_bundle.version
+    job = wait_for(client, upload(client, "broken.pdf", b"%PDF-1.7 not really a pdf"))
+    assert job["status"] == "error"
+    assert job["result"]["failed"] == [str(raw / "柏市" / "broken.pdf")]
+    assert app.rules_bundle.version == version
+
+
+@pytest.mark.parametrize("filename, municipality, content, status", [
+    ("../rules.txt", "柏市", b"x", 400),
+    ("rules.txt", "../柏市", b"x", 400),
+    ("rules.docx", "柏市", b"x", 415),
+    ("rules.pdf", "柏市", b"not a pdf", 415),
+    ("rules.txt", "柏市", b"", 400),
+    ("rules.txt", "柏市", b"x" * 101, 413),
+])
+def test_rejected_uploads(client, raw, monkeypatch, filename, municipality, content, status):
+    monkeypatch.setattr(app.Config, "UPLOAD_MAX_BYTES", 100)
+    version = app.rules_bundle.version
+    assert upload(client, filename, content, municipality).status_code == status
+    # 書き込み途中の一時ファイルも残さない
+    assert sorted(path.name for path in (raw / "柏市").iterdir()) == ["rules.txt"]
+    assert app.rules_bundle.version == version
+
+
+def test_upload_requires_the_token(client, monkeypatch):
+    response = client.post("/documents", params={"filename": "a.txt"}, content=b"x", headers={"Authorization": "Bearer wrong"})
+    assert response.status_code == 401
+    monkeypatch.setattr(app.Config, "UPLOAD_TOKEN", "")
+    assert upload(client, "a.txt", b"x").status_code == 403
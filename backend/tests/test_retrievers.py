@@ -0,0 +1,41 @@
+import threading
+
+from langchain_core.documents import Document
+
+from src.chunks import SCORES_KEY, CompactChunks, assign_chunk_ids
+from src.retrievers import HybridRetriever, build_bm25_index
+
+
+class HungVectorStore:
+    """埋め込みサーバーが応答しない状態のベクトルストア"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def similarity_search_with_relevance_scores(self, query, k):
+        self.release.wait(10)
+        return []
+
+
+def make_retriever(vectorstore, **kwargs):
+    docs = assign_chunk_ids([
+        Document(page_content=text, metadata={"source": "data/raw/a.txt", "page": 0})
+        for text in ("電池 は 有害ごみ", "傘 は 不燃ごみ", "ペットボトル は 資源ごみ")
+    ])
+    corpus = CompactChunks(docs)
+    options = dict(vector_timeout=0.05, bm25_timeout=1.0, k=2)
+    options.update(kwargs)
+    return HybridRetriever(vectorstore=vectorstore, corpus=corpus, bm25_index=build_bm25_index(corpus), **options)
+
+
+def test_hung_vector_leg_does_not_starve_bm25():
+    vectorstore = HungVectorStore()
+    retriever = make_retriever(vectorstore)
+    try:
+        # ベクトル側のスレッドがすべて止まっていても、BM25だけで答え続ける
+        for _ in range(12):
+            docs = retriever.invoke("電池")
+            assert docs[0].page_content == "電池 は 有害ごみ"
+            assert "vector" not in docs[0].metadata[SCORES_KEY]
+    finally:
+        vectorstore.release.set()
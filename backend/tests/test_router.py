@@ -0,0 +1,285 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from src import router as router_module
+from src.admission import AdmissionController
+from src.config import Config
+from src.router import BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN, BackendRouter, CircuitBreaker
+
+MESSAGES = ["hi"]
+
+
+class FakeBackend:
+    """テスト用のLLM。最初のトークンの前に待つ・失敗する、途中で失敗する、を指定できる"""
+
+    def __init__(self, model, tokens=("a", "b", "c"), first_token_delay=0.0, error_before=None, error_after=None):
+        self.model = model
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.error_before = error_before
+        self.error_after = error_after
+        self.release = threading.Event()  # 待っている呼び出しを先に進める
+        self.closed = threading.Event()  # ストリームが閉じられた（打ち切られた・終わった）
+
+    def stream(self, messages):
+        return self._generate()
+
+    def _generate(self):
+        try:
+            self.release.wait(self.first_token_delay)
+            if self.error_before:
+                raise self.error_before
+            for index, token in enumerate(self.tokens):
+                if self.error_after is not None and index == self.error_after:
+                    raise ConnectionError("connection reset")
+                yield SimpleNamespace(content=token)
+        finally:
+            self.closed.set()
+
+
+def make_router(**kwargs):
+    options = dict(ttft_deadline=0.1, first_token_timeout=2.0, failure_threshold=2, cooldown_sec=0.2)
+    options.update(kwargs)
+    return BackendRouter(**options)
+
+
+def test_fast_primary_wins_without_hedging():
+    router = make_router()
+    primary, secondary = FakeBackend("primary"), FakeBackend("secondary")
+    stream = router.stream([primary, secondary], MESSAGES)
+    assert "".join(stream) == "abc"
+    assert stream.backend == "primary"
+    assert not stream.hedged
+    assert router.stats()["hedges"] == 0
+
+
+def test_slow_first_token_hedges_and_cancels_the_loser():
+    router = make_router()
+    primary = FakeBackend("primary", tokens=("slow",), first_token_delay=5.0)
+    secondary = FakeBackend("secondary", tokens=("x", "y"))
+    stream = router.stream([primary, secondary], MESSAGES)
+    assert "".join(stream) == "xy"
+    assert stream.backend == "secondary"
+    assert stream.hedged
+    assert router.stats()["hedges"] == 1
+    assert router.stats()["wins"] == {"secondary": 1}
+
+    loser = next(attempt for attempt in stream._attempts if attempt.key == "primary")
+    assert loser.cancelled.is_set()
+    # 負けた呼び出しは最初のトークンが出た時点で打ち切られ、ストリームが閉じられる
+    primary.release.set()
+    assert primary.closed.wait(2)
+    # 締め切りを過ぎたバックエンドは失敗として数える
+    assert router.breaker("primary").failures == 1
+
+
+def test_error_before_first_token_falls_back_without_waiting_for_deadline():
+    router = make_router(ttft_deadline=5.0)
+    primary = FakeBackend("primary", error_before=ConnectionError("refused"))
+    secondary = FakeBackend("secondary", tokens=("ok",))
+    started = time.monotonic()
+    stream = router.stream([primary, secondary], MESSAGES)
+    assert "".join(stream) == "ok"
+    assert time.monotonic() - started < 1.0
+    assert stream.backend == "secondary"
+    assert not stream.hedged
+    assert stream.errors and stream.errors[0].startswith("primary:")
+    assert router.breaker("primary").failures == 1
+
+
+def test_error_mid_stream_is_raised_and_counted():
+    router = make_router()
+    primary = FakeBackend("primary", tokens=("a", "b", "c"), error_after=1)
+    secondary = FakeBackend("secondary")
+    stream = router.stream([primary, secondary], MESSAGES)
+    received = []
+    with pytest.raises(ConnectionError):
+        for token in stream:
+            received.append(token)
+    # 既にトークンを返しているので予備には切り替えない
+    assert received == ["a"]
+    assert stream.backend == "primary"
+    assert router.breaker("primary").failures == 1
+    assert router.breaker("secondary").failures == 0
+
+
+def test_all_backends_failing_raises():
+    router = make_router()
+    backends = [FakeBackend(name, error_before=ConnectionError("refused")) for name in ("primary", "secondary")]
+    with pytest.raises(RuntimeError, match="All LLM backends failed"):
+        list(router.stream(backends, MESSAGES))
+
+
+def test_first_token_timeout_gives_up():
+    router = make_router(first_token_timeout=0.3)
+    primary = FakeBackend("primary", first_token_delay=5.0)
+    with pytest.raises(TimeoutError):
+        list(router.stream([primary], MESSAGES))
+    primary.release.set()
+    assert primary.closed.wait(2)
+    assert router.breaker("primary").failures == 1
+
+
+def test_closing_the_stream_cancels_the_running_call():
+    router = make_router()
+    primary = FakeBackend("primary", tokens=("a",) * 100)
+    stream = router.stream([primary], MESSAGES)
+    assert next(stream) == "a"
+    stream.close()
+    assert primary.closed.wait(2)
+    assert all(attempt.cancelled.is_set() for attempt in stream._attempts)
+
+
+def test_breaker_skips_open_backend_and_half_opens_after_cooldown():
+    router = make_router(failure_threshold=2, cooldown_sec=0.3)
+    for _ in range(2):
+        primary = FakeBackend("primary", error_before=ConnectionError("refused"))
+        assert "".join(router.stream([primary, FakeBackend("secondary")], MESSAGES)) == "abc"
+    assert router.breaker("primary").state == BREAKER_OPEN
+
+    # 開いている間は呼ばれない
+    primary = FakeBackend("primary")
+    stream = router.stream([primary, FakeBackend("secondary")], MESSAGES)
+    assert "".join(stream) == "abc"
+    assert stream.backend == "secondary"
+    assert [attempt.key for attempt in stream._attempts] == ["secondary"]
+
+    # cooldown 後は1回だけ試し、成功すれば閉じる
+    time.sleep(0.35)
+    stream = router.stream([FakeBackend("primary"), FakeBackend("secondary")], MESSAGES)
+    assert router.breaker("primary").state == BREAKER_HALF_OPEN
+    assert "".join(stream) == "abc"
+    assert stream.backend == "primary"
+    assert router.breaker("primary").state == BREAKER_CLOSED
+
+
+def test_all_open_backends_are_still_tried():
+    router = make_router(failure_threshold=1, cooldown_sec=60)
+    router.breaker("primary").record_failure()
+    stream = router.stream([FakeBackend("primary")], MESSAGES)
+    assert "".join(stream) == "abc"
+    assert router.breaker("primary").state == BREAKER_CLOSED
+
+
+def test_circuit_breaker_states():
+    breaker = CircuitBreaker(failure_threshold=2, cooldown_sec=0.2)
+    breaker.record_failure()
+    assert breaker.state == BREAKER_CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN and not breaker.allow()
+
+    time.sleep(0.25)
+    assert breaker.allow()
+    assert breaker.state == BREAKER_HALF_OPEN
+    # 試しの1回の結果が出るまでは他を通さない
+    assert not breaker.allow()
+    # 試しが失敗したらすぐに開き直す
+    breaker.record_failure()
+    assert breaker.state == BREAKER_OPEN and not breaker.allow()
+
+    time.sleep(0.25)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == BREAKER_CLOSED and breaker.failures == 0
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def admission(monkeypatch):
+    monkeypatch.setattr(router_module, "ADMISSION_RETRY_SEC", 0.05)
+    return AdmissionController({"ollama": 1}, max_queue=4, max_wait_sec=5)
+
+
+def active(admission, backend):
+    return admission.stats()[backend]["active"]
+
+
+def test_hedge_waits_for_admission_capacity(admission):
+    router = make_router(admission=admission)
+    held = admission.try_acquire_nowait("ollama@gpu", "ollama")
+    primary = FakeBackend("primary", tokens=("slow",), first_token_delay=5.0)
+    secondary = FakeBackend("secondary", tokens=("x",))
+    stream = router.stream([primary, secondary], MESSAGES, [None, ("ollama@gpu", "ollama")])
+    received = []
+    consumer = threading.Thread(target=lambda: received.extend(stream))
+    consumer.start()
+
+    # 予備のバックエンドの枠が埋まっている間はヘッジしない
+    time.sleep(0.3)
+    assert [attempt.key for attempt in stream._attempts] == ["primary"]
+    assert router.stats()["admission_skips"] >= 1
+    held.release()
+    consumer.join(2)
+    assert received == ["x"] and stream.hedged and stream.backend == "secondary"
+    wait_until(lambda: active(admission, "ollama@gpu") == 0)
+    primary.release.set()
+
+
+def test_fallback_waits_for_admission_capacity(admission):
+    router = make_router(admission=admission, ttft_deadline=5.0)
+    held = admission.try_acquire_nowait("ollama@cpu", "ollama")
+    primary = FakeBackend("primary", error_before=ConnectionError("refused"))
+    stream = router.stream([primary, FakeBackend("secondary", tokens=("ok",))], MESSAGES, [None, ("ollama@cpu", "ollama")])
+    threading.Timer(0.2, held.release).start()
+    started = time.monotonic()
+    assert "".join(stream) == "ok"
+    assert time.monotonic() - started >= 0.2
+    assert stream.backend == "secondary"
+
+
+def test_hung_hedge_keeps_its_permit_until_the_call_ends(admission):
+    router = make_router(admission=admission)
+    primary = FakeBackend("primary", tokens=("a",), first_token_delay=0.3)
+    secondary = FakeBackend("secondary", tokens=("late",), first_token_delay=5.0)
+    stream = router.stream([primary, secondary], MESSAGES, [None, ("ollama@gpu", "ollama")])
+    assert "".join(stream) == "a"
+    assert stream.hedged and stream.backend == "primary"
+    # 打ち切っても上流の呼び出しが返るまではバックエンドを使っているので、枠を返さない
+    assert active(admission, "ollama@gpu") == 1
+    secondary.release.set()
+    assert secondary.closed.wait(2)
+    wait_until(lambda: active(admission, "ollama@gpu") == 0)
+
+
+def test_hedge_permits_are_taken_on_the_event_loop(admission):
+    async def scenario():
+        router = make_router(admission=admission)
+        permit = await admission.acquire("ollama", "ollama")
+        primary = FakeBackend("primary", tokens=("slow",), first_token_delay=5.0)
+        secondary = FakeBackend("secondary", tokens=("x",))
+        stream = router.stream([primary, secondary], MESSAGES, [None, ("ollama@gpu", "ollama")])
+        # ルーターはワーカースレッドで回る（イベントループ上の受付制御とはスレッドをまたいでやり取りする）
+        tokens = await asyncio.get_running_loop().run_in_executor(None, lambda: "".join(stream))
+        assert tokens == "x"
+        permit.release()
+        for _ in range(100):
+            if active(admission, "ollama@gpu") == 0:
+                break
+            await asyncio.sleep(0.01)
+        assert admission.stats()["ollama@gpu"]["admitted"] == 1
+        assert active(admission, "ollama") == 0 and active(admission, "ollama@gpu") == 0
+        primary.release.set()
+
+    asyncio.run(scenario())
+
+
+def test_llm_clients_have_request_timeouts():
+    from src.generator import RAGGenerator
+
+    # LLMクライアントを作るだけで、検索や生成はしない
+    generator = RAGGenerator.__new__(RAGGenerator)
+    generator.config = Config()
+    ollama = generator._get_llm({"type": "ollama", "name": "qwen2.5:3b"})
+    assert ollama.client_kwargs["timeout"] == Config.LLM_REQUEST_TIMEOUT
+    openai = generator._get_llm({"type": "openai", "name": "gpt-4o-mini", "address": "sk-test"})
+    assert openai.request_timeout == Config.LLM_REQUEST_TIMEOUT
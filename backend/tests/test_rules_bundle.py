@@ -0,0 +1,108 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+from langchain_core.documents import Document
+
+from src.loader import DocumentProcessor
+from src.rules_bundle import RulesBundle, normalize_item, parse_table_row, rules_from_documents, update_rules_bundle
+from src.splitters import CATEGORY_WORDS
+
+RAW_DIR = Path(__file__).resolve().parents[1] / "data" / "raw"
+CATEGORY_VALUE_RE = re.compile(rf"(?:{CATEGORY_WORDS})(?:\([^()]*\))?(?:,(?:{CATEGORY_WORDS})(?:\([^()]*\))?)*")
+
+
+@pytest.fixture(scope="module")
+def rules():
+    paths = [RAW_DIR / "流山市" / "R6_流山市ごみ早見表(50音順).pdf", RAW_DIR / "柏市" / "柏地域分別早見表(50音順).pdf"]
+    docs, failed = DocumentProcessor(strategy="table").load_files([str(path) for path in paths])
+    assert failed == []
+    return rules_from_documents(docs, str(RAW_DIR))
+
+
+def find(rules, municipality, item):
+    return [rule for rule in rules if rule["municipality"] == municipality and rule["item"] == item]
+
+
+def test_parse_table_row():
+    assert parse_table_row("[品目 分別区分 処分時の注意] アイスピック 有害危険ごみ 紙などで梱包してください。") == {
+        "item": "アイスピック", "category": "有害危険ごみ", "disposal_method": "紙などで梱包してください。", "schedule": "",
+    }
+    assert parse_table_row("アイロン 燃やさないごみ -")["disposal_method"] == ""
+    assert parse_table_row("傘 不燃ごみ,小型家電 ○ ×")["category"] == "不燃ごみ,小型家電"
+
+
+@pytest.mark.parametrize("row", [
+    # 区分の後ろに次の行の品目が続いている
+    "木の枝 燃やさないごみキーボード(楽器用)",
+    "自転車 粗大ごみ有料処分(引取・持込)、引取の場合4枚まで1点扱い。",
+    # 区分が2つ続いている（行の区切りを誤っている）
+    "ゲーム機 資源ごみ燃やさないごみ",
+    # 品目が列見出しの断片だけ
+    "区分 品目 燃やすごみ",
+    "燃やすごみ",
+])
+def test_rows_with_unknown_categories_are_dropped(row):
+    assert parse_table_row(row) is None
+
+
+def test_note_wrapped_from_the_previous_row_is_removed():
+    rule = parse_table_row("お近くのリサイクルステーションへお出しください。ぬいぐるみ 燃やさないごみ")
+    assert rule["item"] == "ぬいぐるみ"
+
+
+def test_real_table_rules_have_known_categories(rules):
+    assert {rule["municipality"] for rule in rules} == {"流山市", "柏市"}
+    assert all(CATEGORY_VALUE_RE.fullmatch(rule["category"]) for rule in rules)
+    assert all("○" not in rule["disposal_method"] and "×" not in rule["disposal_method"] for rule in rules)
+
+
+def test_real_table_rules(rules):
+    (battery,) = find(rules, "流山市", "乾電池")
+    assert battery["category"] == "有害危険ごみ"
+    assert battery["source"] == "R6_流山市ごみ早見表(50音順).pdf"
+    assert [rule["category"] for rule in find(rules, "流山市", "ボタン電池")] == ["市では処理できないごみ"]
+    # 柏市の表は行に読み方しか無いので、同じページの品目列にある名前に置き換える
+    assert [rule["category"] for rule in find(rules, "柏市", "ガスコンロ")] == ["資源品(金属類)"]
+    assert [rule["category"] for rule in find(rules, "柏市", "かご 金属製")] == ["資源品(金属類)"]
+
+
+def test_readings_without_a_known_item_name_are_dropped(rules):
+    kashiwa = [rule for rule in rules if rule["municipality"] == "柏市"]
+    items = {normalize_item(rule["item"]) for rule in kashiwa}
+    # 「傘」「鍋」は読み方（カサ・ナベ）からは漢字の品目名が分からない
+    assert not items & {"かさ", "なべ", "かっせいたん"}
+    assert not any(rule["item"].startswith(("北部", "南部")) for rule in kashiwa)
+
+
+def test_bundle_version_depends_only_on_the_rules(rules):
+    first, second = RulesBundle.build(rules), RulesBundle.build(list(reversed(rules)))
+    assert first.version == second.version and first.etag == f'"{first.version}"'
+    bundle = json.loads(first.body)
+    assert bundle["municipalities"] == ["柏市", "流山市"]
+    assert bundle["rules"][bundle["index"]["乾電池"][0]]["item"] == "乾電池"
+
+
+def table(*rows):
+    return "\n".join(["品目 分別区分 処分時の注意", *rows, "空き缶 資源ごみ", "びん 資源ごみ", "ペットボトル 資源ごみ", "電球 燃やさないごみ"])
+
+
+def test_update_replaces_only_the_changed_files(tmp_path):
+    raw = str(tmp_path / "raw")
+    docs = [
+        Document(page_content=table("電池 有害危険ごみ"), metadata={"source": f"{raw}/柏市/a.txt"}),
+        Document(page_content=table("傘 燃やさないごみ"), metadata={"source": f"{raw}/流山市/b.txt"}),
+        Document(page_content=table("鍋 燃やさないごみ"), metadata={"source": f"{raw}/流山市/c.txt"}),
+    ]
+    bundle = RulesBundle.build(rules_from_documents(docs, raw))
+
+    # a.txt は書き換え、c.txt は削除（読み込んだドキュメントは無い）。b.txt は読み直さない
+    changed = [Document(page_content=table("電池 有害ごみ"), metadata={"source": f"{raw}/柏市/a.txt"})]
+    updated = update_rules_bundle(bundle, changed, {f"{raw}/柏市/a.txt", f"{raw}/流山市/c.txt"}, raw, str(tmp_path / "processed"))
+    rules = updated.rules()
+    assert [rule["category"] for rule in find(rules, "柏市", "電池")] == ["有害ごみ"]
+    assert [rule["category"] for rule in find(rules, "流山市", "傘")] == ["燃やさないごみ"]
+    assert find(rules, "流山市", "鍋") == []
+    assert {rule["source"] for rule in rules} == {"a.txt", "b.txt"}
+    assert RulesBundle.load(str(tmp_path / "processed")).version == updated.version
@@ -0,0 +1,94 @@
+from pathlib import Path
+
+import pytest
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from src.loader import DocumentProcessor
+from src.splitters import TableAwareSplitter
+
+RAW_DIR = Path(__file__).resolve().parents[1] / "data" / "raw"
+NAGAREYAMA_TABLE = RAW_DIR / "流山市" / "R6_流山市ごみ早見表(50音順).pdf"
+KASHIWA_TABLE = RAW_DIR / "柏市" / "柏地域分別早見表(50音順).pdf"
+NAGAREYAMA_NOTICE = RAW_DIR / "流山市" / "流山市指定ゴミ袋導入.pdf"
+
+
+def make_splitter(**kwargs):
+    return TableAwareSplitter(RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=0), **kwargs)
+
+
+def split_pages(path, pages=2):
+    processor = DocumentProcessor(strategy="table")
+    docs, failed = processor.load_files([str(path)])
+    assert failed == []
+    return processor.text_splitter.split_documents(docs[:pages])
+
+
+@pytest.fixture(scope="module")
+def nagareyama_rows():
+    return split_pages(NAGAREYAMA_TABLE)
+
+
+def test_table_page_is_split_into_one_row_per_item(nagareyama_rows):
+    assert all(chunk.metadata["chunk_type"] == "table_row" for chunk in nagareyama_rows)
+    first = nagareyama_rows[0]
+    # 列見出しを付けて、1品目だけを持つ
+    assert first.page_content == "[品目 分別区分 処分時の注意] アイスノン 燃やさないごみ -"
+    assert first.metadata["columns"] == "品目 分別区分 処分時の注意"
+    assert first.metadata["source"].endswith("R6_流山市ごみ早見表(50音順).pdf")
+    assert [chunk.metadata["row"] for chunk in nagareyama_rows] == list(range(len(nagareyama_rows)))
+
+
+def test_rows_keep_their_notes(nagareyama_rows):
+    row = next(chunk for chunk in nagareyama_rows if "アイスピック" in chunk.page_content)
+    assert row.page_content.endswith("有害危険ごみ 紙などで梱包してください。")
+
+
+def test_rows_ending_with_circle_cross_columns():
+    # 柏市の早見表は行末の「直接搬入可否」（○/×）までが1品目
+    # この表の列見出しは2ページ目にしか無い（ファイル単位で探して全ページに付ける）
+    rows = split_pages(KASHIWA_TABLE)
+    assert rows and all(chunk.metadata["chunk_type"] == "table_row" for chunk in rows)
+    header = "[可否 区分 品目 読み方] "
+    # 折り返された品目名・読み方も含めて、行末の ○ × までが1つのチャンクになる。半角カナの読み方は全角にそろえる
+    assert [chunk.page_content for chunk in rows[:3]] == [
+        header + "北部 南部 卓上 アイエイチクッキン グヒーター不燃ごみ○ ×",
+        header + "ビルトイン アイエイチクッキン グヒーター資源品(金属類)○ ×",
+        header + "本体(ホルダー, チャージャー)アイコス 有害ごみ○ ×",
+    ]
+
+
+def test_non_table_pdf_falls_back_to_recursive_split():
+    chunks = split_pages(NAGAREYAMA_NOTICE)
+    assert chunks
+    assert all("chunk_type" not in chunk.metadata for chunk in chunks)
+
+
+def test_wrapped_lines_are_joined_to_the_previous_row():
+    text = "\n".join([
+        "品目 分別区分 処分時の注意",
+        "アイロン 燃やさないごみ",
+        "傘 燃やさないごみ 骨が金属のもの",
+        "は燃やさないごみへ",
+        "空き缶 資源ごみ",
+        "電池 有害危険ごみ",
+        "ペットボトル 資源ごみ",
+    ])
+    chunks = make_splitter().split_documents([Document(page_content=text, metadata={"source": "a.pdf", "page": 0})])
+    assert [chunk.page_content for chunk in chunks] == [
+        "[品目 分別区分 処分時の注意] アイロン 燃やさないごみ",
+        "[品目 分別区分 処分時の注意] 傘 燃やさないごみ 骨が金属のもの は燃やさないごみへ",
+        "[品目 分別区分 処分時の注意] 空き缶 資源ごみ",
+        "[品目 分別区分 処分時の注意] 電池 有害危険ごみ",
+        "[品目 分別区分 処分時の注意] ペットボトル 資源ごみ",
+    ]
+
+
+def test_overlong_row_goes_to_the_fallback_splitter():
+    lines = [f"品目{i} 資源ごみ" for i in range(5)] + ["長い注意書き" * 100]
+    doc = Document(page_content="\n".join(lines), metadata={"source": "a.pdf", "page": 0})
+    chunks = make_splitter(max_row_chars=100).split_documents([doc])
+    rows = [chunk for chunk in chunks if chunk.metadata.get("chunk_type") == "table_row"]
+    assert len(rows) == 4
+    assert len(chunks) > len(rows)
+    assert all(len(chunk.page_content) <= 200 for chunk in chunks)
@@ -0,0 +1,41 @@
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import app で読み込まれてはいけない重いモジュール（ウォームアップ中に遅延インポートする）
+HEAVY_MODULES = ("langchain_chroma", "chromadb", "pypdf", "langchain_community", "langchain_openai", "langchain_ollama")
+
+# import app にかかってよい時間（秒）。遅いCIでは STARTUP_IMPORT_BUDGET_SEC で緩められる
+IMPORT_BUDGET_SEC = float(os.getenv("STARTUP_IMPORT_BUDGET_SEC", "3"))
+
+SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import app
+print(json.dumps({
+    "seconds": time.perf_counter() - started,
+    "heavy": sorted(name for name in sys.modules if name.split(".")[0] in %r),
+}))
+""" % (HEAVY_MODULES,)
+
+
+def _import_app():
+    """別プロセスで import app して、かかった時間と読み込まれた重いモジュールを返す"""
+    env = dict(os.environ, MODEL_WARMUP="false", QUERY_LOG_ENABLED="false")
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT], cwd=BACKEND_DIR, env=env, capture_output=True, text=True, timeout=120
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_import_app_does_not_load_heavy_backends():
+    assert _import_app()["heavy"] == []
+
+
+def test_import_app_within_budget():
+    seconds = _import_app()["seconds"]
+    assert seconds < IMPORT_BUDGET_SEC, f"import app took {seconds:.2f}s (budget {IMPORT_BUDGET_SEC}s)"
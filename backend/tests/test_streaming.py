@@ -0,0 +1,91 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.streaming import iterate_in_thread
+
+
+class Upstream:
+    """テスト用の上流ストリーム。何件作ったか・閉じられたかを記録する"""
+
+    def __init__(self, count=None, error_at=None):
+        self.count = count
+        self.error_at = error_at
+        self.produced = 0
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        try:
+            while self.count is None or self.produced < self.count:
+                if self.error_at is not None and self.produced == self.error_at:
+                    raise ConnectionError("upstream failed")
+                self.produced += 1
+                yield self.produced
+        finally:
+            self.closed.set()
+
+
+def collect(make_iterator, limit=None, **kwargs):
+    async def run():
+        items = []
+        stream = iterate_in_thread(make_iterator, **kwargs)
+        try:
+            async for item in stream:
+                items.append(item)
+                if limit is not None and len(items) >= limit:
+                    break
+        finally:
+            await stream.aclose()
+        return items
+
+    return asyncio.run(run())
+
+
+def test_yields_all_items_in_order():
+    upstream = Upstream(count=5)
+    assert collect(lambda: iter(upstream)) == [1, 2, 3, 4, 5]
+    assert upstream.closed.wait(2)
+
+
+def test_stopping_early_closes_the_upstream_iterator():
+    upstream = Upstream()
+    assert collect(lambda: iter(upstream), limit=3, max_buffer=2) == [1, 2, 3]
+    # 打ち切った後、満杯のバッファで待っていたワーカーも上流を閉じて止まる
+    assert upstream.closed.wait(2)
+    produced = upstream.produced
+    time.sleep(0.3)
+    assert upstream.produced == produced
+
+
+def test_buffer_limits_how_far_the_worker_runs_ahead():
+    upstream = Upstream()
+
+    async def run():
+        stream = iterate_in_thread(lambda: iter(upstream), max_buffer=2)
+        first = await stream.__anext__()
+        # 読まずに待っても、ワーカーはバッファの分（と受け渡し中の1件）しか先に作らない
+        await asyncio.sleep(0.3)
+        produced = upstream.produced
+        await stream.aclose()
+        return first, produced
+
+    first, produced = asyncio.run(run())
+    assert first == 1
+    assert produced <= 1 + 2 + 1
+    assert upstream.closed.wait(2)
+
+
+def test_upstream_error_is_raised_to_the_caller():
+    upstream = Upstream(error_at=2)
+    items = []
+
+    async def run():
+        async for item in iterate_in_thread(lambda: iter(upstream)):
+            items.append(item)
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())
+    assert items == [1, 2]
+    assert upstream.closed.wait(2)
@@ -0,0 +1,10 @@
+from src.warmup import keep_alive_int, keep_alive_seconds, parse_keep_alive
+
+
+def test_keep_alive_values():
+    assert parse_keep_alive("30m") == "30m" and parse_keep_alive("600") == 600
+    assert keep_alive_seconds("1h30m") == 5400.0
+    assert keep_alive_seconds("-1") is None
+    # OllamaEmbeddings には整数で渡す
+    assert keep_alive_int("30m") == 1800
+    assert keep_alive_int("-1m") == -1
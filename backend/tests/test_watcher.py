@@ -0,0 +1,115 @@
+import os
+import queue
+
+import pytest
+
+from src.watcher import RawDirWatcher, diff_snapshots, snapshot
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+class Recorder:
+    """on_change の呼び出しを記録し、指定したパスを読み込めなかったことにする"""
+
+    def __init__(self, fail=(), error=None):
+        self.batches = queue.Queue()
+        self.fail = {os.path.abspath(path) for path in fail}
+        self.error = error
+
+    def __call__(self, paths):
+        self.batches.put(paths)
+        if self.error:
+            raise self.error
+        return {"failed": [path for path in paths if path in self.fail]}
+
+    def next(self, timeout=3):
+        return self.batches.get(timeout=timeout)
+
+
+@pytest.fixture
+def start(tmp_path):
+    watchers = []
+
+    def start(on_change, **kwargs):
+        options = dict(debounce_sec=0.05, poll_interval=0.05, force_polling=True)
+        options.update(kwargs)
+        watcher = RawDirWatcher(str(tmp_path), on_change, **options).start()
+        watchers.append(watcher)
+        return watcher
+
+    yield start
+    for watcher in watchers:
+        watcher.stop()
+
+
+def test_snapshot_diff_finds_added_changed_and_deleted_files(tmp_path):
+    write(tmp_path / "柏市" / "a.pdf", "a")
+    write(tmp_path / "b.txt", "b")
+    write(tmp_path / ".upload-1.part", "x")
+    before = snapshot(str(tmp_path))
+    assert set(before) == {str(tmp_path / "柏市" / "a.pdf"), str(tmp_path / "b.txt")}
+
+    write(tmp_path / "b.txt", "bb")
+    os.remove(tmp_path / "柏市" / "a.pdf")
+    write(tmp_path / "c.txt", "c")
+    assert diff_snapshots(before, snapshot(str(tmp_path))) == {
+        str(tmp_path / "柏市" / "a.pdf"), str(tmp_path / "b.txt"), str(tmp_path / "c.txt")
+    }
+
+
+def test_changes_are_batched(tmp_path, start):
+    recorder = Recorder()
+    watcher = start(recorder)
+    write(tmp_path / "a.txt", "a")
+    write(tmp_path / "柏市" / "b.pdf", "b")
+    batch = recorder.next()
+    # 同じ間隔のうちに変わったファイルは1回にまとめることもある
+    while len(batch) < 2:
+        batch += recorder.next()
+    assert sorted(batch) == sorted([str(tmp_path / "a.txt"), str(tmp_path / "柏市" / "b.pdf")])
+    assert watcher.stats()["mode"] == "polling"
+
+
+def test_failed_files_are_retried_then_given_up(tmp_path, start):
+    path = str(tmp_path / "broken.pdf")
+    recorder = Recorder(fail=[path])
+    watcher = start(recorder, max_retries=2)
+    write(path, "%PDF-")
+    # 最初の1回と再試行2回
+    for _ in range(3):
+        assert recorder.next() == [path]
+    with pytest.raises(queue.Empty):
+        recorder.next(timeout=0.5)
+    stats = watcher.stats()
+    assert stats["retries"] == 2 and stats["pending"] == 0
+    assert stats["last_batch"]["failed"] == 1
+
+    # ファイルが変わればまた取り込む
+    write(path, "%PDF-1.7")
+    assert recorder.next() == [path]
+
+
+def test_on_change_errors_do_not_stop_the_watcher(tmp_path, start):
+    recorder = Recorder(error=RuntimeError("index is broken"))
+    watcher = start(recorder)
+    write(tmp_path / "a.txt", "a")
+    recorder.next()
+    write(tmp_path / "b.txt", "b")
+    recorder.next()
+    stats = watcher.stats()
+    assert stats["failures"] >= 2
+    assert stats["last_batch"]["error"] == "index is broken"
+
+
+def test_files_indexed_by_upload_are_not_ingested_again(tmp_path, start):
+    recorder = Recorder()
+    watcher = start(recorder)
+    uploaded = str(tmp_path / "uploaded.pdf")
+    write(uploaded, "%PDF-")
+    watcher.mark_indexed([uploaded])
+    write(tmp_path / "other.txt", "x")
+    assert recorder.next() == [str(tmp_path / "other.txt")]
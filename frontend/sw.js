@@ -46,6 +46,10 @@ self.addEventListener('fetch', (event) => {
     url.pathname.startsWith('/health') ||
     url.pathname.startsWith('/config') ||
     url.pathname.startsWith('/ingest') ||
+    url.pathname.startsWith('/documents') || // アップロードの進捗
+    url.pathname === '/files' || // アップロードで増えるので一覧は毎回取得する
+    url.pathname.startsWith('/rules') || // ETagで毎回確認するのでブラウザのHTTPキャッシュに任せる
+    url.pathname.startsWith('/chunks') || // 内容アドレスなのでブラウザのHTTPキャッシュに任せる
     event.request.method !== 'GET'
   ) {
     return;
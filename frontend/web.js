@@ -15,6 +15,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const tempValue = document.getElementById('tempValue');
     const saveSettingsBtn = document.getElementById('saveSettings');
     const ttsEnabledSelect = document.getElementById('ttsEnabled');
+    const municipalitySelect = document.getElementById('municipalitySelect');
     const voiceInputBtn = document.getElementById('voiceInputBtn');
     const toggleThemeBtn = document.getElementById('toggleTheme');
     const connectionStatus = document.getElementById('connectionStatus');
@@ -31,12 +32,15 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- State ---
     let currentChatSession = [];
     let activeSessionId = null;
+    let conversationId = null; // サーバーが発行した会話ID（X-Conversation-ID）
     let lastUserQuery = null;
     let currentImageBase64 = null;
     let isStreaming = false;
 
     // Per-message source storage: maps message DOM elements to their source arrays
     const messageSourcesMap = new WeakMap();
+    // 取得済みのチャンク全文（回答にはIDとスニペットしか含まれない）
+    const chunkTextCache = new Map();
 
     // --- Sanitization helper ---
     function sanitize(html) {
@@ -232,6 +236,7 @@ document.addEventListener('DOMContentLoaded', () => {
         loadFileList();
         currentChatSession = [];
         activeSessionId = null;
+        conversationId = null;
         addMessage("新しいセッションを開始しました。ごみの分別や出し方について質問してください。", "system");
         renderHistorySidebar();
         showSection('mainUI');
@@ -485,6 +490,111 @@ document.addEventListener('DOMContentLoaded', () => {
     checkHealth();
     loadFileList();
 
+    // --- Offline rules bundle ---
+    // 品目名だけの簡単な質問は、サーバーが公開する分別ルールのバンドルを使って端末内で答える
+
+    const RULES_BUNDLE_FORMAT = 1;
+    const RULES_CACHE_NAME = 'gca-rules';
+    let rulesBundle = null;
+
+    // 自治体はモデルの設定（プリセット）とは別に端末に保存し、質問ごとにサーバーへ送る
+    function getMunicipality() {
+        return localStorage.getItem('municipality') || null;
+    }
+
+    function fillMunicipalityOptions(names) {
+        const current = getMunicipality();
+        municipalitySelect.innerHTML = '<option value="">指定しない</option>';
+        for (const name of names || []) {
+            const option = document.createElement('option');
+            option.value = name;
+            option.textContent = name;
+            municipalitySelect.appendChild(option);
+        }
+        // 選んでいた自治体がバンドルから消えた場合も、選択はそのまま残す
+        if (current && !(names || []).includes(current)) {
+            const option = document.createElement('option');
+            option.value = current;
+            option.textContent = current;
+            municipalitySelect.appendChild(option);
+        }
+        municipalitySelect.value = current || '';
+    }
+
+    municipalitySelect.addEventListener('change', () => {
+        if (municipalitySelect.value) {
+            localStorage.setItem('municipality', municipalitySelect.value);
+        } else {
+            localStorage.removeItem('municipality');
+        }
+    });
+
+    async function loadRulesBundle() {
+        const url = `${getApiBase()}/rules/bundle`;
+        try {
+            // no-cache: 毎回ETagで確認し、変わっていなければ304でブラウザのキャッシュを使う
+            const res = await fetch(url, { cache: 'no-cache' });
+            if (res.ok) {
+                const data = await res.clone().json();
+                if (data.format === RULES_BUNDLE_FORMAT) {
+                    rulesBundle = data;
+                    // オフライン時に使えるよう保存しておく（APIが別オリジンでも使える）
+                    if ('caches' in window) {
+                        caches.open(RULES_CACHE_NAME).then((cache) => cache.put(url, res));
+                    }
+                }
+                return;
+            }
+        } catch {
+            // オフライン: 保存済みのバンドルを使う
+        }
+        try {
+            if (!('caches' in window)) return;
+            const cached = await (await caches.open(RULES_CACHE_NAME)).match(url);
+            if (cached) {
+                const data = await cached.json();
+                if (data.format === RULES_BUNDLE_FORMAT) rulesBundle = data;
+            }
+        } catch (e) {
+            console.warn('Could not load rules bundle:', e);
+        }
+    }
+
+    // サーバー側の normalize_item と同じ規則（NFKC・小文字・空白除去・カタカナ→ひらがな）
+    function normalizeItem(text) {
+        return text.normalize('NFKC').toLowerCase().replace(/\s+/g, '')
+            .replace(/[\u30a1-\u30f6]/g, (ch) => String.fromCharCode(ch.charCodeAt(0) - 0x60));
+    }
+
+    const QUESTION_SUFFIX_RE = /(って|は)?((何|なに|なん)(ごみ|ゴミ)(ですか|でしょうか)?|の(捨て方|出し方|分別(方法)?)(は|を教えて(ください)?)?|(どう(やって)?)?捨て(ればいい|る)(の|ですか)?)$/;
+
+    // 端末内で答えるのは、自治体が分かっていて、その自治体の品目名がちょうど1件だけ一致したときに限る。
+    // 材質違いなどで候補が複数ある・別の自治体のルールしか無い場合はサーバーに任せる
+    function lookupLocalRules(text) {
+        const municipality = getMunicipality();
+        if (!rulesBundle || !municipality || !text || text.length > 30) return null;
+        const item = text.trim().replace(/[?？。!！\s]+$/, '').replace(QUESTION_SUFFIX_RE, '');
+        const key = normalizeItem(item);
+        const ids = rulesBundle.index[key] || [];
+        const matches = ids
+            .map((i) => rulesBundle.rules[i])
+            .filter((r) => r.municipality === municipality && normalizeItem(r.item) === key);
+        return matches.length === 1 ? matches : null;
+    }
+
+    function formatLocalAnswer(rules) {
+        const lines = rules.map((r) => {
+            const where = r.municipality ? `【${r.municipality}】` : '';
+            const method = r.disposal_method ? `（${r.disposal_method}）` : '';
+            const schedule = r.schedule ? ` 収集日: ${r.schedule}` : '';
+            return `- ${where}${r.item}: **${r.category}**${method}${schedule}`;
+        });
+        return `${lines.join('\n')}\n\n※端末に保存した早見表のデータから回答しています。詳しく知りたい場合は続けて質問してください。`;
+    }
+
+    fillMunicipalityOptions([]);
+    loadRulesBundle().then(() => fillMunicipalityOptions(rulesBundle && rulesBundle.municipalities));
+
     // --- Message rendering ---
 
     function renderMarkdown(text) {
@@ -641,10 +751,25 @@ document.addEventListener('DOMContentLoaded', () => {
                     <span class="source-popup-filename">[${i + 1}] ${sanitize(filename)}${pageLabel}</span>
                 </a>
             `;
+            if (typeof s === 'object' && s.chunk_id) {
+                html += `
+                    <button type="button" class="source-popup-expand" data-index="${i}">本文を表示</button>
+                    <div class="source-popup-text" data-index="${i}" hidden></div>
+                `;
+            }
         });
         html += '</div>';
         popup.innerHTML = html;
 
+        popup.querySelectorAll('.source-popup-expand').forEach(btn => {
+            btn.addEventListener('click', (e) => {
+                e.stopPropagation();
+                const index = btn.dataset.index;
+                const textEl = popup.querySelector(`.source-popup-text[data-index="${index}"]`);
+                toggleChunkText(btn, textEl, sources[index], apiBase);
+            });
+        });
+
         document.body.appendChild(popup);
 
         const btnRect = anchorBtn.getBoundingClientRect();
@@ -665,6 +790,31 @@ document.addEventListener('DOMContentLoaded', () => {
         popup.style.left = `${left}px`;
     }
 
+    async function toggleChunkText(btn, textEl, source, apiBase) {
+        if (!textEl.hidden) {
+            textEl.hidden = true;
+            btn.textContent = '本文を表示';
+            return;
+        }
+        textEl.hidden = false;
+        btn.textContent = '本文を閉じる';
+        // 全文はクライアントが開いたときだけ取得する
+        let text = chunkTextCache.get(source.chunk_id);
+        if (text === undefined) {
+            textEl.textContent = source.snippet || '読み込み中...';
+            try {
+                const res = await fetch(`${apiBase}/chunks/${encodeURIComponent(source.chunk_id)}`);
+                if (!res.ok) throw new Error(`HTTP ${res.status}`);
+                text = (await res.json()).text;
+                chunkTextCache.set(source.chunk_id, text);
+            } catch (err) {
+                console.warn('Failed to load chunk text:', err);
+                return;
+            }
+        }
+        textEl.textContent = text;
+    }
+
     // Close source popup on click outside
     document.addEventListener('click', (e) => {
         const popup = document.querySelector('.source-popup');
@@ -738,16 +888,34 @@ document.addEventListener('DOMContentLoaded', () => {
         imageInput.value = "";
         imagePreviewContainer.classList.add('hidden');
         imageBtn.classList.remove('active');
+
+        // 早見表で引ける品目名だけの質問は、サーバーに送らず端末内で答える
+        const localRules = requestImage ? null : lookupLocalRules(text);
+        if (localRules) {
+            const localMsg = createStreamingMessage();
+            messageSourcesMap.set(localMsg, localRules.map((r) => ({ filename: r.source, page: r.page })));
+            finalizeStreamingMessage(localMsg, formatLocalAnswer(localRules));
+            isStreaming = false;
+            userInput.disabled = false;
+            sendBtn.disabled = false;
+            voiceInputBtn.disabled = false;
+            imageBtn.disabled = false;
+            userInput.focus();
+            return;
+        }
         
         // ストリーミングメッセージ作成
         const streamMsg = createStreamingMessage();
+        // 問い合わせの際にサーバー側のトレースを探せるよう、リクエストIDを控えておく
+        let requestId = null;
 
         try {
             const config = JSON.parse(localStorage.getItem('rag_config') || '{}');
             const apiBase = getApiBase();
             
-            // 会話履歴を送信（最新10件、システムメッセージを除いた軽量版）
-            const history = currentChatSession.slice(-10).map(m => ({
+            // 会話履歴はサーバー側で会話IDごとに保持される。
+            // サーバー再起動時の引き継ぎ用に直近の数件だけを送る
+            const history = currentChatSession.slice(-3).map(m => ({
                 role: m.role,
                 text: m.text.slice(0, 500) // テキストは500文字に制限
             }));
@@ -761,8 +929,10 @@ document.addEventListener('DOMContentLoaded', () => {
                     temp: config.temp
                 },
                 location: null,
+                municipality: getMunicipality(),
                 image: requestImage,
-                history: history
+                history: history,
+                conversation_id: conversationId
             };
 
             const controller = new AbortController();
@@ -776,6 +946,8 @@ document.addEventListener('DOMContentLoaded', () => {
             });
 
             clearTimeout(timeoutId);
+            requestId = response.headers.get('X-Request-ID');
+            conversationId = response.headers.get('X-Conversation-ID') || conversationId;
 
             if (!response.ok) {
                 const errorData = await response.json().catch(() => ({}));
@@ -845,6 +1017,7 @@ document.addEventListener('DOMContentLoaded', () => {
             } else {
                 errorMsg += `予期せぬエラーが発生しました (${error.message})`;
             }
+            if (requestId) errorMsg += ` [リクエストID: ${requestId}]`;
             addMessage(errorMsg, "system");
         } finally {
             isStreaming = false;
@@ -976,7 +1149,8 @@ document.addEventListener('DOMContentLoaded', () => {
             id: activeSessionId || Date.now().toString(),
             title: sessionTitle,
             timestamp: new Date().toLocaleString(),
-            messages: currentChatSession
+            messages: currentChatSession,
+            conversationId: conversationId
         };
 
         if (!activeSessionId) activeSessionId = sessionData.id;
@@ -1001,6 +1175,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
         if (activeSessionId === sessionId) {
             activeSessionId = null;
+            conversationId = null;
             currentChatSession = [];
             chatLog.innerHTML = '';
             loadFileList();
@@ -1089,6 +1264,7 @@ document.addEventListener('DOMContentLoaded', () => {
         chatLog.innerHTML = '';
         currentChatSession = [...session.messages];
         activeSessionId = session.id;
+        conversationId = session.conversationId || null;
 
         const oldTts = ttsEnabledSelect.value;
         ttsEnabledSelect.value = 'false';